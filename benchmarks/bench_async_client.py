@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Times adding records one request at a time with Client against
+AsyncClient with a growing concurrency, against an api server started
+locally in a separate process. The server is wsgiref with a thread per
+request (from the standard library), so requests really are handled
+concurrently.
+
+    $ python benchmarks/bench_async_client.py [records] [concurrency...]
+"""
+import os
+import sys
+import time
+import socket
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from multiprocessing import Process
+import requests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import api
+from data.store.client import Client, AsyncClient
+
+HOST = "127.0.0.1"
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(port):
+    make_server(HOST, port, api.api, ThreadingWSGIServer,
+                QuietHandler).serve_forever()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind((HOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            requests.get("http://{}:{}/collections".format(HOST, port))
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("The api server did not start")
+
+
+def sync_add_records(port, collection, count, concurrency):
+    with Client(HOST, port) as client:
+        for n in xrange(count):
+            client.add_record(collection, {"n": n})
+
+
+def async_add_records(port, collection, count, concurrency):
+    with AsyncClient(HOST, port, concurrency=concurrency) as client:
+        results = [client.add_record(collection, {"n": n})
+                   for n in xrange(count)]
+        for result in results:
+            result.get()
+
+
+def main(count, concurrencies):
+    port = free_port()
+    process = Process(target=serve, args=(port,))
+    process.daemon = True
+    process.start()
+    try:
+        wait_for(port)
+        client = Client(HOST, port)
+        print "{} records".format(count)
+        print "{:>14} {:>10} {:>12}".format("client", "seconds", "records/s")
+        runs = [("Client", sync_add_records, 1)] + [
+            ("Async x{}".format(concurrency), async_add_records, concurrency)
+            for concurrency in concurrencies]
+        for name, function, concurrency in runs:
+            client.create_collection(name)
+            start = time.time()
+            function(port, name, count, concurrency)
+            seconds = time.time() - start
+            print "{:>14} {:>10.3f} {:>12.0f}".format(
+                name, seconds, count / seconds)
+        client.close()
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    count = args[0] if args else 2000
+    main(count, args[1:] or [4, 16, 64])
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Times a handful of queries repeated over and over, as an api serving
+the same searches would see them, against a Store without and with the
+result cache. Every few queries a record is updated, invalidating the
+results which held it.
+
+    $ python benchmarks/bench_cache.py [number_of_records] [queries]
+"""
+import os
+import re
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import Store
+
+# An update every this many queries
+UPDATE_EVERY = 50
+
+
+def run(store, descs, queries):
+    start = time.time()
+    for n in xrange(queries):
+        desc, options = descs[n % len(descs)]
+        store.find(desc, **options)
+        if n % UPDATE_EVERY == 0:
+            store.update_record(
+                {"_id": str(n % len(store))}, {"visits": n})
+    return queries / (time.time() - start)
+
+
+def main(size, queries):
+    descs = [
+        ({"group": 3, "age": 30}, {}),
+        ({"name": re.compile(r"user1\d*5$")}, {"order_by": "age"}),
+        ({"age": {"$gte": 80}}, {"order_by": "name", "limit": 20}),
+        ({"group": 1}, {"fields": ["name"], "limit": 50}),
+    ]
+    print "{:>10} {:>12} {:>12}".format("cache", "queries/s", "hit rate")
+    for cached in (False, True):
+        store = Store(
+            {"_id": str(x), "name": "user{}".format(x), "age": x % 90,
+             "group": x % 7}
+            for x in xrange(size))
+        if cached:
+            store.enable_cache()
+        rate = run(store, descs, queries)
+        info = store.cache_info()
+        hit_rate = "-" if info is None else "{:.1%}".format(
+            info["hits"] / float(info["hits"] + info["misses"]))
+        print "{:>10} {:>12.0f} {:>12}".format(
+            "on" if cached else "off", rate, hit_rate)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(args[0] if args else 100000, args[1] if len(args) > 1 else 400)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Compares the throughput (in MB/s) of the whole-buffer cipher, both
+in memory and streamed through a file, against the character at a
+time implementation encrypt and decrypt used to have.
+
+The old implementation is slow so it is only timed up to
+--max-legacy megabytes.
+
+    $ python benchmarks/bench_cipher.py [--max-legacy N] [megabytes...]
+"""
+import os
+import sys
+import time
+import base64
+import tempfile
+from itertools import cycle, izip
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store.cipher import (
+    encrypt, decrypt, EncryptingWriter, DecryptingReader)
+
+KEY = "password"
+
+
+def legacy_encrypt(string, key="_"):
+    return base64.encodestring(
+        ''.join(
+            chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key)))).strip()
+
+
+def legacy_decrypt(string, key="_"):
+    string = base64.decodestring(string)
+    return ''.join(
+        chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key))).strip()
+
+
+def stream_encrypt(data, filename):
+    with open(filename, "wb") as fout:
+        writer = EncryptingWriter(fout, KEY)
+        for start in xrange(0, len(data), 64 * 1024):
+            writer.write(data[start:start + 64 * 1024])
+        writer.close()
+
+
+def stream_decrypt(filename):
+    with open(filename, "rb") as fin:
+        reader = DecryptingReader(fin, KEY)
+        while reader.read(64 * 1024):
+            pass
+
+
+def throughput(size, function, *args):
+    start = time.time()
+    function(*args)
+    return size / (1024.0 * 1024) / (time.time() - start)
+
+
+def main(sizes, max_legacy):
+    filename = os.path.join(tempfile.mkdtemp(), "bench.db")
+    print "{:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "MB", "old enc", "new enc", "stream enc",
+        "old dec", "new dec", "stream dec")
+    for megabytes in sizes:
+        size = int(megabytes * 1024 * 1024)
+        data = os.urandom(size)
+        encrypted = encrypt(data, KEY)
+        row = [megabytes]
+        legacy = megabytes <= max_legacy
+        row.append(throughput(size, legacy_encrypt, data, KEY)
+                   if legacy else None)
+        row.append(throughput(size, encrypt, data, KEY))
+        row.append(throughput(size, stream_encrypt, data, filename))
+        row.append(throughput(size, legacy_decrypt, encrypted, KEY)
+                   if legacy else None)
+        row.append(throughput(size, decrypt, encrypted, KEY))
+        row.append(throughput(size, stream_decrypt, filename))
+        print "{:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            row[0], *("-" if value is None else "{:.1f}".format(value)
+                      for value in row[1:]))
+    os.remove(filename)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    max_legacy = 10
+    if args[:1] == ["--max-legacy"]:
+        max_legacy = float(args[1])
+        args = args[2:]
+    sizes = [float(arg) for arg in args] or [1, 10, 100]
+    main(sizes, max_legacy)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Times adding and fetching records through the REST api with a
+connection per request (module level requests calls, as Client used
+to make them), with the pooled keep-alive Client and with the
+buffered Client, against an api server started locally in a separate
+process.
+
+The server is run with cherrypy (as start_server.py does) by default,
+pass --server to use another bottle server adapter. Keep-alive needs
+a server which supports it, wsgiref for one closes the connection
+after every response.
+
+    $ python benchmarks/bench_client.py [--server NAME] [records]
+"""
+import os
+import sys
+import time
+import socket
+from multiprocessing import Process
+import requests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import api
+from data.store.client import Client
+
+HOST = "127.0.0.1"
+
+
+def serve(server, port):
+    api.api.run(server=server, host=HOST, port=port, quiet=True)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind((HOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            requests.get("http://{}:{}/collections".format(HOST, port))
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("The api server did not start")
+
+
+def legacy_add_records(port, collection, records):
+    url = "http://{}:{}/collections/{}/records".format(HOST, port, collection)
+    for record in records:
+        requests.post(url, json=record).json()
+
+
+def pooled_add_records(port, collection, records):
+    with Client(HOST, port) as client:
+        for record in records:
+            client.add_record(collection, record)
+
+
+def buffered_add_records(port, collection, records):
+    with Client(HOST, port, buffer_size=1000) as client:
+        for record in records:
+            client.add_record(collection, record)
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main(server, count):
+    port = free_port()
+    process = Process(target=serve, args=(server, port))
+    process.daemon = True
+    process.start()
+    try:
+        wait_for(port)
+        client = Client(HOST, port)
+        print "{} records, {} server".format(count, server)
+        print "{:>10} {:>10} {:>12}".format("client", "seconds", "records/s")
+        for name, function in (("per call", legacy_add_records),
+                               ("pooled", pooled_add_records),
+                               ("buffered", buffered_add_records)):
+            client.create_collection(name)
+            records = [{"n": n, "name": "user {}".format(n)}
+                       for n in xrange(count)]
+            seconds = timed(function, port, name, records)
+            print "{:>10} {:>10.3f} {:>12.0f}".format(
+                name, seconds, count / seconds)
+        seconds = timed(client.get_records, "buffered", {})
+        print "{:>10} {:>10.3f} {:>12.0f}".format(
+            "fetch all", seconds, count / seconds)
+        client.close()
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    server = "cherrypy"
+    if args[:1] == ["--server"]:
+        server = args[1]
+        args = args[2:]
+    main(server, int(args[0]) if args else 2000)
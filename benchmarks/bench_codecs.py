@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Reports how fast Store.persist writes and data.store.load reads a
+Store with each codec (and without one, the default protocol pickle
+every earlier version wrote), and how large the files are, for a few
+sizes of Store.
+
+    $ python benchmarks/bench_codecs.py [number_of_records...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import data.store
+from data.store import Store, codec
+
+
+def make_store(size):
+    return Store(
+        {"_id": "{:08d}".format(x), "name": "user{}".format(x),
+         "email": "user{}@example.com".format(x), "age": x % 90,
+         "score": x / 7.0, "active": x % 3 == 0, "tags": ["a", "b"]}
+        for x in xrange(size))
+
+
+def best(function, repeat=3):
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(sizes):
+    directory = tempfile.mkdtemp()
+    try:
+        print "{:>9} {:>8} {:>12} {:>12} {:>10}".format(
+            "records", "codec", "write rec/s", "read rec/s", "size KB")
+        for size in sizes:
+            store = make_store(size)
+            for name in [None] + codec.available():
+                filename = os.path.join(directory, "bench.db")
+                write = best(lambda: store.persist(filename, codec=name))
+                read = best(lambda: data.store.load(filename))
+                print "{:>9} {:>8} {:>12.0f} {:>12.0f} {:>10.0f}".format(
+                    size, name or "default", size / write, size / read,
+                    os.path.getsize(filename) / 1024.0)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Measures find throughput with a growing number of reader threads
+while one writer thread keeps adding and deleting records, once with
+the Store's reader-writer lock and once with an exclusive lock (what
+every operation would get from a plain RLock).
+
+Because of the GIL, pure Python finds don't run in parallel, what the
+reader-writer lock buys is that readers don't queue behind each other
+(or behind a reader the writer is waiting for) on every call.
+
+    $ python benchmarks/bench_contention.py [--seconds N] [threads...]
+"""
+import os
+import sys
+import time
+from threading import Thread, Event, RLock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import Store
+
+
+class ExclusiveLock(object):
+    """Looks like an RWLock but lets a single thread in at a time."""
+
+    def __init__(self):
+        self._lock = RLock()
+
+    def read(self):
+        return self._lock
+
+    def write(self):
+        return self._lock
+
+
+def create_store(exclusive):
+    store = Store({"n": n, "group": n % 100} for n in xrange(20000))
+    store.create_index("group")
+    if exclusive:
+        store._lock = ExclusiveLock()
+    return store
+
+
+def run(store, readers, seconds):
+    stop = Event()
+    reads = [0] * readers
+    writes = [0]
+
+    def read(slot):
+        group = slot
+        while not stop.is_set():
+            store.find({"group": group % 100, "n": {"$gte": 0}})
+            group += 1
+            reads[slot] += 1
+
+    def write():
+        n = len(store)
+        while not stop.is_set():
+            store.add_record({"n": n, "group": n % 100})
+            store.del_records({"n": n})
+            n += 1
+            writes[0] += 1
+            time.sleep(0.001)
+    threads = [Thread(target=read, args=(slot,)) for slot in range(readers)]
+    threads.append(Thread(target=write))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(reads) / seconds, writes[0] / seconds
+
+
+def main(thread_counts, seconds):
+    print "{:>8} {:>14} {:>14} {:>14} {:>14}".format(
+        "readers", "rw reads/s", "rw writes/s", "excl reads/s",
+        "excl writes/s")
+    for readers in thread_counts:
+        row = [readers]
+        for exclusive in (False, True):
+            row.extend(run(create_store(exclusive), readers, seconds))
+        print "{:>8} {:>14.0f} {:>14.0f} {:>14.0f} {:>14.0f}".format(*row)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    seconds = 2.0
+    if args[:1] == ["--seconds"]:
+        seconds = float(args[1])
+        args = args[2:]
+    thread_counts = [int(arg) for arg in args] or [1, 2, 4, 8]
+    main(thread_counts, seconds)
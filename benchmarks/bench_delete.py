@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Compares deleting many records with del_records and taking the
+complement with filter against the way both used to work (a call to
+list.remove, itself a scan with dict comparisons, per match).
+
+The old implementations are quadratic so they are only timed up to
+--max-legacy records.
+
+    $ python benchmarks/bench_delete.py [--max-legacy N] [sizes...]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import Store
+
+
+def legacy_del_records(store, desc):
+    records = store.find(desc)
+    for record in records:
+        list.remove(store, record)
+
+
+def legacy_filter(store, desc):
+    matches = store.find(desc)
+    ret = [record.copy() for record in store]
+    for match in matches:
+        ret.remove(match)
+    return ret
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def create_store(size):
+    return Store({"n": n, "group": n % 10} for n in xrange(size))
+
+
+def main(sizes, max_legacy):
+    desc = {"group": 3}
+    print "{:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "records", "old del", "new del", "old filter", "new filter")
+    for size in sizes:
+        row = [size]
+        if size <= max_legacy:
+            row.append(timed(legacy_del_records, create_store(size), desc))
+        else:
+            row.append(None)
+        row.append(timed(Store.del_records, create_store(size), desc))
+        store = create_store(size)
+        if size <= max_legacy:
+            row.append(timed(legacy_filter, store, desc))
+        else:
+            row.append(None)
+        row.append(timed(store.filter, desc))
+        print "{:>10} {:>12} {:>12} {:>12} {:>12}".format(
+            row[0], *("-" if value is None else "{:.3f}s".format(value)
+                      for value in row[1:]))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    max_legacy = 20000
+    if args[:1] == ["--max-legacy"]:
+        max_legacy = int(args[1])
+        args = args[2:]
+    sizes = [int(arg) for arg in args] or [10 ** 4, 10 ** 5, 10 ** 6]
+    main(sizes, max_legacy)
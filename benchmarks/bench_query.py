@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Compares the number of records per second find can scan when the
+desc is interpreted for every record (the way find used to work) and
+when it is compiled once into a single predicate.
+
+    $ python benchmarks/bench_query.py [number_of_records]
+"""
+import os
+import re
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import Store
+
+
+def interpreted(store, desc):
+    """The matching loop find used before descs were compiled."""
+    ret = []
+    for item in store:
+        for key, value in desc.items():
+            if hasattr(value, "match"):
+                if not value.match(item.get(key, None)):
+                    break
+            elif callable(value):
+                if not value(item[key]):
+                    break
+            else:
+                if not value == item.get(key, None):
+                    break
+        else:
+            ret.append(item)
+    return ret
+
+
+def compiled(store, desc):
+    return list(store._iter_matches(desc))
+
+
+def timed(function, store, desc, repeat=5):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        function(store, desc)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(store) / best
+
+
+def main(size):
+    store = Store(
+        {"name": "user{}".format(x), "age": x % 90, "group": x % 7}
+        for x in xrange(size))
+    descs = [
+        ("equality", {"group": 3, "age": 30}),
+        ("regex", {"name": re.compile(r"user1\d*5$"), "group": 3}),
+        ("callable", {"age": lambda age: age > 50, "group": 1}),
+    ]
+    print "{:>10} {:>16} {:>16} {:>8}".format(
+        "desc", "before rec/s", "after rec/s", "speedup")
+    for name, desc in descs:
+        assert interpreted(store, desc) == compiled(store, desc)
+        before = timed(interpreted, store, desc)
+        after = timed(compiled, store, desc)
+        print "{:>10} {:>16,.0f} {:>16,.0f} {:>7.2f}x".format(
+            name, before, after, after / before)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Compares the time a CPU bound scan (a regex and a callable which
+can't use an index) takes on a Store and on ShardedStores with a
+growing number of shards. On a machine with at least as many cores
+as shards the scan time should fall close to linearly.
+
+    $ python benchmarks/bench_sharded.py [--records N] [shards...]
+"""
+import os
+import re
+import sys
+import time
+from multiprocessing import cpu_count
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from data.store import Store
+from data.store.sharded import ShardedStore
+
+DESC = {"email": re.compile(r".*7@example\.com$")}
+
+
+def checksum(value):
+    # Defined at the top level so it can be pickled for the shards
+    return sum(ord(c) for c in value) % 7 == 0
+
+
+def create_records(count):
+    return [{"n": n, "name": "user {}".format(n),
+             "email": "user{}@example.com".format(n)}
+            for n in xrange(count)]
+
+
+def timed(store, repeat=3):
+    desc = dict(DESC, name=checksum)
+    start = time.time()
+    for _ in range(repeat):
+        results = store.find(desc, order_by="n", limit=100)
+    return (time.time() - start) / repeat, len(results)
+
+
+def main(shard_counts, records):
+    print "{} records, {} cores".format(records, cpu_count())
+    print "{:>8} {:>10} {:>10}".format("shards", "seconds", "speedup")
+    base, expected = timed(Store(create_records(records)))
+    print "{:>8} {:>10.3f} {:>10}".format("Store", base, "1.00x")
+    for shards in shard_counts:
+        with ShardedStore(create_records(records), shards) as store:
+            seconds, found = timed(store)
+        assert found == expected
+        print "{:>8} {:>10.3f} {:>9.2f}x".format(
+            shards, seconds, base / seconds)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    records = 200000
+    if args[:1] == ["--records"]:
+        records = int(args[1])
+        args = args[2:]
+    shard_counts = [int(arg) for arg in args] or sorted(
+        set([1, 2, 4, cpu_count()]))
+    main(shard_counts, records)
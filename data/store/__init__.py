@@ -20,14 +20,26 @@ This module provide an easy api to a generic schema-less data_store.
 
 ## Load persisted data_store
 """
+import os
 import pickle
-from cStringIO import StringIO
 from store import Store, decrypt
+from cipher import DecryptingReader
+import codec as codecs
+from mapped import MappedStore, dump as dump_mapped, is_mapped
+import journal
 
 
-def load(filename, password=None):
+def load(filename, password=None, codec=None):
     """Returns a data_store loaded from a file to which it
-    was persisted
+    was persisted. If the Store was journaled (see Store.journal)
+    the changes logged since its last snapshot are replayed. Files
+    written by dump_mapped are read completely, use MappedStore to
+    open them lazily.
+
+    The codec the file was written with (see Store.persist) is read
+    from the file. If codec is given a ValueError is raised unless
+    the file was written with it, pass a codec which is safe to load
+    (ie 'jsonl') to never unpickle a file from an untrusted source.
 
     >>> store = Store([
     ...     {'this': 'that', '_id': 'test1'},
@@ -38,17 +50,34 @@ def load(filename, password=None):
     >>> store == store2
     True
     """
-    if password:
-        with open(filename, "rb") as fin:
-            contents = fin.read()
-            contents = decrypt(contents, key=password)
-        f = StringIO()
-        f.write(contents)
-        f.seek(0)
-        store = pickle.load(f)
-    else:
-        with open(filename, "rb") as fin:
+    if not password and codec is None and is_mapped(filename):
+        with MappedStore(filename) as mapped:
+            return mapped.load()
+    lsn = 0
+    with open(filename, "rb") as fin:
+        header = codecs.read_header(fin)
+        # Files without a header are pickled Stores
+        found = "pickle" if header is None else header["codec"]
+        if codec is not None and codec != found:
+            raise ValueError("{} was written with the {} codec, not {}".format(
+                filename, found, codec))
+        if header is not None:
+            store = Store(codecs.load(fin, header, password))
+            store.__setstate__(header["state"])
+        elif password:
+            store = pickle.load(DecryptingReader(fin, password))
+        else:
             store = pickle.load(fin)
+            try:
+                # Snapshots written by Store.journal end with an lsn
+                lsn = pickle.load(fin)
+            except EOFError:
+                pass
+    if "_ids" not in vars(store):
+        # persisted by a version of data.store without the '_id' index
+        store._reindex()
+    if not password and os.path.exists(journal.wal_filename(filename)):
+        journal.replay(store, filename, lsn)
     return store
 
 default_store = Store()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Aggregates computed over groups of records in a single pass.
+
+An aggregate is named in a dict of name to spec, where spec is either
+"count" (the number of records) or an (operation, field) tuple:
+
+    {"n": "count", "total": ("sum", "amount"), "oldest": ("max", "age")}
+
+The operations are "count" (of the records holding field), "sum",
+"min", "max" and "avg". Records missing field, or holding None, are
+left out of an aggregate over it. Only a small running state is kept
+for each group, the records themselves are never collected.
+"""
+OPERATIONS = ("count", "sum", "min", "max", "avg")
+
+
+def group_key(by):
+    """Returns a function which accepts a record and returns the value
+    it is grouped under: the value of by, or the tuple of the values of
+    the fields in by if it is a list or tuple. Missing fields are
+    grouped under None.
+
+    >>> group_key(["a", "b"])({"a": 1})
+    (1, None)
+    """
+    if isinstance(by, (list, tuple)):
+        fields = tuple(by)
+        return lambda record: tuple(map(record.get, fields))
+    return lambda record: record.get(by)
+
+
+class Aggregation(object):
+    def __init__(self, aggregates):
+        """Computes aggregates (see the module docstring) over a group
+        of records: start() returns the state of an empty group,
+        update(state, record) adds a record to it and result(state)
+        returns the dict of name to value.
+
+        >>> aggregation = Aggregation({"n": "count", "avg": ("avg", "x")})
+        >>> state = aggregation.start()
+        >>> for record in [{"x": 1}, {"x": 2}, {}]:
+        ...     aggregation.update(state, record)
+        >>> sorted(aggregation.result(state).items())
+        [('avg', 1.5), ('n', 3)]
+        """
+        self.specs = []
+        for name, spec in sorted(aggregates.items()):
+            if isinstance(spec, basestring):
+                operation, field = spec, None
+            else:
+                operation, field = spec
+            if operation not in OPERATIONS:
+                raise ValueError("Unknown aggregate {}".format(operation))
+            if field is None and operation != "count":
+                raise ValueError(
+                    "The {} aggregate needs a field".format(operation))
+            self.specs.append((name, operation, field))
+
+    def start(self):
+        """Returns the state of an empty group, a [count, value] pair
+        per aggregate."""
+        return [[0, None] for spec in self.specs]
+
+    def update(self, state, record):
+        """Add record to the group whose state is state."""
+        get = record.get
+        for entry, (name, operation, field) in zip(state, self.specs):
+            if field is None:
+                entry[0] += 1
+                continue
+            value = get(field)
+            if value is None:
+                continue
+            if not entry[0]:
+                entry[1] = value
+            elif operation == "sum" or operation == "avg":
+                entry[1] += value
+            elif operation == "min":
+                if value < entry[1]:
+                    entry[1] = value
+            elif operation == "max":
+                if value > entry[1]:
+                    entry[1] = value
+            entry[0] += 1
+
+    def merge(self, state, other):
+        """Add the records counted in the state other (ie the state of
+        the same group computed elsewhere) to state."""
+        for entry, more, (name, operation, field) in zip(
+                state, other, self.specs):
+            if not more[0]:
+                continue
+            if not entry[0]:
+                entry[1] = more[1]
+            elif operation == "sum" or operation == "avg":
+                entry[1] += more[1]
+            elif operation == "min":
+                entry[1] = min(entry[1], more[1])
+            elif operation == "max":
+                entry[1] = max(entry[1], more[1])
+            entry[0] += more[0]
+
+    def states(self, records, by):
+        """Returns a dict mapping the key (see group_key) of each group
+        of records grouped by by to its state."""
+        key = group_key(by)
+        states = {}
+        start, update = self.start, self.update
+        for record in records:
+            value = key(record)
+            try:
+                state = states[value]
+            except KeyError:
+                state = states[value] = start()
+            update(state, record)
+        return states
+
+    def result(self, state):
+        """Returns the dict of aggregate name to value for state."""
+        result = {}
+        for (count, value), (name, operation, field) in zip(
+                state, self.specs):
+            if operation == "count":
+                result[name] = count
+            elif operation == "sum":
+                result[name] = value if count else 0
+            elif operation == "avg":
+                result[name] = value / float(count) if count else None
+            else:
+                result[name] = value
+        return result
@@ -1,23 +1,163 @@
 import json
+import time
+import hashlib
+from itertools import islice
 import bottle
 import data.store
+from data.store.query import is_operator
 
 api = bottle.Bottle(__name__)
 
+# The collections by name, a dict or anything else which works like
+# one (ie a data.store.registry.Registry)
 collections = {}
 
+# When set, collections created through the api cache the results of
+# up to this many queries, see data.store.Store.enable_cache
+cache_size = None
+
+
+def _parse_desc(query):
+    """Returns a desc built from the query string. Values which are
+    JSON encoded operator dicts (ie '{"$gte": 18}') are decoded, all
+    other values are used as-is. Parameters starting with '$' are
+    options (ie '$fields') rather than part of the desc."""
+    desc = {}
+    for key, value in query.items():
+        if key.startswith("$"):
+            continue
+        if value.startswith("{"):
+            try:
+                operators = json.loads(value)
+            except ValueError:
+                pass
+            else:
+                if is_operator(operators):
+                    value = operators
+        desc[key] = value
+    return desc
+
+
+def _parse_fields(query):
+    """Returns the projection requested through the '$fields' query
+    parameter, a comma separated list of field names to include or
+    (when prefixed with '-') to exclude."""
+    fields = query.get("$fields")
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if all(name.startswith("-") for name in names):
+        return dict((name[1:], 0) for name in names)
+    return names
+
+
+NDJSON = "application/x-ndjson"
+
+# The number of records encoded into each chunk of a streamed response
+CHUNK_RECORDS = 256
+
+
+def _chunks(records, ndjson=False):
+    """Yields the JSON encoding of records (an iterable of dicts) in
+    chunks of CHUNK_RECORDS records, as a JSON list exactly as
+    json.dumps would encode it or, if ndjson is True, one record per
+    line."""
+    remaining = iter(records)
+    first = True
+    if not ndjson:
+        yield "["
+    while True:
+        batch = [json.dumps(record)
+                 for record in islice(remaining, CHUNK_RECORDS)]
+        if not batch:
+            break
+        if ndjson:
+            yield "\n".join(batch) + "\n"
+        else:
+            yield ("" if first else ", ") + ", ".join(batch)
+        first = False
+    if not ndjson:
+        yield "]"
+
+
+def _stream(records):
+    """Returns a generator of chunks of the JSON encoding of records
+    (an iterable of dicts) and sets the Content-Type to match. If the
+    request accepts NDJSON the records are sent one per line,
+    otherwise as a JSON list, see _chunks. Nothing is encoded before
+    the response is being sent."""
+    ndjson = NDJSON in bottle.request.headers.get("Accept", "")
+    bottle.response.content_type = NDJSON if ndjson else "application/json"
+    return _chunks(records, ndjson)
+
+
+def _not_modified(store, *parts):
+    """Sets the ETag and Last-Modified headers of the response from
+    the version of store (and parts, anything else the response depends
+    on) and returns True if the request's If-None-Match (or, failing
+    that, If-Modified-Since) header shows the client already has the
+    response, in which case the status is set to 304.
+
+    Dates only have whole seconds, so Last-Modified is only sent once
+    the second of the last change is over (a later change can't share
+    it), and If-Modified-Since is only trusted for a second which is
+    over."""
+    state = (id(store), store.version, store.modified) + parts
+    etag = '"{}"'.format(hashlib.sha1(repr(state)).hexdigest()[:20])
+    now = int(time.time())
+    modified = int(store.modified)
+    bottle.response.set_header("ETag", etag)
+    if modified < now:
+        bottle.response.set_header("Last-Modified", bottle.http_date(modified))
+    bottle.response.set_header("Cache-Control", "no-cache")
+    bottle.response.set_header("Vary", "Accept")
+    headers = bottle.request.headers
+    if "If-None-Match" in headers:
+        tags = [tag.strip() for tag in headers["If-None-Match"].split(",")]
+        fresh = "*" in tags or etag in tags or "W/" + etag in tags
+    else:
+        since = bottle.parse_date(headers.get("If-Modified-Since", ""))
+        fresh = since is not None and modified <= since < now
+    if fresh:
+        bottle.response.status = 304
+    return fresh
+
 
 @api.route("/collections")
 def get_collections():
-    """Returns a list of collections."""
+    """Streams a JSON object of every collection's name to its list of
+    records. The collections are read one at a time while the response
+    is sent, so a Registry never has to hold all of them at once."""
     global collections
-    return collections
+    bottle.response.content_type = "application/json"
+
+    def chunks():
+        yield "{"
+        first = True
+        for name in list(collections):
+            try:
+                store = collections[name]
+            except KeyError:
+                # Deleted since the names were listed
+                continue
+            yield ("" if first else ", ") + json.dumps(name) + ": "
+            for chunk in _chunks(store.iter_find({}, copy=True)):
+                yield chunk
+            first = False
+        yield "}"
+    return chunks()
 
 
 @api.route("/collections/<name>")
 def get_collection(name):
+    """Streams the records of collection name, see _stream. Nothing
+    is sent if they haven't changed since the client last got them,
+    see _not_modified"""
     global collections
-    return json.dumps(collections[name])
+    store = collections[name]
+    if _not_modified(store, bottle.request.headers.get("Accept", "")):
+        return ""
+    return _stream(store.iter_find({}, copy=True))
 
 
 @api.route("/collections/<collection>", method="POST")
@@ -25,6 +165,8 @@ def post_collection(collection):
     """Creates a collection"""
     global collections
     new_collection = data.store.Store()
+    if cache_size:
+        new_collection.enable_cache(cache_size)
     collections[collection] = new_collection
     return json.dumps(new_collection)
 
@@ -53,13 +195,41 @@ def post_record(collection):
 
 @api.route("/collections/<collection>/records")
 def get_records(collection):
-    """Search collection for records"""
+    """Search collection for records, the matches are streamed as
+    they are found, see _stream. If the collection caches results
+    repeated searches are answered from its cache instead. Nothing is
+    sent if the collection hasn't changed since the client last got
+    them, see _not_modified"""
     global collections
     if collection not in collections:
         bottle.abort(404)
-    desc = bottle.request.query
+    store = collections[collection]
+    if _not_modified(store, bottle.request.query_string,
+                     bottle.request.headers.get("Accept", "")):
+        return ""
+    desc = _parse_desc(bottle.request.query)
+    fields = _parse_fields(bottle.request.query)
+    if store.cache_info() is None:
+        records = store.iter_find(desc, copy=True, fields=fields)
+    else:
+        records = store.find(desc, fields=fields)
+    return _stream(records)
+
+
+@api.route("/collections/<collection>/aggregate", method="POST")
+def aggregate(collection):
+    """Runs the pipeline (a JSON list of stages) in the body over
+    collection, see data.store.Store.aggregate"""
+    global collections
+    if collection not in collections:
+        bottle.abort(404)
+    try:
+        pipeline = json.loads(bottle.request.body.read())
+        results = list(collections[collection].aggregate(pipeline))
+    except (ValueError, KeyError, TypeError) as error:
+        bottle.abort(400, text="invalid pipeline: {}".format(error))
     bottle.response.content_type = "application/json"
-    return json.dumps(collections[collection].find(desc))
+    return json.dumps(results)
 
 
 @api.route("/collections/<collection>/records", method="DELETE")
@@ -70,30 +240,52 @@ def delete_record(collection):
     global collections
     if collection not in collections:
         bottle.abort(404)
-    desc = bottle.request.query
+    desc = _parse_desc(bottle.request.query)
     record = collections[collection].del_record(desc)
     return json.dumps(record)
 
 
+def _parse_operations(request):
+    """Returns the list of operations in the body of request, either a
+    JSON list or (if the Content-Type is NDJSON) one JSON encoded
+    operation per line. The whole body is decoded before any operation
+    is applied, so a malformed body changes nothing."""
+    if request.content_type.split(";")[0].strip() == NDJSON:
+        return [json.loads(line) for line in request.body if line.strip()]
+    operations = json.loads(request.body.read())
+    if not isinstance(operations, list):
+        raise ValueError("expected a list of operations")
+    return operations
+
+
+@api.route(r"/collections/<collection>/records\:bulk", method="POST")
+def bulk_write(collection):
+    """Applies a batch of inserts, updates and deletes to collection
+    and returns the status of each, see data.store.Store.bulk_write"""
+    global collections
+    if collection not in collections:
+        bottle.abort(404)
+    try:
+        operations = _parse_operations(bottle.request)
+        statuses = collections[collection].bulk_write(operations)
+    except ValueError as error:
+        bottle.abort(400, text="invalid operations: {}".format(error))
+    bottle.response.content_type = "application/json"
+    return json.dumps(statuses)
+
+
 @api.route("/collections/<collection>/records/<_id>", method="PUT")
 def update_record(collection, _id):
     """Updates a record with _id in collection."""
     global collections
-    with open("/tmp/api.log", "w") as fout:
-        fout.write("here {} {}".format(collection, _id))
     if collection not in collections:
         bottle.abort(404)
     if _id is None:
         bottle.abort(404, text="record not found")
 
-    record = collections[collection].find({"_id": _id})
-    if len(record) != 1:
-        bottle.abort(404, text="one unique record could not be located.")
-
-    record = record[0]
     body = json.loads(bottle.request.body.read())
-    for key, value in body.items():
-        record[key] = value
-    collections[collection].del_record({"_id": _id})
-    collections[collection].add_record(record)
+    try:
+        record = collections[collection].update_record({"_id": _id}, body)
+    except ValueError:
+        bottle.abort(404, text="one unique record could not be located.")
     return json.dumps(record)
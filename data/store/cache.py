@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""A bounded cache of query results, see Store.enable_cache.
+
+Entries are keyed by the name of the query method, a normalized desc
+and the options the query was made with. Regular expressions and
+callables in a desc can't be compared by value, so they are keyed by
+identity: passing the same compiled regex (or function) again hits the
+cache, an equivalent new one misses. An entry keeps a reference to its
+desc so the identities it was keyed by can't be reused while it lives.
+
+Every entry remembers the fields its query depends on (the fields in
+its desc and the field it is ordered by) and the '_id's of the records
+in its results. Updating a record only drops the entries depending on
+an updated field or holding the record, adding or removing records
+drops every entry.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+def freeze(value):
+    """Returns a hashable stand-in for value (a desc or an option) to
+    build a cache key from. A TypeError is raised if value holds
+    anything which can't be hashed (ie a set).
+
+    >>> freeze({"n": {"$in": [1, 2]}}) == freeze({"n": {"$in": [1, 2]}})
+    True
+    >>> freeze({"n": [1, 2]}) == freeze({"n": (1, 2)})
+    False
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted(
+            (key, freeze(item)) for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(item) for item in value))
+    if hasattr(value, "match") or callable(value):
+        return (id, id(value))
+    hash(value)
+    return value
+
+
+class ResultCache(object):
+    def __init__(self, maxsize=128):
+        """A cache of up to maxsize query results, the least recently
+        used entry is evicted to make room for a new one. hits and
+        misses count the lookups which found (or didn't find) an
+        entry. The cache is safe to use from several threads.
+
+        >>> cache = ResultCache(2)
+        >>> key = cache.key("find", {"n": 1}, ())
+        >>> cache.get(key)
+        (False, None)
+        >>> cache.put(key, [{"_id": "a", "n": 1}], {"n": 1}, ["n"])
+        >>> cache.get(key)
+        (True, [{'_id': 'a', 'n': 1}])
+        >>> cache.invalidate(["other"], "b")
+        >>> cache.get(key)[0]
+        True
+        >>> cache.invalidate(["other"], "a")
+        >>> cache.get(key)[0]
+        False
+        >>> cache.hits, cache.misses
+        (2, 2)
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, method, desc, options):
+        """Returns the key for the results of calling method with desc
+        and options (a tuple), or None if they can't be cached."""
+        try:
+            return method, freeze(desc), freeze(options)
+        except TypeError:
+            return None
+
+    def get(self, key):
+        """Returns (True, results) if key is cached, otherwise
+        (False, None)."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, results, desc, fields):
+        """Cache results (a list of records or a single record, which
+        may be None) under key. desc is the desc they were found with,
+        fields the names of the fields the query depends on."""
+        if isinstance(results, dict):
+            ids = frozenset([results["_id"]])
+        elif results is None:
+            ids = frozenset()
+        else:
+            ids = frozenset(record["_id"] for record in results)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (results, frozenset(fields), ids, desc)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, fields=None, _id=None):
+        """Drop the entries which may have changed when the fields (a
+        list of names) of the record with _id were updated. If fields
+        is None every entry is dropped."""
+        with self._lock:
+            if fields is None:
+                self._entries.clear()
+                return
+            fields = set(fields)
+            for key, (results, depends, ids, desc) in self._entries.items():
+                if _id in ids or not fields.isdisjoint(depends):
+                    del self._entries[key]
+
+    def info(self):
+        """Returns a dict of the hits, misses, size and maxsize of this
+        cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "maxsize": self.maxsize}
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""The XOR + base64 cipher used by data.store for encrypted fields and
+encrypted persistence.
+
+The XOR is done on whole buffers at once with str.translate, so no
+Python code runs per character. EncryptingWriter and DecryptingReader
+apply the cipher to a file chunk by chunk and produce exactly what
+encrypt and decrypt would for the whole contents, so persisted Stores
+can be encrypted and decrypted without holding the file in memory.
+"""
+import base64
+import binascii
+
+# base64.encodestring writes lines of 76 characters, each encoding
+# 57 bytes. Chunks which are a multiple of that encode to whole lines.
+LINE = 57
+CHUNK = LINE * 16 * 1024
+
+
+# _TABLES[k] maps every byte to itself XORed with k, for str.translate
+_TABLES = {}
+
+
+def _table(key_byte):
+    try:
+        return _TABLES[key_byte]
+    except KeyError:
+        _TABLES[key_byte] = "".join(
+            chr(value ^ ord(key_byte)) for value in xrange(256))
+        return _TABLES[key_byte]
+
+
+def xor(data, key, offset=0):
+    """Returns data XORed with key repeated, starting offset bytes into
+    the repeated key.
+
+    Every len(key)th byte of data is XORed with the same byte of key,
+    so each of those strided slices is translated in one call and
+    written back into the result with an extended slice assignment.
+
+    >>> xor(xor("secret", "key"), "key")
+    'secret'
+    >>> xor("cret", "key", offset=2) == xor("secret", "key")[2:]
+    True
+    """
+    step = len(key)
+    result = bytearray(len(data))
+    for start in xrange(min(step, len(data))):
+        result[start::step] = data[start::step].translate(
+            _table(key[(offset + start) % step]))
+    return str(result)
+
+
+def _bytes(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+
+# Values up to SMALL bytes are XORed as integers against a cached
+# integer of the key stream, which is much cheaper than translating
+# them for values as short as most fields.
+SMALL = 1024
+MAX_STREAMS = 64
+_STREAMS = {}
+
+
+class KeyStream(object):
+    def __init__(self, key):
+        """The cipher for one key. The key stream is computed once and
+        cached, as integers for short values and as translate tables
+        for longer ones, so it pays to reuse a KeyStream (see
+        key_stream) for every value encrypted with the same key.
+
+        >>> stream = KeyStream("key")
+        >>> stream.decrypt(stream.encrypt("secret"))
+        'secret'
+        """
+        self.key = _bytes(key)
+        self._ints = {}
+
+    def xor(self, data, offset=0):
+        """Returns data XORed with the key, see xor."""
+        length = len(data)
+        if not length or length > SMALL:
+            return xor(data, self.key, offset)
+        start = offset % len(self.key)
+        try:
+            stream = self._ints[start, length]
+        except KeyError:
+            if len(self._ints) >= SMALL:
+                self._ints.clear()
+            repeats = (start + length) // len(self.key) + 1
+            stream = self._ints[start, length] = int(binascii.hexlify(
+                (self.key * repeats)[start:start + length]), 16)
+        value = int(binascii.hexlify(data), 16) ^ stream
+        return binascii.unhexlify("%0*x" % (2 * length, value))
+
+    def encrypt(self, string):
+        """Returns encrypt(string, key)."""
+        data = self.xor(_bytes(string))
+        if len(data) <= LINE:
+            # encodestring would loop to produce this single line
+            return binascii.b2a_base64(data)[:-1]
+        return base64.encodestring(data).strip()
+
+    def decrypt(self, string):
+        """Returns decrypt(string, key)."""
+        return self.xor(binascii.a2b_base64(string)).strip()
+
+
+def key_stream(key):
+    """Returns the cached KeyStream for key."""
+    try:
+        return _STREAMS[key]
+    except KeyError:
+        if len(_STREAMS) >= MAX_STREAMS:
+            _STREAMS.clear()
+        stream = _STREAMS[key] = KeyStream(key)
+        return stream
+
+
+def encrypt(string, key="_"):
+    """Return the base64 encoded XORed version of string. This is XORed with
+    key which defaults to a single underscore."""
+    return key_stream(key).encrypt(string)
+
+
+def decrypt(string, key="_"):
+    """Returns the base64 decoded, XORed version of string. This is XORed with
+    key, which defaults to a single underscore"""
+    return key_stream(key).decrypt(string)
+
+
+class EncryptingWriter(object):
+    def __init__(self, fileobj, key):
+        """A file-like object which encrypts everything written to it
+        into fileobj. Once closed, fileobj holds exactly what
+        encrypt(everything written, key) would return.
+
+        >>> from cStringIO import StringIO
+        >>> out = StringIO()
+        >>> writer = EncryptingWriter(out, "key")
+        >>> writer.write("sec")
+        >>> writer.write("ret")
+        >>> writer.close()
+        >>> out.getvalue() == encrypt("secret", "key")
+        True
+        """
+        self.fileobj = fileobj
+        self.stream = key_stream(key)
+        self._pending = []
+        self._size = 0
+        self._offset = 0
+
+    def _encrypt(self, data):
+        data = self.stream.xor(data, self._offset)
+        self._offset += len(data)
+        return base64.encodestring(data)
+
+    def write(self, data):
+        self._pending.append(data)
+        self._size += len(data)
+        if self._size <= CHUNK:
+            return
+        data = "".join(self._pending)
+        # Always keep something back, the last line must not end with
+        # a newline
+        end = (len(data) - 1) // CHUNK * CHUNK
+        self.fileobj.write(self._encrypt(data[:end]))
+        self._pending = [data[end:]]
+        self._size = len(data) - end
+
+    def close(self):
+        self.fileobj.write(self._encrypt("".join(self._pending)).rstrip("\n"))
+        self._pending = []
+        self._size = 0
+
+
+class DecryptingReader(object):
+    def __init__(self, fileobj, key):
+        """A file-like object supporting read and readline which
+        decrypts fileobj (as written by encrypt or EncryptingWriter)
+        as it is read, a chunk at a time.
+
+        >>> from cStringIO import StringIO
+        >>> reader = DecryptingReader(StringIO(encrypt("a\\nb", "key")), "key")
+        >>> reader.readline(), reader.read()
+        ('a\\n', 'b')
+        """
+        self.fileobj = fileobj
+        self.stream = key_stream(key)
+        self._buffer = ""
+        self._offset = 0
+        self._eof = False
+
+    def _fill(self):
+        """Decrypt the next chunk, returns False at the end of the
+        file."""
+        if self._eof:
+            return False
+        encoded = "".join(self.fileobj.readlines(CHUNK))
+        if not encoded:
+            self._eof = True
+            return False
+        data = self.stream.xor(base64.decodestring(encoded), self._offset)
+        self._offset += len(data)
+        self._buffer += data
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while "\n" not in self._buffer and self._fill():
+            pass
+        end = self._buffer.find("\n") + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
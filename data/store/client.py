@@ -1,48 +1,439 @@
+import json
+import uuid
+from itertools import islice
+from collections import OrderedDict
+from threading import Lock, Thread, Event, BoundedSemaphore
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from store import Store
+from query import is_operator
+
+NDJSON = "application/x-ndjson"
+
+# Marks the end of the records queued by AsyncClient.iter_records
+_END = object()
+
+
+def _encode_desc(desc):
+    """Returns desc with any operator dicts JSON encoded so they
+    can be sent in a query string."""
+    return dict(
+        (key, json.dumps(value) if is_operator(value) else value)
+        for key, value in desc.items())
+
+
+def _encode_fields(fields):
+    """Returns fields (a list of names to include or a dict of names
+    to 1 or 0) as the value of the '$fields' query parameter."""
+    if isinstance(fields, dict):
+        return ",".join(
+            name if flag else "-{}".format(name)
+            for name, flag in fields.items())
+    return ",".join(fields)
 
 
 class Client(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, pool_size=10, retries=3, timeout=30.0,
+                 buffer_size=None, flush_interval=None,
+                 etag_cache_size=128):
+        """A client for the data.store REST api. Requests go through a
+        requests.Session, so connections to the server are kept alive
+        and reused, up to pool_size of them at once. Failed connections
+        (and idempotent requests answered with 502, 503 or 504) are
+        retried up to retries times with a short backoff, and every
+        request times out after timeout seconds.
+
+        If buffer_size is given, add_record only queues the record
+        (giving it an '_id' if it has none) and the queued records are
+        sent through bulk_write once buffer_size of them are waiting,
+        every flush_interval seconds if given, on flush() and when the
+        Client is closed (or its with block exits). The statuses of the
+        inserts those automatic flushes could not apply are kept until
+        failures() is called. A periodic flush which could not be sent
+        is retried at the next interval, its error is kept in
+        flush_error until a flush succeeds.
+
+        The responses of get_collection and get_records are remembered
+        along with their ETag, for the last etag_cache_size distinct
+        requests (0 to remember none). Repeating a request asks the
+        server to only send the response if it changed, otherwise the
+        remembered one is used.
+        """
         self.base_url = "http://{}:{}/collections".format(host, port)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries, backoff_factor=0.1,
+                status_forcelist=(502, 503, 504)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_lock = Lock()
+        self._closed = Event()
+        self._flusher = None
+        self._failed = []
+        self.flush_error = None
+        self.etag_cache_size = etag_cache_size
+        self._etags = OrderedDict()
+        self._etags_lock = Lock()
+        if buffer_size and flush_interval:
+            self._flusher = Thread(
+                target=self._flush_periodically, args=(flush_interval,))
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Send any buffered records and close the connections. The
+        inserts of this last flush which failed are kept, see
+        failures()."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self._keep_failed(self._flush())
+        self.session.close()
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def _get(self, url, params=None):
+        """GETs url and returns the decoded JSON response. The ETag of
+        the last response to the same request is sent along, if the
+        server answers 304 Not Modified that response is decoded
+        again instead."""
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._etags_lock:
+            cached = self._etags.pop(key, None)
+            if cached is not None:
+                self._etags[key] = cached
+        headers = {} if cached is None else {"If-None-Match": cached[0]}
+        response = self._request("GET", url, params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return json.loads(cached[1])
+        etag = response.headers.get("ETag")
+        if self.etag_cache_size and response.status_code == 200 and etag:
+            with self._etags_lock:
+                self._etags[key] = (etag, response.content)
+                while len(self._etags) > self.etag_cache_size:
+                    self._etags.popitem(last=False)
+        return response.json()
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self._keep_failed(self._flush())
+            except requests.RequestException as error:
+                # The records were queued again, the next flush retries
+                self.flush_error = error
+            else:
+                self.flush_error = None
+
+    def _keep_failed(self, results):
+        failed = [result for result in results if not result[2]["ok"]]
+        if failed:
+            with self._buffer_lock:
+                self._failed.extend(failed)
+
+    def failures(self):
+        """Returns (and forgets) a list of (collection, record, status)
+        tuples of the inserts sent by automatic flushes which failed,
+        see Client. Failures of explicit flush() calls are not kept,
+        flush returns their statuses."""
+        with self._buffer_lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+    def flush(self):
+        """Send the buffered records, returns the statuses of their
+        inserts (see bulk_write). If sending fails the records which
+        may not have been sent are queued again, since they all have
+        an '_id' sending one twice only fails the second insert."""
+        return [status for collection, record, status in self._flush()]
+
+    def _flush(self):
+        """Does the work of flush, returns a (collection, record,
+        status) tuple per record sent."""
+        with self._buffer_lock:
+            buffered, self._buffer = self._buffer, []
+        results = []
+        collections = []
+        for collection, record in buffered:
+            if collection not in collections:
+                collections.append(collection)
+        for position, collection in enumerate(collections):
+            records = [
+                record for name, record in buffered if name == collection]
+            try:
+                statuses = self.bulk_write(collection, (
+                    {"op": "insert", "record": record} for record in records))
+            except requests.RequestException:
+                unsent = set(collections[position:])
+                with self._buffer_lock:
+                    self._buffer[:0] = [
+                        (name, record) for name, record in buffered
+                        if name in unsent]
+                raise
+            results.extend(
+                (collection, record, status)
+                for record, status in zip(records, statuses))
+        return results
 
     def get_collections(self):
         """Returns all collections as a dict of name to collection
         mappings"""
-        return requests.get(self.base_url).json()
+        return self._request("GET", self.base_url).json()
 
     def get_collection(self, name):
         """returns collection of name"""
         url = "{}/{}".format(self.base_url, name)
-        return requests.get(url).json()
+        return self._get(url)
 
     def create_collection(self, name):
         """Create a collection with name name"""
         url = "{}/{}".format(self.base_url, name)
-        return requests.post(url).json()
+        return self._request("POST", url).json()
 
     def del_collection(self, name):
         """Removes collection"""
         url = "{}/{}".format(self.base_url, name)
-        return requests.delete(url).json()
+        return self._request("DELETE", url).json()
 
     def add_record(self, collection, record):
-        """Adds a record (dict) to collection"""
+        """Adds a record (dict) to collection. If the Client buffers
+        writes the record is only queued, see Client"""
+        if self.buffer_size:
+            if "_id" not in record:
+                record["_id"] = uuid.uuid4().hex
+            with self._buffer_lock:
+                self._buffer.append((collection, record))
+                full = len(self._buffer) >= self.buffer_size
+            if full:
+                self._keep_failed(self._flush())
+            return record
         url = "{}/{}/records".format(self.base_url, collection)
-        return requests.post(url, json=record).json()
+        return self._request("POST", url, json=record).json()
 
-    def get_records(self, collection, desc):
+    def get_records(self, collection, desc, fields=None):
         """Returns a data.store.Store creted from records from collection
-        matching desc"""
+        matching desc. If fields is given only those fields are sent
+        back, see data.store.Store.find_one"""
         url = "{}/{}/records".format(self.base_url, collection)
-        return Store(requests.get(url, params=desc).json())
+        params = _encode_desc(desc)
+        if fields is not None:
+            params["$fields"] = _encode_fields(fields)
+        return Store(self._get(url, params))
+
+    def aggregate(self, collection, pipeline):
+        """Returns the list of results of running pipeline over
+        collection on the server, see data.store.Store.aggregate"""
+        url = "{}/{}/aggregate".format(self.base_url, collection)
+        return self._request("POST", url, json=pipeline).json()
+
+    def _iter(self, url, params=None):
+        """Yields the records of a streamed response from url one at a
+        time, as they arrive."""
+        response = self._request(
+            "GET", url, params=params, headers={"Accept": NDJSON},
+            stream=True)
+        response.raise_for_status()
+        try:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+    def iter_collection(self, name):
+        """Yields the records of collection name one at a time, without
+        waiting for the whole collection to arrive."""
+        return self._iter("{}/{}".format(self.base_url, name))
+
+    def iter_records(self, collection, desc, fields=None):
+        """Yields the records from collection matching desc one at a
+        time, without waiting for all of them to arrive. See
+        get_records"""
+        url = "{}/{}/records".format(self.base_url, collection)
+        params = _encode_desc(desc)
+        if fields is not None:
+            params["$fields"] = _encode_fields(fields)
+        return self._iter(url, params)
 
     def del_record(self, collection, desc):
         """remove record from collection matching desc."""
         url = "{}/{}/records".format(self.base_url, collection)
-        requests.delete(url, params=desc).json()
+        self._request("DELETE", url, params=_encode_desc(desc)).json()
+
+    def bulk_write(self, collection, operations, batch_size=10000):
+        """Applies operations (an iterable of inserts, updates and
+        deletes, see data.store.Store.bulk_write) to collection, sending
+        them batch_size at a time as NDJSON. Returns the list of the
+        statuses of the operations."""
+        url = "{}/{}/records:bulk".format(self.base_url, collection)
+        headers = {"Content-Type": NDJSON}
+        operations = iter(operations)
+        statuses = []
+        while True:
+            batch = [json.dumps(operation)
+                     for operation in islice(operations, batch_size)]
+            if not batch:
+                return statuses
+            response = self._request(
+                "POST", url, data="\n".join(batch), headers=headers)
+            response.raise_for_status()
+            statuses.extend(response.json())
 
     def update_record(self, collection, _id, updates):
         """"""
         url = "{}/{}/records/{}".format(self.base_url, collection, _id)
-        return requests.put(url, json=updates).json()
+        return self._request("PUT", url, json=updates).json()
+
+
+class AsyncClient(object):
+    def __init__(self, host, port, concurrency=32, max_pending=None,
+                 **options):
+        """A Client whose calls return at once with a
+        multiprocessing.pool.AsyncResult (call .get() for the result,
+        which raises the call's exception if it failed) instead of
+        blocking until the server answers.
+
+        Up to concurrency requests run at once, each in a thread of a
+        pool sharing a single pooled Client (options are passed on to
+        it, see Client), so connections are reused across calls. At
+        most max_pending calls (by default four times concurrency) may
+        be waiting, beyond that a call blocks until an earlier one
+        finishes so a fast producer can't queue unbounded work.
+
+        Every method also accepts a callback, called with the result
+        from the pool thread once the call succeeds.
+        """
+        self.client = Client(host, port, pool_size=concurrency, **options)
+        self._pool = ThreadPool(concurrency)
+        self._pending = BoundedSemaphore(max_pending or concurrency * 4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Wait for the outstanding calls to finish and close the
+        connections."""
+        self._pool.close()
+        self._pool.join()
+        self.client.close()
+
+    def _submit(self, function, args, kwargs):
+        callback = kwargs.pop("callback", None)
+        self._pending.acquire()
+
+        def call():
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._pending.release()
+        return self._pool.apply_async(call, callback=callback)
+
+    def get_collections(self, **kwargs):
+        """See Client.get_collections"""
+        return self._submit(self.client.get_collections, (), kwargs)
+
+    def get_collection(self, name, **kwargs):
+        """See Client.get_collection"""
+        return self._submit(self.client.get_collection, (name,), kwargs)
+
+    def create_collection(self, name, **kwargs):
+        """See Client.create_collection"""
+        return self._submit(self.client.create_collection, (name,), kwargs)
+
+    def del_collection(self, name, **kwargs):
+        """See Client.del_collection"""
+        return self._submit(self.client.del_collection, (name,), kwargs)
+
+    def add_record(self, collection, record, **kwargs):
+        """See Client.add_record"""
+        return self._submit(
+            self.client.add_record, (collection, record), kwargs)
+
+    def get_records(self, collection, desc, **kwargs):
+        """See Client.get_records"""
+        return self._submit(
+            self.client.get_records, (collection, desc), kwargs)
+
+    def aggregate(self, collection, pipeline, **kwargs):
+        """See Client.aggregate"""
+        return self._submit(
+            self.client.aggregate, (collection, pipeline), kwargs)
+
+    def del_record(self, collection, desc, **kwargs):
+        """See Client.del_record"""
+        return self._submit(
+            self.client.del_record, (collection, desc), kwargs)
+
+    def bulk_write(self, collection, operations, **kwargs):
+        """See Client.bulk_write"""
+        return self._submit(
+            self.client.bulk_write, (collection, list(operations)), kwargs)
+
+    def update_record(self, collection, _id, updates, **kwargs):
+        """See Client.update_record"""
+        return self._submit(
+            self.client.update_record, (collection, _id, updates), kwargs)
+
+    def iter_records(self, collection, desc, fields=None, buffer=1000):
+        """Returns an iterator over the records from collection matching
+        desc. They are read from the streamed response by a pool thread
+        into a queue of up to buffer records, so the server keeps
+        sending while the caller works through them. Nothing is read
+        before the first record is asked for, and abandoning the
+        iterator stops the reading."""
+        records = Queue(buffer)
+        stop = Event()
+
+        def put(item):
+            """Queue item unless the iterator was abandoned."""
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for record in self.client.iter_records(
+                        collection, desc, fields=fields):
+                    if not put((True, record)):
+                        return
+                put((True, _END))
+            except Exception as error:
+                put((False, error))
+
+        def consume():
+            # Submitted from here, a generator which is never started
+            # never runs its finally to stop the reading
+            self._submit(read, (), {})
+            try:
+                while True:
+                    ok, record = records.get()
+                    if not ok:
+                        raise record
+                    if record is _END:
+                        return
+                    yield record
+            finally:
+                stop.set()
+        return consume()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""The formats Store.persist can write and data.store.load can read.
+
+A file persisted with a codec starts with a small header:
+
+    MAGIC | JSON header | newline | body
+
+The JSON header names the codec, whether the body is encrypted and
+the state of the Store besides its records (the declarations of its
+indexes and of its result cache). The body is the list of records
+encoded by the codec, encrypted if persist was given a password.
+load reads the header to pick the codec. Files without a header are
+pickled Stores, which persist writes when it isn't given a codec (as
+every earlier version did).
+
+* "pickle" - cPickle with the highest protocol. Any picklable value
+  round trips, but loading a pickle can run arbitrary code so never
+  load one from an untrusted source.
+* "marshal" - the fastest, but only for records made of built-in
+  values (str, unicode, int, float, bool, None, lists, tuples, dicts
+  and sets) and only readable by the same version of Python.
+* "jsonl" - one JSON record per line, safe to load and readable by
+  anything. Strings come back as unicode and tuples as lists.
+* "msgpack" - compact and safe to load, needs the msgpack package.
+  Strings and unicode round trip, tuples come back as lists.
+"""
+import json
+import marshal
+import cPickle
+from itertools import islice
+from cipher import EncryptingWriter, DecryptingReader
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = "DSCODEC1"
+
+# The number of records encoded per write by the line based codecs
+BATCH = 1000
+
+
+def _dump_pickle(records, fout):
+    cPickle.dump(records, fout, cPickle.HIGHEST_PROTOCOL)
+
+
+def _load_pickle(fin):
+    return cPickle.load(fin)
+
+
+def _dump_marshal(records, fout):
+    fout.write(marshal.dumps(records, 2))
+
+
+def _load_marshal(fin):
+    return marshal.loads(fin.read())
+
+
+def _dump_jsonl(records, fout):
+    records = iter(records)
+    while True:
+        batch = [json.dumps(record) for record in islice(records, BATCH)]
+        if not batch:
+            return
+        fout.write("\n".join(batch) + "\n")
+
+
+def _load_jsonl(fin):
+    return [json.loads(line) for line in iter(fin.readline, "")
+            if line.strip()]
+
+
+def _dump_msgpack(records, fout):
+    packer = msgpack.Packer(use_bin_type=True)
+    records = iter(records)
+    while True:
+        batch = [packer.pack(record) for record in islice(records, BATCH)]
+        if not batch:
+            return
+        fout.write("".join(batch))
+
+
+def _load_msgpack(fin):
+    return list(msgpack.Unpacker(fin, raw=False))
+
+
+CODECS = {
+    "pickle": (_dump_pickle, _load_pickle),
+    "marshal": (_dump_marshal, _load_marshal),
+    "jsonl": (_dump_jsonl, _load_jsonl),
+    "msgpack": (_dump_msgpack, _load_msgpack),
+}
+
+
+def available():
+    """Returns the names of the codecs which can be used here.
+
+    >>> sorted(set(available()) - set(["msgpack"]))
+    ['jsonl', 'marshal', 'pickle']
+    """
+    return [name for name in sorted(CODECS)
+            if name != "msgpack" or msgpack is not None]
+
+
+def _codec(name):
+    """Returns the (encode, decode) functions of codec name."""
+    if name not in CODECS:
+        raise ValueError("Unknown codec {}, use one of {}".format(
+            name, ", ".join(sorted(CODECS))))
+    if name == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack codec needs the msgpack package")
+    return CODECS[name]
+
+
+def dump(fout, records, state, codec, password=None):
+    """Write the header and records (a list of dicts) to fout with
+    codec, encrypted with password if given. state is a JSON
+    serializable dict of the rest of the Store, see Store._state.
+
+    >>> from cStringIO import StringIO
+    >>> out = StringIO()
+    >>> dump(out, [{'_id': 'a'}], {}, 'jsonl')
+    >>> print out.getvalue(),
+    DSCODEC1{"codec": "jsonl", "encrypted": false, "state": {}}
+    {"_id": "a"}
+    """
+    encode = _codec(codec)[0]
+    header = {"codec": codec, "encrypted": bool(password), "state": state}
+    fout.write(MAGIC + json.dumps(header, sort_keys=True) + "\n")
+    if password:
+        writer = EncryptingWriter(fout, password)
+        encode(records, writer)
+        writer.close()
+    else:
+        encode(records, fout)
+
+
+def read_header(fin):
+    """Returns the header of fin (a dict of its "codec", whether it is
+    "encrypted" and the "state" of the Store), leaving fin at the
+    start of the records. If fin has no header None is returned and
+    fin is left where it was (ie at its start)."""
+    position = fin.tell()
+    if fin.read(len(MAGIC)) != MAGIC:
+        fin.seek(position)
+        return None
+    return json.loads(fin.readline())
+
+
+def load(fin, header, password=None):
+    """Returns the list of records in the body of fin, positioned by
+    read_header which returned header."""
+    decode = _codec(header["codec"])[1]
+    if header["encrypted"]:
+        if not password:
+            raise ValueError("The records are encrypted, a password is "
+                             "needed to load them")
+        return decode(DecryptingReader(fin, password))
+    return decode(fin)
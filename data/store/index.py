@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Indexes which a Store keeps in sync with its records.
+
+Indexes only ever hold '_id's, the Store maps those back to records.
+Lookups return candidate '_id's, every candidate is still tested
+against the full desc so an index only has to return a superset of
+the matching records.
+"""
+from bisect import bisect_left, bisect_right
+
+# Sorts after any position, see SortedIndex.bounds
+_LAST = float("inf")
+
+
+class HashIndex(object):
+    def __init__(self, field, unique=False):
+        """A hash index mapping each value of field to the set of
+        '_id's of the records holding that value. Records missing
+        field are indexed under None (which is what find compares
+        against for missing fields). Records whose value can't be
+        hashed are kept aside and returned with every lookup.
+
+        If unique is True, no two records may share a value for field
+        (records without the field or with a value of None are
+        exempt).
+
+        >>> index = HashIndex("this")
+        >>> index.add({"_id": 1, "this": "that"})
+        >>> index.add({"_id": 2, "this": "that"})
+        >>> sorted(index.lookup("that"))
+        [1, 2]
+        """
+        self.field = field
+        self.unique = unique
+        self.values = {}
+        self.unhashable = set()
+
+    def check(self, record, ignore=None):
+        """Raise a ValueError if adding record would violate the
+        unique constraint of this index. ignore is an '_id' which
+        should not count as a conflict (ie the record being updated).
+        """
+        if not self.unique:
+            return
+        value = record.get(self.field, None)
+        if value is None:
+            return
+        try:
+            ids = self.values.get(value, ())
+        except TypeError:
+            return
+        if ids and (len(ids) > 1 or ignore not in ids):
+            raise ValueError(
+                "A record with {} {} already exists!".format(
+                    self.field, value))
+
+    def check_many(self, records):
+        """Raise a ValueError if adding all of records would violate
+        the unique constraint of this index."""
+        if not self.unique:
+            return
+        seen = set()
+        for record in records:
+            self.check(record)
+            value = record.get(self.field, None)
+            if value is None:
+                continue
+            try:
+                if value in seen:
+                    raise ValueError(
+                        "A record with {} {} already exists!".format(
+                            self.field, value))
+                seen.add(value)
+            except TypeError:
+                pass
+
+    def add_many(self, records):
+        """Add every record in records to this index."""
+        for record in records:
+            HashIndex.add(self, record)
+
+    def discard_many(self, records):
+        """Remove every record in records from this index."""
+        for record in records:
+            HashIndex.discard(self, record)
+
+    def add(self, record):
+        """Add record to this index."""
+        value = record.get(self.field, None)
+        try:
+            ids = self.values.setdefault(value, set())
+        except TypeError:
+            self.unhashable.add(record["_id"])
+        else:
+            ids.add(record["_id"])
+
+    def discard(self, record):
+        """Remove record from this index, if present."""
+        value = record.get(self.field, None)
+        try:
+            ids = self.values.get(value)
+        except TypeError:
+            self.unhashable.discard(record["_id"])
+            return
+        if ids is not None:
+            ids.discard(record["_id"])
+            if not ids:
+                del self.values[value]
+
+    def lookup(self, value):
+        """Returns a set of '_id's of records which may have value
+        for field, or None if value can't be looked up."""
+        try:
+            ids = self.values.get(value, set())
+        except TypeError:
+            return None
+        if self.unhashable:
+            return ids | self.unhashable
+        return ids
+
+    def select(self, operators):
+        """Returns the '_id's of records which may satisfy operators,
+        or None if this index can't narrow them down. A HashIndex can
+        only answer '$in'."""
+        if "$in" not in operators:
+            return None
+        ids = set()
+        for value in operators["$in"]:
+            found = self.lookup(value)
+            if found is None:
+                return None
+            ids |= found
+        return ids
+
+
+class SortedIndex(HashIndex):
+    def __init__(self, field, positions, unique=False):
+        """A HashIndex which additionally keeps the records holding
+        field sorted by their value using bisect. This lets range
+        operators ('$gt', '$gte', '$lt', '$lte') and order_by be
+        answered without scanning or sorting the whole Store.
+
+        positions is the mapping of '_id' to position kept by the
+        Store. It is used to break ties between equal values so that
+        records with equal values stay in Store order (just as they
+        would with a stable sort). Records missing field are left out
+        of the sorted entries.
+
+        >>> index = SortedIndex("age", {1: 0, 2: 1, 3: 2})
+        >>> index.add({"_id": 1, "age": 30})
+        >>> index.add({"_id": 2, "age": 20})
+        >>> index.add({"_id": 3, "age": 40})
+        >>> index.select({"$gte": 25})
+        [1, 3]
+        """
+        super(SortedIndex, self).__init__(field, unique=unique)
+        self.positions = positions
+        self.keys = []
+        self.ids = []
+
+    def add(self, record):
+        super(SortedIndex, self).add(record)
+        if self.field in record:
+            key = (record[self.field], self.positions[record["_id"]])
+            position = bisect_right(self.keys, key)
+            self.keys.insert(position, key)
+            self.ids.insert(position, record["_id"])
+
+    def add_many(self, records):
+        """Add every record in records to this index, sorting the
+        entries once rather than inserting them one at a time."""
+        super(SortedIndex, self).add_many(records)
+        field, positions = self.field, self.positions
+        entries = sorted(
+            ((record[field], positions[record["_id"]]), record["_id"])
+            for record in records if field in record)
+        if not entries:
+            return
+        if self.keys and entries[0][0] < self.keys[-1]:
+            entries = sorted(zip(self.keys, self.ids) + entries)
+            del self.keys[:], self.ids[:]
+        self.keys.extend(key for key, _id in entries)
+        self.ids.extend(_id for key, _id in entries)
+
+    def discard(self, record):
+        super(SortedIndex, self).discard(record)
+        if self.field in record:
+            key = (record[self.field], self.positions[record["_id"]])
+            position = bisect_left(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                del self.keys[position]
+                del self.ids[position]
+
+    def discard_many(self, records):
+        """Remove every record in records from this index in a single
+        pass over the sorted entries."""
+        super(SortedIndex, self).discard_many(records)
+        doomed = set(record["_id"] for record in records)
+        entries = [
+            (key, _id) for key, _id in zip(self.keys, self.ids)
+            if _id not in doomed]
+        self.keys[:] = [key for key, _id in entries]
+        self.ids[:] = [_id for key, _id in entries]
+
+    def bounds(self, operators):
+        """Returns the slice (lo, hi) of the sorted entries which
+        satisfy the range operators in operators."""
+        lo, hi = 0, len(self.keys)
+        if "$gt" in operators:
+            lo = max(lo, bisect_right(self.keys, (operators["$gt"], _LAST)))
+        if "$gte" in operators:
+            lo = max(lo, bisect_left(self.keys, (operators["$gte"],)))
+        if "$lt" in operators:
+            hi = min(hi, bisect_left(self.keys, (operators["$lt"],)))
+        if "$lte" in operators:
+            hi = min(hi, bisect_right(self.keys, (operators["$lte"], _LAST)))
+        return lo, max(lo, hi)
+
+    def select(self, operators):
+        """Returns the '_id's of the records which may satisfy
+        operators, in value order when range operators are given."""
+        for name in operators:
+            if name in ("$gt", "$gte", "$lt", "$lte"):
+                lo, hi = self.bounds(operators)
+                return self.ids[lo:hi]
+        return super(SortedIndex, self).select(operators)
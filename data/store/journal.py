@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Append-only journaling of the changes made to a Store.
+
+A journaled Store is kept on disk as a snapshot (filename) and a
+write-ahead log (filename + ".wal"). The snapshot is a pickled Store
+followed by the log sequence number (lsn) of the last change it
+contains, so data.store.load can read it like any other persisted
+Store. Every change made to the Store afterwards is appended to the
+log as a frame:
+
+    4 byte length | 4 byte crc32 | pickle of (lsn, operation, args)
+
+data.store.load replays the frames with an lsn greater than the one
+of the snapshot and stops at the first torn or corrupt frame.
+
+When the log grows past compact_size bytes it is compacted in the
+background: a fresh snapshot is written next to the old one, renamed
+over it and the log is truncated.
+"""
+import os
+import struct
+import zlib
+import cPickle
+from threading import RLock, Thread, Event
+
+HEADER = struct.Struct(">Ii")
+
+SYNC_POLICIES = ("always", "group", "never")
+
+
+def wal_filename(filename):
+    return filename + ".wal"
+
+
+def write_snapshot(store, filename, lsn):
+    """Atomically replace filename with a snapshot of store which
+    contains every change up to lsn."""
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as fout:
+        cPickle.dump(store, fout, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(lsn, fout, cPickle.HIGHEST_PROTOCOL)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(tmp, filename)
+
+
+def read_frames(filename):
+    """Yields the (lsn, operation, args) tuples logged to filename,
+    stopping at the first torn or corrupt frame."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "rb") as fin:
+        while True:
+            header = fin.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            payload = fin.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield cPickle.loads(payload)
+
+
+def apply(store, operation, args):
+    """Apply one logged change to store."""
+    if operation == "add":
+        store.add_records(args[0])
+    elif operation == "delete":
+        records = [store._ids[_id] for _id in args[0] if _id in store._ids]
+        store._remove_many(records)
+    elif operation == "update":
+        store.update_record({"_id": args[0]}, args[1])
+    elif operation == "create_index":
+        store.create_index(args[0], unique=args[1], ordered=args[2])
+    elif operation == "drop_index":
+        store.drop_index(args[0])
+    else:
+        raise ValueError("Unknown journal operation {}".format(operation))
+
+
+def replay(store, filename, lsn=0):
+    """Apply every change logged for filename after lsn to store and
+    return the lsn of the last change applied."""
+    for entry_lsn, operation, args in read_frames(wal_filename(filename)):
+        if entry_lsn > lsn:
+            apply(store, operation, args)
+            lsn = entry_lsn
+    return lsn
+
+
+def last_lsn(filename):
+    """Returns the lsn of the last change stored on disk for filename,
+    either in its snapshot or in its log."""
+    lsn = 0
+    if os.path.exists(filename):
+        with open(filename, "rb") as fin:
+            try:
+                cPickle.load(fin)
+                lsn = cPickle.load(fin)
+            except (EOFError, cPickle.UnpicklingError):
+                pass
+    for entry_lsn, operation, args in read_frames(wal_filename(filename)):
+        lsn = max(lsn, entry_lsn)
+    return lsn
+
+
+class Journal(object):
+    def __init__(self, store, filename, sync="always", interval=1.0,
+                 compact_size=64 * 1024 * 1024):
+        """Journal the changes made to store to filename. This writes a
+        fresh snapshot of store and starts an empty log, see
+        Store.journal.
+
+        sync decides when the log is forced to disk:
+
+        * "always" - every change is written and fsynced before the
+          method making it returns.
+        * "group" - changes are buffered and a background thread
+          writes and fsyncs them together every interval seconds. If
+          writing fails the changes stay buffered and are retried at
+          the next interval, the error is kept in error until a write
+          succeeds.
+        * "never" - every change is written, but fsyncing is left to
+          the operating system.
+        """
+        if sync not in SYNC_POLICIES:
+            raise ValueError(
+                "sync must be one of {}".format(", ".join(SYNC_POLICIES)))
+        self.store = store
+        self.filename = filename
+        self.sync = sync
+        self.interval = interval
+        self.compact_size = compact_size
+        self._lock = RLock()
+        self._buffer = []
+        self._compacting = False
+        self._closed = Event()
+        self.error = None
+        self.lsn = last_lsn(filename)
+        write_snapshot(store, filename, self.lsn)
+        self._file = open(wal_filename(filename), "wb")
+        self._size = 0
+        if sync == "group":
+            self._flusher = Thread(target=self._flush_periodically)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def append(self, operation, *args):
+        """Log one change. This is called by the Store while it holds
+        its own lock so changes are logged in the order they are
+        made."""
+        with self._lock:
+            self.lsn += 1
+            payload = cPickle.dumps(
+                (self.lsn, operation, args), cPickle.HIGHEST_PROTOCOL)
+            frame = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+            self._size += len(frame)
+            if self.sync == "group":
+                self._buffer.append(frame)
+            else:
+                self._file.write(frame)
+                self._file.flush()
+                if self.sync == "always":
+                    os.fsync(self._file.fileno())
+            if self._size > self.compact_size and not self._compacting:
+                self._compacting = True
+                compactor = Thread(target=self.compact)
+                compactor.daemon = True
+                compactor.start()
+
+    def flush(self):
+        """Write and fsync any buffered changes. If writing fails the
+        changes stay buffered and the log is cut back to its last
+        complete frame, so flushing again doesn't leave a torn frame
+        in front of them."""
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._buffer:
+                position = self._file.tell()
+                try:
+                    self._file.write("".join(self._buffer))
+                    self._file.flush()
+                except (IOError, OSError):
+                    self._file.seek(position)
+                    self._file.truncate()
+                    raise
+                del self._buffer[:]
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.flush()
+            except (IOError, OSError) as error:
+                self.error = error
+            else:
+                self.error = None
+
+    def compact(self):
+        """Replace the snapshot with one holding every change logged so
+        far and truncate the log. Changes to the Store are blocked
+        while the snapshot is written, reads are not."""
+        with self.store._lock.read():
+            with self._lock:
+                try:
+                    if self._file.closed:
+                        return
+                    self.flush()
+                    write_snapshot(self.store, self.filename, self.lsn)
+                    self._file.close()
+                    self._file = open(wal_filename(self.filename), "wb")
+                    self._size = 0
+                finally:
+                    self._compacting = False
+
+    def close(self):
+        """Flush any buffered changes and stop journaling."""
+        self._closed.set()
+        with self._lock:
+            if not self._file.closed:
+                self.flush()
+                self._file.close()
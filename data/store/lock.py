@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""The reader-writer lock which guards every Store."""
+from threading import Condition, Lock
+from thread import get_ident
+
+
+class _Holding(object):
+    """A context manager calling acquire on enter and release on
+    exit."""
+    __slots__ = ("acquire", "release")
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RWLock(object):
+    def __init__(self):
+        """A reader-writer lock: any number of threads may hold it for
+        reading at once, but a thread holding it for writing holds it
+        alone. Waiting writers go first, so a steady stream of readers
+        can't starve them.
+
+        Both sides are reentrant and the writer may also take the read
+        side (ie a write can call a read method). A reader can't
+        upgrade to writing, that raises a RuntimeError rather than
+        deadlocking.
+
+        >>> lock = RWLock()
+        >>> with lock.write():
+        ...     with lock.read():
+        ...         pass
+        """
+        self._condition = Condition(Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+        self._read = _Holding(self.acquire_read, self.release_read)
+        self._write = _Holding(self.acquire_write, self.release_write)
+
+    def read(self):
+        """Returns a context manager holding the lock for reading."""
+        return self._read
+
+    def write(self):
+        """Returns a context manager holding the lock for writing."""
+        return self._write
+
+    def acquire_read(self):
+        me = get_ident()
+        with self._condition:
+            if me in self._readers or self._writer == me:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting:
+                self._condition.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = get_ident()
+        with self._condition:
+            depth = self._readers[me] - 1
+            if depth:
+                self._readers[me] = depth
+                return
+            del self._readers[me]
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError(
+                    "Can't take a write lock while holding a read lock")
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._condition:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._condition.notify_all()
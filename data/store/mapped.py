@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""A record oriented file format which is opened with mmap.
+
+Unlike a pickled Store, which has to be unpickled completely before
+it can be used, a mapped file is opened instantly and a record is only
+decoded when a query touches it. Hash indexes are stored in the file
+so that queries testing indexed fields for equality only decode the
+matching records.
+
+The layout of a mapped file is:
+
+    magic | header | records | offset table | indexes | index directory
+
+* magic is MAGIC.
+* header holds the number of records and the positions of the offset
+  table and of the index directory.
+* records are the individually pickled records.
+* the offset table holds the start of every record, plus the end of
+  the last one, as big endian unsigned 64 bit integers.
+* indexes are individually pickled (values, unhashable) tuples, values
+  maps each value of the field to the positions of the records holding
+  it (None for records without the field) and unhashable lists the
+  positions of records whose value can't be hashed.
+* the index directory is a pickled dict mapping each indexed field to
+  the (start, end) of its index.
+"""
+import mmap
+import struct
+import cPickle
+from itertools import ifilter, islice, imap
+from store import Store
+from query import is_operator, compile_desc
+
+MAGIC = "DSMAP001"
+HEADER = struct.Struct(">QQQ")
+OFFSET = struct.Struct(">Q")
+
+
+def _build_index(store, field):
+    values = {}
+    unhashable = []
+    for position, record in enumerate(store):
+        value = record.get(field, None)
+        try:
+            values.setdefault(value, []).append(position)
+        except TypeError:
+            unhashable.append(position)
+    return values, unhashable
+
+
+def dump(store, filename, fields=None):
+    """Write store to filename in the mapped format. Hash indexes are
+    stored for '_id', for every field in fields and, if fields is
+    None, for every field store has an index on.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'test.map')
+    >>> dump(Store([{'this': 'that', '_id': 'test1'}]), filename)
+    >>> with MappedStore(filename) as mapped:
+    ...     mapped.find_one({'_id': 'test1'})
+    {'this': 'that', '_id': 'test1'}
+    """
+    if fields is None:
+        fields = store._indexes.keys()
+    fields = ["_id"] + [field for field in fields if field != "_id"]
+    with store._lock.read(), open(filename, "wb") as fout:
+        fout.write(MAGIC)
+        fout.write(HEADER.pack(0, 0, 0))
+        offsets = []
+        for record in store:
+            offsets.append(fout.tell())
+            fout.write(cPickle.dumps(dict(record), cPickle.HIGHEST_PROTOCOL))
+        offsets.append(fout.tell())
+        offset_table = fout.tell()
+        fout.write("".join(OFFSET.pack(offset) for offset in offsets))
+        directory = {}
+        for field in fields:
+            start = fout.tell()
+            cPickle.dump(
+                _build_index(store, field), fout, cPickle.HIGHEST_PROTOCOL)
+            directory[field] = (start, fout.tell())
+        directory_start = fout.tell()
+        cPickle.dump(directory, fout, cPickle.HIGHEST_PROTOCOL)
+        fout.seek(len(MAGIC))
+        fout.write(HEADER.pack(len(store), offset_table, directory_start))
+
+
+def is_mapped(filename):
+    """Returns True if filename was written by dump."""
+    with open(filename, "rb") as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+class MappedStore(object):
+    def __init__(self, filename):
+        """A read-only view of a file written by dump. The file is
+        mapped into memory and records are only decoded when they are
+        accessed, so opening it takes constant time whatever its size.
+
+        find, find_one and iter_find accept the same arguments as they
+        do on a Store. Testing an indexed field for equality (or with
+        '$in') only decodes the records holding those values, other
+        queries decode every record as they scan.
+        """
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("{} is not a mapped Store".format(filename))
+        self._count, self._offsets, directory = HEADER.unpack_from(
+            self._map, len(MAGIC))
+        self._directory = cPickle.loads(self._map[directory:])
+        self._indexes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError("record index out of range")
+        start, end = struct.unpack_from(
+            ">QQ", self._map, self._offsets + OFFSET.size * position)
+        return cPickle.loads(self._map[start:end])
+
+    def __iter__(self):
+        return imap(self.__getitem__, xrange(self._count))
+
+    def indexed_fields(self):
+        """Returns the fields which are indexed in the file."""
+        return self._directory.keys()
+
+    def _index(self, field):
+        """Returns the (values, unhashable) index stored for field,
+        decoding it on first use."""
+        if field not in self._indexes:
+            start, end = self._directory[field]
+            self._indexes[field] = cPickle.loads(self._map[start:end])
+        return self._indexes[field]
+
+    def _lookup(self, field, values):
+        """Returns the set of positions of records which may hold one
+        of values for field, or None if it can't be looked up."""
+        index, unhashable = self._index(field)
+        positions = set(unhashable)
+        for value in values:
+            try:
+                positions.update(index.get(value, ()))
+            except TypeError:
+                return None
+        return positions
+
+    def _candidates(self, desc):
+        """Returns an iterable of the records which could match desc,
+        using the smallest lookup in the stored indexes."""
+        best = None
+        for key, value in desc.items():
+            if key not in self._directory:
+                continue
+            if is_operator(value):
+                if "$in" not in value:
+                    continue
+                positions = self._lookup(key, value["$in"])
+            elif hasattr(value, "match") or callable(value):
+                continue
+            else:
+                positions = self._lookup(key, [value])
+            if positions is not None and (
+                    best is None or len(positions) < len(best)):
+                best = positions
+        if best is None:
+            return iter(self)
+        return imap(self.__getitem__, sorted(best))
+
+    def _iter_matches(self, desc):
+        return ifilter(compile_desc(desc), self._candidates(desc))
+
+    def iter_find(self, desc, limit=None, skip=0, **options):
+        """Returns an iterator over the (decoded) records matching
+        desc, see Store.iter_find."""
+        matches = self._iter_matches(desc)
+        if skip or limit is not None:
+            stop = None if limit is None else skip + limit
+            matches = islice(matches, skip, stop)
+        if options:
+            return Store(matches).iter_find({}, **options)
+        return matches
+
+    def find(self, desc, **options):
+        """Returns a Store of the records matching desc, see
+        Store.find."""
+        return Store(self._iter_matches(desc)).find({}, **options)
+
+    def find_one(self, desc, **options):
+        """Returns the first record matching desc, see
+        Store.find_one."""
+        for record in self._iter_matches(desc):
+            return Store([record]).find_one({}, **options)
+
+    def load(self):
+        """Returns a Store holding every record, with hash indexes on
+        the indexed fields."""
+        store = Store(self)
+        for field in self._directory:
+            if field != "_id":
+                store.create_index(field)
+        return store
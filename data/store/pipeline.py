@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Aggregation pipelines, see Store.aggregate.
+
+A pipeline is a list of stages, each a dict with a single key naming
+the stage:
+
+* {"$match": desc} - only pass on the records matching desc.
+* {"$project": fields} - pass on the projected records, fields is a
+  list of names or a dict of names to 1 or 0 (see compile_projection).
+* {"$group": {"by": by, "aggregates": aggregates}} - pass on one
+  record per group holding '_id' (the group's key), the fields in by
+  and the aggregates (see data.store.aggregate).
+* {"$sort": {"by": field, "reverse": False}} - pass on the records
+  sorted by field ("$sort": field is short for the same thing).
+* {"$skip": n} and {"$limit": n} - skip or stop after n records.
+
+Every stage consumes the iterator of the stage before it, so records
+flow through the pipeline one at a time and are only collected by
+$group and $sort. A leading $match is looked up in the Store's
+indexes, a $sort right after it is read from a sorted index when there
+is one, and a $sort followed by $skip and $limit only keeps the
+records it will pass on, on a bounded heap.
+"""
+from itertools import ifilter, islice, imap
+from operator import itemgetter
+from query import compile_desc, compile_projection
+from aggregate import Aggregation
+
+STAGES = ("$match", "$project", "$group", "$sort", "$skip", "$limit")
+
+
+def _stage(stage):
+    """Returns the (name, argument) of stage."""
+    if not isinstance(stage, dict) or len(stage) != 1:
+        raise ValueError(
+            "A stage must be a dict with a single key, not {}".format(stage))
+    name, argument = stage.items()[0]
+    if name not in STAGES:
+        raise ValueError("Unknown stage {}".format(name))
+    return name, argument
+
+
+def _sort_spec(argument):
+    """Returns the (by, reverse) of a $sort stage."""
+    if isinstance(argument, dict):
+        return argument["by"], bool(argument.get("reverse", False))
+    return argument, False
+
+
+def _slice(stages, position):
+    """Returns (skip, limit, position) for the $skip and $limit stages
+    starting at position, limit is None if there is none."""
+    skip, limit = 0, None
+    while position < len(stages):
+        name, argument = stages[position]
+        if name == "$skip" and limit is None:
+            skip += int(argument)
+        elif name == "$limit":
+            argument = int(argument)
+            limit = argument if limit is None else min(limit, argument)
+        else:
+            break
+        position += 1
+    return skip, limit, position
+
+
+def _group(records, argument):
+    by = argument["by"]
+    aggregation = Aggregation(argument.get("aggregates", {}))
+    # A list or tuple of fields is grouped under the tuple of their
+    # values, even if it only names one field (see group_key)
+    compound = isinstance(by, (list, tuple))
+    names = list(by) if compound else [by]
+    for value, state in aggregation.states(records, by).iteritems():
+        result = aggregation.result(state)
+        result.update(zip(names, value if compound else [value]))
+        result["_id"] = value
+        yield result
+
+
+def _sort(store, records, by, reverse, skip, limit):
+    if limit is not None:
+        return iter(store._top(records, by, skip + limit, reverse)[skip:])
+    records = sorted(records, key=itemgetter(by))
+    if reverse:
+        records.reverse()
+    return iter(records[skip:])
+
+
+def run(store, pipeline):
+    """Returns an iterator over the records coming out of the last
+    stage of pipeline run over store. Records which come straight from
+    store are copied so store can't be modified through them. Unless
+    they are looked up in an index the records are scanned lazily (see
+    Store._scan), so store may change while the results are read."""
+    stages = [_stage(stage) for stage in pipeline]
+    position = 0
+    desc = {}
+    if stages and stages[0][0] == "$match":
+        desc = stages[0][1]
+        position = 1
+    with store._lock.read():
+        candidates = store._candidates(desc)
+        if position < len(stages) and stages[position][0] == "$sort":
+            by, reverse = _sort_spec(stages[position][1])
+            ordered = store._ordered_candidates(desc, by, candidates)
+            if ordered is not None:
+                candidates = reversed(ordered) if reverse else ordered
+                position += 1
+    if candidates is store:
+        # The Store may change while the results are read
+        candidates = store._scan()
+    records = store._iter_matches(desc, candidates=candidates)
+    copied = False
+    while position < len(stages):
+        name, argument = stages[position]
+        position += 1
+        if name == "$match":
+            records = ifilter(compile_desc(argument), records)
+        elif name == "$project":
+            records = imap(compile_projection(argument), records)
+            copied = True
+        elif name == "$group":
+            records = _group(records, argument)
+            copied = True
+        elif name == "$sort":
+            by, reverse = _sort_spec(argument)
+            skip, limit, position = _slice(stages, position)
+            records = _sort(store, records, by, reverse, skip, limit)
+        else:
+            skip, limit, position = _slice(stages, position - 1)
+            stop = None if limit is None else skip + limit
+            records = islice(records, skip, stop)
+    if not copied:
+        records = imap(dict.copy, records)
+    return records
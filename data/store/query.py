@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Helpers for interpreting the values of a desc.
+
+Besides plain values, compiled regular expressions and callables, a
+desc may map a field to a dict of operators, in the style of MongoDB:
+
+    {"age": {"$gte": 18, "$lt": 65}, "status": {"$in": ["a", "b"]}}
+
+A record missing the field never matches an operator dict, a
+compiled regular expression or a callable. Plain values are compared
+against None for missing fields.
+
+compile_desc turns a desc into a single predicate. The code for the
+predicate is generated once per desc shape (the keys and the kind of
+matching done for each key) and cached, so only the values have to
+be bound for each query.
+"""
+from cipher import key_stream
+
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+
+def is_operator(value):
+    """Returns True if value is a dict of operators (ie all of its
+    keys start with '$').
+
+    >>> is_operator({"$gt": 1})
+    True
+    >>> is_operator({"this": "that"})
+    False
+    """
+    if not isinstance(value, dict) or not value:
+        return False
+    for key in value:
+        if not isinstance(key, basestring) or not key.startswith("$"):
+            return False
+    return True
+
+
+# The order in which the kinds of matching are tested, the most
+# selective (and cheapest) first
+_EQUAL, _IN, _RANGE, _REGEX, _CALLABLE = range(5)
+
+_EXPRESSIONS = {
+    _EQUAL: "get({key}) == {value}",
+    _REGEX: "({key} in item and {value}.match(item[{key}]))",
+    _CALLABLE: "({key} in item and {value}(item[{key}]))",
+}
+
+_OPERATOR_EXPRESSIONS = {
+    "$gt": "item[{key}] > {value}",
+    "$gte": "item[{key}] >= {value}",
+    "$lt": "item[{key}] < {value}",
+    "$lte": "item[{key}] <= {value}",
+    "$in": "_in(item[{key}], {value})",
+}
+
+MAX_PLANS = 256
+_PLANS = {}
+
+
+def _kind(value):
+    if hasattr(value, "match"):
+        return _REGEX
+    if is_operator(value):
+        for name in value:
+            if name not in _OPERATOR_EXPRESSIONS:
+                raise ValueError("Unknown operator {}".format(name))
+        if "$in" in value:
+            return (_IN, tuple(sorted(value)))
+        return (_RANGE, tuple(sorted(value)))
+    if callable(value):
+        return _CALLABLE
+    return _EQUAL
+
+
+def _selectivity(entry):
+    key, kind = entry
+    return (kind[0] if isinstance(kind, tuple) else kind), key
+
+
+def _in(value, values):
+    try:
+        return value in values
+    except TypeError:
+        # an unhashable value can't be in a frozenset
+        return False
+
+
+def _plan(shape):
+    """Returns a factory which, given the values of a desc of shape,
+    returns the predicate matching that desc. shape is a tuple of
+    (key, kind) pairs ordered by selectivity."""
+    names = []
+    tests = []
+    for index, (key, kind) in enumerate(shape):
+        names.append("k{}".format(index))
+        if isinstance(kind, tuple):
+            terms = ["k{} in item".format(index)]
+            for name in kind[1]:
+                names.append("v{}_{}".format(index, len(terms)))
+                terms.append(_OPERATOR_EXPRESSIONS[name].format(
+                    key="k{}".format(index), value=names[-1]))
+            tests.append("({})".format(" and ".join(terms)))
+        else:
+            names.append("v{}".format(index))
+            tests.append(_EXPRESSIONS[kind].format(
+                key="k{}".format(index), value=names[-1]))
+    source = (
+        "def factory({names}):\n"
+        "    def predicate(item):\n"
+        "        get = item.get\n"
+        "        return bool({tests})\n"
+        "    return predicate\n").format(
+            names=", ".join(names),
+            tests=" and ".join(tests) or "True")
+    namespace = {"_in": _in}
+    exec compile(source, "<desc {}>".format(shape), "exec") in namespace
+    return namespace["factory"]
+
+
+def _operand(name, value):
+    if name == "$in":
+        try:
+            return frozenset(value)
+        except TypeError:
+            return value
+    return value
+
+
+def compile_desc(desc):
+    """Returns a predicate which accepts a record and returns True if
+    it matches desc. The plan for a desc is cached by its shape so
+    compiling a desc with the same keys and kinds of values as a
+    previous one only binds the values.
+
+    >>> import re
+    >>> match = compile_desc({"name": re.compile("j"), "age": {"$gt": 20}})
+    >>> match({"name": "jane", "age": 22})
+    True
+    >>> match({"name": "jane"})
+    False
+    """
+    items = desc.items()
+    shape = tuple(sorted(
+        ((key, _kind(value)) for key, value in items), key=_selectivity))
+    try:
+        factory = _PLANS[shape]
+    except KeyError:
+        if len(_PLANS) >= MAX_PLANS:
+            _PLANS.clear()
+        factory = _PLANS[shape] = _plan(shape)
+    values = dict(items)
+    args = []
+    for key, kind in shape:
+        args.append(key)
+        value = values[key]
+        if isinstance(kind, tuple):
+            args.extend(_operand(name, value[name]) for name in kind[1])
+        else:
+            args.append(value)
+    return factory(*args)
+
+
+def compile_projection(fields):
+    """Returns a function which accepts a record and returns a new
+    dict holding only the projected fields of the record, or None if
+    fields is None.
+
+    fields may be an iterable of the names of the fields to include,
+    or a dict mapping field names to a true value (include) or a false
+    value (exclude), in which case it can't mix the two. '_id' is
+    always included since every record in a Store needs one.
+
+    >>> project = compile_projection(["name"])
+    >>> project({"_id": 1, "name": "jane", "age": 22})
+    {'_id': 1, 'name': 'jane'}
+    >>> project = compile_projection({"age": 0})
+    >>> project({"_id": 1, "name": "jane", "age": 22})
+    {'_id': 1, 'name': 'jane'}
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, dict):
+        flags = set(bool(flag) for name, flag in fields.items()
+                    if name != "_id")
+        if len(flags) > 1:
+            raise ValueError(
+                "Can't mix included and excluded fields in {}".format(
+                    fields))
+        if flags == set([False]):
+            excluded = frozenset(fields) - frozenset(["_id"])
+            return lambda record: dict(
+                (key, value) for key, value in record.iteritems()
+                if key not in excluded)
+    included = ["_id"] + [name for name in fields if name != "_id"]
+    return lambda record: dict(
+        (key, record[key]) for key in included if key in record)
+
+
+SANITIZED = "*" * 8
+
+
+def compile_transform(sanitize_list=None, encrypt_list=None, password="_",
+                      fields=None):
+    """Returns a function which accepts a record and returns the copy
+    of it which find returns: projected by fields (see
+    compile_projection), with the truthy values of the fields in
+    sanitize_list replaced by asterisks and then the values of the
+    fields in encrypt_list encrypted with password. Fields a record
+    doesn't have are left out rather than sanitized or encrypted.
+
+    The cipher for password is looked up once, so transforming each
+    record costs a copy and a dict lookup per listed field.
+
+    >>> transform = compile_transform(["password"], ["email"], "key")
+    >>> record = transform({"_id": 1, "password": "s3cret", "age": 22})
+    >>> record == {"_id": 1, "password": "********", "age": 22}
+    True
+    """
+    project = compile_projection(fields) or dict.copy
+    sanitized = tuple(sanitize_list or ())
+    encrypted = tuple(encrypt_list or ())
+    if not sanitized and not encrypted:
+        return project
+    encrypt = key_stream(password).encrypt
+
+    def transform(record):
+        record = project(record)
+        get = record.get
+        for field in sanitized:
+            if get(field):
+                record[field] = SANITIZED
+        for field in encrypted:
+            if field in record:
+                value = record[field]
+                record[field] = encrypt(
+                    value if isinstance(value, str) else str(value))
+        return record
+    return transform
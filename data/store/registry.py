@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""A registry of named Stores kept in a directory, one file each.
+
+The REST api keeps its collections in a dict by default, so they are
+lost when the server stops and all of them stay in memory. A Registry
+can take the place of that dict (see start_server.py): a collection is
+only read from its file the first time it is used, the least recently
+used collections are written back and dropped from memory once more
+than a budget of them (or of their records) are loaded, and changed
+collections are written back in the background and on close.
+
+A collection is changed if its Store.version moved since it was read
+or last written. Files are replaced atomically, a crash leaves either
+the previous or the new version of a collection behind.
+"""
+import os
+import urllib
+import weakref
+from collections import MutableMapping, OrderedDict
+from threading import RLock, Thread, Event
+import data.store
+
+EXTENSION = ".db"
+
+
+class Registry(MutableMapping):
+    def __init__(self, directory, max_collections=None, max_records=None,
+                 flush_interval=5.0, codec="pickle"):
+        """Keep the collections of directory (which is created if
+        needed). Nothing is read until a collection is used, so opening
+        a Registry takes the same time whatever the size of its
+        collections.
+
+        At most max_collections collections, holding at most
+        max_records records between them, are kept in memory (the most
+        recently used one is always kept). Changed collections are
+        written every flush_interval seconds, pass None to only write
+        them when they are evicted, on flush() and on close().
+
+        Collections are written with codec, see Store.persist.
+
+        A collection evicted while it is still in use (ie a request is
+        adding records to it) stays in memory, and is written back
+        like any other, until it is no longer used.
+
+        Files are read and written without holding up the other
+        collections. If writing in the background fails it is retried
+        at the next interval, the error is kept in error until a flush
+        succeeds.
+
+        >>> import tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> with Registry(directory) as registry:
+        ...     registry["users"] = data.store.Store([{"_id": "a"}])
+        >>> with Registry(directory) as registry:
+        ...     registry["users"]
+        [{'_id': 'a'}]
+        """
+        self.directory = directory
+        self.max_collections = max_collections
+        self.max_records = max_records
+        self.codec = codec
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = RLock()
+        self._loaded = OrderedDict()
+        self._retired = {}
+        self._flushed = {}
+        self._name_locks = {}
+        self._closed = Event()
+        self.error = None
+        self._flusher = None
+        if flush_interval:
+            self._flusher = Thread(
+                target=self._flush_periodically, args=(flush_interval,))
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop flushing in the background and write every changed
+        collection."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def _path(self, name):
+        return os.path.join(
+            self.directory, urllib.quote(name, safe="") + EXTENSION)
+
+    def _names(self):
+        """Returns the names of the collections with a file."""
+        return [
+            urllib.unquote(filename[:-len(EXTENSION)])
+            for filename in os.listdir(self.directory)
+            if filename.endswith(EXTENSION)]
+
+    def _name_lock(self, name):
+        """Returns the lock held while collection name is read,
+        written or removed, so the registry's lock never has to be held
+        during file I/O. Must be called while holding the lock."""
+        lock = self._name_locks.get(name)
+        if lock is None:
+            lock = self._name_locks[name] = RLock()
+        return lock
+
+    def _registered(self, name):
+        """Returns the Store of collection name in memory, or None.
+        Must be called while holding the lock."""
+        store = self._loaded.get(name)
+        if store is None:
+            store = self._retired.get(name)
+        return store
+
+    def _use(self, name, store):
+        """Make store the most recently used collection and return the
+        names of the collections evicted to make room for it, which
+        still have to be written and released (see _retire). Must be
+        called while holding the lock."""
+        self._retired.pop(name, None)
+        self._loaded.pop(name, None)
+        self._loaded[name] = store
+        return self._evict()
+
+    def __getitem__(self, name):
+        with self._lock:
+            store = self._registered(name)
+            if store is not None:
+                evicted = self._use(name, store)
+            else:
+                lock = self._name_lock(name)
+        if store is None:
+            # Only one thread reads a collection, the others wait for it
+            # without blocking the rest of the registry
+            with lock:
+                with self._lock:
+                    store = self._registered(name)
+                if store is None:
+                    if not os.path.exists(self._path(name)):
+                        raise KeyError(name)
+                    loaded = data.store.load(self._path(name))
+                with self._lock:
+                    if store is None:
+                        store = self._registered(name)
+                    if store is None:
+                        store = loaded
+                        self._flushed[name] = store.version
+                    evicted = self._use(name, store)
+        self._retire(evicted)
+        return store
+
+    def __setitem__(self, name, store):
+        with self._lock:
+            evicted = self._use(name, store)
+            # Never written, so it is changed whatever its version
+            self._flushed[name] = None
+        self._retire(evicted)
+
+    def __delitem__(self, name):
+        with self._lock:
+            lock = self._name_lock(name)
+        with lock:
+            with self._lock:
+                found = self._loaded.pop(name, None) is not None
+                found = self._retired.pop(name, None) is not None or found
+                self._flushed.pop(name, None)
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+            elif not found:
+                raise KeyError(name)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._loaded or name in self._retired or \
+                os.path.exists(self._path(name))
+
+    def __iter__(self):
+        with self._lock:
+            names = set(self._loaded) | set(self._retired)
+            names.update(self._names())
+        return iter(sorted(names))
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def loaded(self):
+        """Returns the names of the collections in memory, least
+        recently used first."""
+        with self._lock:
+            return self._loaded.keys() + sorted(self._retired)
+
+    def _over_budget(self):
+        if self.max_collections is not None and \
+                len(self._loaded) > self.max_collections:
+            return True
+        if self.max_records is not None:
+            records = sum(len(store) for store in self._loaded.values())
+            return records > self.max_records
+        return False
+
+    def _evict(self):
+        """Move the least recently used collections to the retired
+        ones until the loaded ones fit the budget, and return their
+        names. Must be called while holding the lock."""
+        evicted = []
+        while len(self._loaded) > 1 and self._over_budget():
+            name, store = self._loaded.popitem(last=False)
+            self._retired[name] = store
+            evicted.append(name)
+        return evicted
+
+    def _retire(self, names):
+        """Write back the evicted collections names and drop the ones
+        no longer in use. Must be called without holding the lock."""
+        for name in names:
+            self._flush(name)
+        with self._lock:
+            for name in names:
+                self._release(name)
+
+    def _release(self, name):
+        """Drop the registry's reference to the retired collection
+        name, unless it changed since it was written or something else
+        still refers to it (then it stays retired). Must be called
+        while holding the lock."""
+        store = self._retired.get(name)
+        if store is None or self._flushed.get(name) != store.version:
+            return
+        del store
+        collected = weakref.ref(self._retired.pop(name))
+        store = collected()
+        if store is not None:
+            self._retired[name] = store
+
+    def _flush(self, name):
+        """Write collection name if it changed. The file is written
+        while holding the collection's lock rather than the registry's,
+        so must be called without holding the latter."""
+        with self._lock:
+            lock = self._name_lock(name)
+        with lock:
+            with self._lock:
+                store = self._registered(name)
+                if store is None:
+                    return
+                # Read before writing, a change made meanwhile is
+                # written again by the next flush
+                version = store.version
+                if self._flushed.get(name) == version:
+                    return
+            # persist replaces the file atomically
+            store.persist(self._path(name), codec=self.codec)
+            with self._lock:
+                if self._registered(name) is store:
+                    self._flushed[name] = version
+
+    def flush(self):
+        """Write every changed collection, and drop the evicted ones
+        which are no longer in use. A collection which can't be written
+        doesn't stop the others, the first error is raised once they
+        have all been tried."""
+        with self._lock:
+            names = self._loaded.keys() + self._retired.keys()
+        errors = []
+        for name in names:
+            try:
+                self._flush(name)
+            except Exception as error:
+                errors.append(error)
+        with self._lock:
+            for name in self._retired.keys():
+                self._release(name)
+        if errors:
+            raise errors[0]
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.flush()
+            except Exception as error:
+                # Retried at the next interval, the changes are kept
+                self.error = error
+            else:
+                self.error = None
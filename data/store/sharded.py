@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""A Store partitioned across worker processes.
+
+Each shard is a Store living in its own process, records are assigned
+to a shard by a hash of their '_id'. Queries are sent to every shard
+at once, so the shards scan in parallel on separate cores, and their
+results are merged in the calling process.
+
+Everything sent to a shard is pickled. Plain values, operator dicts
+and compiled regular expressions pickle fine, callables only if they
+can be pickled by reference (ie functions defined at the top level of
+a module, not lambdas or nested functions).
+"""
+import heapq
+import uuid
+import zlib
+import cPickle
+from itertools import islice
+from multiprocessing import Process, Pipe, cpu_count
+from threading import Lock
+from store import Store
+from aggregate import Aggregation
+
+
+def _serve(connection):
+    """The loop run by each shard process: call the requested method
+    of the shard's Store and send back (True, result) or (False,
+    exception) until told to stop."""
+    store = Store()
+    while True:
+        try:
+            message = cPickle.loads(connection.recv_bytes())
+        except EOFError:
+            return
+        if message is None:
+            return
+        method, args, kwargs = message
+        try:
+            if method == "_group_states":
+                result = _group_states(store, *args)
+            else:
+                result = getattr(store, method)(*args, **kwargs)
+            connection.send((True, result))
+        except Exception as error:
+            connection.send((False, error))
+
+
+def _group_states(store, by, aggregates, desc):
+    """Returns the aggregation states (see Aggregation.states) of
+    store grouped by by, for merging with those of other shards."""
+    with store._lock.read():
+        records = store if desc is None else store._iter_matches(desc)
+        return Aggregation(aggregates).states(records, by)
+
+
+class _Descending(object):
+    """Wraps a sort key so that larger keys come first."""
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _merge(results, order_by, reverse):
+    """k-way merges results, a list of lists of records each sorted by
+    order_by. Ties keep the order of the lists they come from."""
+    def decorated(index, records):
+        for position, record in enumerate(records):
+            key = record[order_by]
+            if reverse:
+                key = _Descending(key)
+            yield key, index, position, record
+    merged = heapq.merge(*[
+        decorated(index, records) for index, records in enumerate(results)])
+    return (record for key, index, position, record in merged)
+
+
+class ShardedStore(object):
+    def __init__(self, records=None, shards=None):
+        """A Store whose records are split across shards (by default
+        one per CPU) worker processes. add_record, add_records, find,
+        find_one, del_records, group_by, sort and len work as they do
+        on a Store, queries run on every shard in parallel.
+
+        Close the ShardedStore (or use it as a context manager) to
+        stop the worker processes.
+
+        >>> with ShardedStore([{"n": n} for n in range(10)], 3) as store:
+        ...     [record["n"] for record in store.find(
+        ...         {"n": {"$gte": 5}}, order_by="n", limit=3)]
+        [5, 6, 7]
+        """
+        self._lock = Lock()
+        self._connections = []
+        self._processes = []
+        for shard in range(shards or cpu_count()):
+            parent, child = Pipe()
+            process = Process(target=_serve, args=(child,))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._connections.append(parent)
+            self._processes.append(process)
+        if records:
+            self.add_records(records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes, their records are lost."""
+        with self._lock:
+            for connection in self._connections:
+                connection.send_bytes(cPickle.dumps(None))
+                connection.close()
+            for process in self._processes:
+                process.join()
+            del self._connections[:], self._processes[:]
+
+    def _shard(self, _id):
+        """Returns the index of the shard holding _id. Unicode ids are
+        hashed as UTF-8, so u'abc' and 'abc' land on the same shard."""
+        if isinstance(_id, unicode):
+            _id = _id.encode("utf-8")
+        return zlib.crc32(str(_id)) % len(self._connections)
+
+    def _call(self, requests):
+        """Send each (shard, method, args, kwargs) request, then wait
+        for all of the results so the shards work in parallel. The
+        results are returned in the order of requests, the first
+        exception raised by a shard is raised again here."""
+        # Everything is pickled before anything is sent, so a request
+        # which can't be pickled leaves no replies behind in the pipes
+        messages = [
+            (shard, cPickle.dumps(
+                (method, args, kwargs), cPickle.HIGHEST_PROTOCOL))
+            for shard, method, args, kwargs in requests]
+        with self._lock:
+            for shard, message in messages:
+                self._connections[shard].send_bytes(message)
+            replies = [
+                self._connections[shard].recv()
+                for shard, method, args, kwargs in requests]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for ok, result in replies]
+
+    def _broadcast(self, method, *args, **kwargs):
+        """Call method on every shard, returns the list of results."""
+        return self._call([
+            (shard, method, args, kwargs)
+            for shard in range(len(self._connections))])
+
+    def __len__(self):
+        return sum(self._broadcast("__len__"))
+
+    def add_record(self, record):
+        """Add record to the shard its '_id' hashes to, see
+        Store.add_record."""
+        if "_id" not in record:
+            record["_id"] = uuid.uuid4().hex
+        return self._call([
+            (self._shard(record["_id"]), "add_record", (record,), {})])[0]
+
+    def add_records(self, records):
+        """Add every record in records, each shard adding its part in
+        a single call, see Store.add_records. A shard refusing its
+        part does not stop the others from adding theirs."""
+        parts = {}
+        for record in records:
+            if "_id" not in record:
+                record["_id"] = uuid.uuid4().hex
+            parts.setdefault(self._shard(record["_id"]), []).append(record)
+        self._call([
+            (shard, "add_records", (part,), {})
+            for shard, part in parts.items()])
+
+    def find(self, desc, sanitize_list=None, encrypt_list=None,
+             password="_", order_by=None, limit=None, skip=0,
+             reverse=False, fields=None):
+        """Returns a Store of the records matching desc, see
+        Store.find. Each shard sorts and limits its own matches, which
+        are then k-way merged when order_by is given."""
+        stop = None if limit is None else skip + limit
+        results = self._broadcast(
+            "find", desc, sanitize_list=sanitize_list,
+            encrypt_list=encrypt_list, password=password,
+            order_by=order_by, limit=stop, reverse=reverse, fields=fields)
+        if order_by is None:
+            records = (record for result in results for record in result)
+        else:
+            records = _merge(results, order_by, reverse)
+        return Store._from_results(islice(records, skip, stop))
+
+    def find_one(self, desc, sanitize_list=None, encrypt_list=None,
+                 password="_", fields=None):
+        """Returns one record matching desc, or None, see
+        Store.find_one."""
+        for record in self._broadcast(
+                "find_one", desc, sanitize_list=sanitize_list,
+                encrypt_list=encrypt_list, password=password, fields=fields):
+            if record is not None:
+                return record
+
+    def sort(self, by="_id", limit=None, skip=0, reverse=False):
+        """Return a sorted Store, see Store.sort."""
+        return self.find(
+            {}, order_by=by, limit=limit, skip=skip, reverse=reverse)
+
+    def del_records(self, desc):
+        """Delete every record matching desc from every shard, see
+        Store.del_records."""
+        deleted = []
+        for records in self._broadcast("del_records", desc):
+            deleted.extend(records)
+        return deleted
+
+    def group_by(self, by, aggregates=None, desc=None):
+        """Returns the groups (or the aggregates of the groups) of the
+        records grouped by by, see Store.group_by. Each shard computes
+        the states of its own groups, which are then merged."""
+        if aggregates is None:
+            groups = {}
+            for result in self._broadcast("group_by", by, desc=desc):
+                for value, records in result.items():
+                    groups.setdefault(value, []).extend(records)
+            return dict(
+                (value, Store(records)) for value, records in groups.items())
+        aggregation = Aggregation(aggregates)
+        states = {}
+        for result in self._broadcast(
+                "_group_states", by, aggregates, desc):
+            for value, state in result.items():
+                if value in states:
+                    aggregation.merge(states[value], state)
+                else:
+                    states[value] = state
+        return dict(
+            (value, aggregation.result(state))
+            for value, state in states.items())
@@ -1,32 +1,97 @@
 # -*- coding: utf-8 -*-
+import os
+import time
 import uuid
+import binascii
 from threading import RLock
 import pickle
 import base64
-from itertools import cycle, izip
+import json
+import heapq
+from collections import Mapping
+from operator import itemgetter
+from itertools import izip, islice, ifilter, ifilterfalse, imap, count
+from index import HashIndex, SortedIndex
+from lock import RWLock
+from journal import Journal
+from cache import ResultCache
+from aggregate import Aggregation, group_key
+from pipeline import run as run_pipeline
+from cipher import encrypt, decrypt, EncryptingWriter
+from codec import dump as dump_records
+from query import (
+    is_operator, compile_desc, compile_transform, RANGE_OPERATORS)
 
 
-def encrypt(string, key="_"):
-    """Return the base64 encoded XORed version of string. This is XORed with
-    key which defaults to a single underscore."""
-    return base64.encodestring(
-        ''.join(
-            chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key)))).strip()
+def new_ids(number):
+    """Returns a list of number new ids, formatted just like
+    uuid.uuid4().hex, using a single call to os.urandom.
 
-
-def decrypt(string, key="_"):
-    """Returns the base64 decoded, XORed version of string. This is XORed with
-    key, which defaults to a single underscore"""
-    string = base64.decodestring(string)
-    return ''.join(
-        chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key))).strip()
+    >>> ids = new_ids(2)
+    >>> len(set(ids)), len(ids[0])
+    (2, 32)
+    """
+    data = bytearray(os.urandom(16 * number))
+    for offset in xrange(0, 16 * number, 16):
+        # Set the version (4) and variant bits as uuid.uuid4 does
+        data[offset + 6] = data[offset + 6] & 0x0f | 0x40
+        data[offset + 8] = data[offset + 8] & 0x3f | 0x80
+    hexed = binascii.hexlify(data)
+    return [hexed[offset:offset + 32] for offset in xrange(0, 32 * number, 32)]
 
 
 class ResultList(list):
     pass
 
+
+class RecordView(Mapping):
+    """A read-only view of a record held by a Store, returned by
+    Store.iter_find so that records don't have to be copied. Use
+    copy() to get a mutable dict.
+
+    >>> view = RecordView({'this': 'that'})
+    >>> view['this']
+    'that'
+    >>> view['this'] = 'other'
+    Traceback (most recent call last):
+        ...
+    TypeError: 'RecordView' object does not support item assignment
+    """
+    __slots__ = ("_record",)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getitem__(self, key):
+        return self._record[key]
+
+    def __iter__(self):
+        return iter(self._record)
+
+    def __len__(self):
+        return len(self._record)
+
+    def __contains__(self, key):
+        return key in self._record
+
+    def __repr__(self):
+        return repr(self._record)
+
+    def get(self, key, default=None):
+        return self._record.get(key, default)
+
+    def copy(self):
+        return self._record.copy()
+
 LOCKS = {}
 
+# Removing up to this many records one at a time is cheaper than
+# rebuilding the whole list
+REMOVE_ONE_BY_ONE = 16
+
+# The number of records a lazy scan reads under the lock at a time
+SCAN_BATCH = 1024
+
 
 class Store(list):
     def __init__(self, records=None):
@@ -37,15 +102,414 @@ class Store(list):
         If you pass in a list of dicts then they will be used to
         initialize your store with records.
 
+        Records should only be added, updated and removed through
+        the methods of Store (add_record, update_record, del_record,
+        etc.) so that the internal '_id' index stays in sync.
+
         >>> store = Store([{'this': 'that'}])
         >>> store2 = Store()
         >>> store2.add_record(store.find_one({'this': 'that'}))  #doctest: +ELLIPSIS
         {'this': 'that', '_id':...}
         >>> store == store2
         True"""
+        self._lock = RWLock()
+        self._ids = {}
+        self._positions = {}
+        self._next_position = 0
+        self._indexes = {}
+        self._journal = None
+        self._version = 0
+        self._modified = time.time()
+        self._cache = None
+        if records:
+            self.add_records(records)
+
+    def _state(self):
+        """Returns what has to be kept of this Store besides its
+        records, see __setstate__. The indexes and the lock are rebuilt,
+        only the declarations of the secondary indexes (and of the
+        result cache) are kept. Journaling has to be started again
+        explicitly."""
+        indexes = [
+            (field, index.unique, isinstance(index, SortedIndex))
+            for field, index in self._indexes.items()]
+        cache = self._cache.maxsize if self._cache is not None else None
+        return {"indexes": indexes, "cache": cache}
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),), self._state())
+
+    def __setstate__(self, state):
+        for field, unique, ordered in state.get("indexes", []):
+            self.create_index(field, unique=unique, ordered=ordered)
+        if state.get("cache"):
+            self.enable_cache(state["cache"])
+
+    def _reindex(self):
+        """Rebuild the internal '_id' index from the records currently
+        held in this Store. This is only needed for Stores which were
+        created without calling __init__ (ie unpickled from a file
+        written by an older version of data.store)."""
+        self._lock = RWLock()
+        self._ids = {}
+        self._positions = {}
+        self._next_position = 0
+        self._indexes = {}
+        self._journal = None
+        self._version = 0
+        self._modified = time.time()
+        self._cache = None
+        for position, record in enumerate(self):
+            self._ids[record["_id"]] = record
+            self._positions[record["_id"]] = position
+        self._next_position = len(self)
+
+    def _log(self, operation, *args):
+        """Append a change to the journal, if this Store is journaled.
+        Must be called while holding the lock."""
+        if self._journal is not None:
+            self._journal.append(operation, *args)
+
+    def _changed(self, fields=None, _id=None):
+        """Count a change to the records of this Store and drop the
+        cached results it may affect, see ResultCache.invalidate. Must
+        be called while holding the write lock."""
+        self._version += 1
+        self._modified = time.time()
+        if self._cache is not None:
+            self._cache.invalidate(fields, _id)
+
+    @property
+    def version(self):
+        """A number which grows every time records are added to,
+        updated in or removed from this Store.
+
+        >>> store = Store()
+        >>> version = store.version
+        >>> _ = store.add_record({'this': 'that'})
+        >>> store.version > version
+        True
+        """
+        return self._version
+
+    @property
+    def modified(self):
+        """The time (in seconds since the epoch) this Store was created
+        or its records were last changed."""
+        return self._modified
+
+    def enable_cache(self, maxsize=128):
+        """Cache the results of up to maxsize distinct find and
+        find_one calls, evicting the least recently used. Repeating a
+        call returns copies of the cached results instead of scanning
+        again. Adding or removing records drops every cached result,
+        updating a record only drops the results which held it or
+        depend on an updated field. Regular expressions and callables
+        in a desc are compared by identity, so reuse the same objects
+        to hit the cache.
+
+        The ResultCache is returned, see data.store.cache.
+
+        >>> store = Store([{'this': 'that'}])
+        >>> cache = store.enable_cache()
+        >>> store.find({'this': 'that'}) == store.find({'this': 'that'})
+        True
+        >>> sorted(store.cache_info().items())
+        [('hits', 1), ('maxsize', 128), ('misses', 1), ('size', 1)]
+        """
+        with self._lock.write():
+            self._cache = ResultCache(maxsize)
+            return self._cache
+
+    def disable_cache(self):
+        """Stop caching query results and drop the cached ones."""
+        with self._lock.write():
+            self._cache = None
+
+    def cache_info(self):
+        """Returns a dict of the hits, misses, size and maxsize of the
+        result cache, or None if results aren't cached."""
+        cache = self._cache
+        return None if cache is None else cache.info()
+
+    def _cache_key(self, method, desc, sanitize_list, encrypt_list,
+                   options):
+        """Returns the key the results of method are cached under, or
+        None if they can't be cached. Must be called while holding the
+        lock."""
+        if self._cache is None:
+            return None
+        if "_id" in (sanitize_list or ()) or "_id" in (encrypt_list or ()):
+            # The cached results are tracked by their '_id's
+            return None
+        return self._cache.key(
+            method, desc, (sanitize_list, encrypt_list) + options)
+
+    def journal(self, filename, sync="always", interval=1.0,
+                compact_size=64 * 1024 * 1024):
+        """Start journaling this Store to filename. A snapshot of this
+        Store is written to filename and from then on every change made
+        through add_record(s), update_record, del_record(s), retain,
+        create_index and drop_index is appended to the write-ahead log
+        filename + '.wal'. data.store.load(filename) rebuilds the Store
+        from the snapshot and the log.
+
+        sync is one of 'always' (fsync every change), 'group' (buffer
+        changes and fsync them together every interval seconds) or
+        'never' (let the operating system decide). Once the log grows
+        past compact_size bytes a fresh snapshot is written in the
+        background and the log is truncated.
+
+        The Journal is returned, see data.store.journal.Journal.
+
+        >>> import os, tempfile
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'test.db')
+        >>> store = Store([{'this': 'that', '_id': 'test1'}])
+        >>> journal = store.journal(filename)
+        >>> store.add_record({'this': 'that', '_id': 'test2'})
+        {'this': 'that', '_id': 'test2'}
+        >>> store.close_journal()
+        >>> from data.store import load
+        >>> load(filename)
+        [{'this': 'that', '_id': 'test1'}, {'this': 'that', '_id': 'test2'}]
+        """
+        with self._lock.write():
+            self.close_journal()
+            self._journal = Journal(
+                self, filename, sync=sync, interval=interval,
+                compact_size=compact_size)
+            return self._journal
+
+    def close_journal(self):
+        """Flush any buffered changes to the journal and stop
+        journaling this Store."""
+        with self._lock.write():
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _take_position(self, number=1):
+        """Returns the first of number fresh positions for records
+        about to be appended. Positions only ever grow, so they are
+        unique and follow Store order however many records have been
+        deleted. Must be called while holding the write lock."""
+        position = self._next_position
+        self._next_position += number
+        return position
+
+    def _index_of(self, record):
+        """Returns the index of record (which must be held by this
+        Store) in the underlying list."""
+        return self._bisect(self._positions[record["_id"]])
+
+    def _bisect(self, position):
+        """Returns the index in the underlying list of the first record
+        whose position is at least position. Records are only ever
+        appended and positions only grow, so the list is sorted by
+        position and can be bisected."""
+        positions = self._positions
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if positions[self[mid]["_id"]] < position:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _scan(self):
+        """Yields the records of this Store in order without copying
+        the list or holding the lock between records. They are read
+        SCAN_BATCH at a time under the read lock, if the Store changed
+        since the last batch the scan picks up after the position of the
+        last record yielded. Records added after the scan started are
+        left out, records removed before they are reached are skipped
+        (unless they were already read in the current batch)."""
+        end = self._next_position
+        index, position, version = 0, -1, None
+        while True:
+            with self._lock.read():
+                if version != self._version:
+                    index = self._bisect(position + 1)
+                    version = self._version
+                batch = self[index:index + SCAN_BATCH]
+                positions = self._positions
+                if batch and positions[batch[-1]["_id"]] >= end:
+                    batch = [record for record in batch
+                             if positions[record["_id"]] < end]
+                if batch:
+                    position = positions[batch[-1]["_id"]]
+            if not batch:
+                return
+            index += len(batch)
+            for record in batch:
+                yield record
+
+    def _remove(self, record):
+        """Remove record (which must be held by this Store) from the
+        underlying list and the '_id' index."""
+        _id = record["_id"]
+        for index in self._indexes.values():
+            index.discard(record)
+        del self[self._index_of(record)]
+        del self._positions[_id]
+        del self._ids[_id]
+
+    def _remove_many(self, records):
+        """Remove every record in records (which must all be held by
+        this Store) in a single pass over the underlying list."""
         if records:
+            self._changed()
+        if len(records) <= REMOVE_ONE_BY_ONE:
             for record in records:
-                self.add_record(record)
+                self._remove(record)
+            return
+        for index in self._indexes.values():
+            index.discard_many(records)
+        for record in records:
+            del self._positions[record["_id"]]
+            del self._ids[record["_id"]]
+        # The positions of the records left are unchanged, they still
+        # follow Store order (see _take_position)
+        doomed = set(imap(id, records))
+        self[:] = [record for record in self if id(record) not in doomed]
+
+    def _candidates(self, desc):
+        """Returns an iterable of the records which could possibly match
+        desc. If desc pins '_id' to a single value this is at most one
+        record looked up in the '_id' index. Otherwise if desc pins
+        any indexed fields to a single value (or range of values), the
+        records from the smallest matching index entry are returned in
+        Store order. Failing that every record in this Store is
+        returned."""
+        best = None
+        for key, value in desc.items():
+            if hasattr(value, "match") or callable(value):
+                continue
+            if is_operator(value):
+                if key == "_id" and "$in" in value:
+                    try:
+                        ids = set(
+                            _id for _id in value["$in"] if _id in self._ids)
+                    except TypeError:
+                        # unhashable (or not iterable) operands are left
+                        # to the predicate
+                        continue
+                elif key in self._indexes:
+                    ids = self._indexes[key].select(value)
+                else:
+                    continue
+                if ids is not None and (best is None or len(ids) < len(best)):
+                    best = ids
+                continue
+            if key == "_id":
+                try:
+                    record = self._ids.get(value)
+                except TypeError:
+                    # unhashable values can't be in the index
+                    continue
+                return [record] if record is not None else []
+            index = self._indexes.get(key)
+            if index is None:
+                continue
+            ids = index.lookup(value)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        if best is None:
+            return self
+        return [
+            self._ids[_id]
+            for _id in sorted(best, key=self._positions.__getitem__)]
+
+    def _ordered_candidates(self, desc, order_by, candidates):
+        """Returns the records which could possibly match desc sorted
+        by order_by, read straight from a sorted index on order_by. If
+        there is no such index, or if candidates (as returned by
+        _candidates) is a smaller set to sort, None is returned."""
+        index = self._indexes.get(order_by)
+        if not isinstance(index, SortedIndex):
+            return None
+        operators = desc.get(order_by)
+        if is_operator(operators) and any(
+                name in operators for name in RANGE_OPERATORS):
+            lo, hi = index.bounds(operators)
+            ids = index.ids[lo:hi]
+        elif len(index.ids) == len(self):
+            ids = index.ids
+        else:
+            # Some records lack order_by, sorting them raises KeyError
+            return None
+        if candidates is not self and len(candidates) < len(ids):
+            return None
+        return [self._ids[_id] for _id in ids]
+
+    def create_index(self, field, unique=False, ordered=False):
+        """Create a hash index on field. Any desc passed to find,
+        find_one, filter, del_record or del_records which tests field
+        for equality with a plain value (or with '$in') will only look
+        at the records holding those values. group_by also uses the
+        index when grouping by field.
+
+        If ordered is True the index additionally keeps the records
+        sorted by field, so that range operators ('$gt', '$gte', '$lt'
+        and '$lte') on field are answered with a bisect and find with
+        order_by=field reads its results in order instead of sorting.
+
+        If unique is True, a ValueError is raised when a record is
+        added (or updated) with a value for field which another record
+        already holds. Records missing field are not checked.
+
+        The index is kept up to date by add_record, update_record and
+        the del_* methods, so modifying a record in place will leave
+        it stale.
+
+        >>> store = Store([
+        ...     {'this': 'that', '_id': 'test1'},
+        ...     {'this': 'that', '_id': 'test2'},
+        ...     {'this': 'other', '_id': 'test3'}])
+        >>> store.create_index('this')
+        >>> store.find({'this': 'other'})
+        [{'this': 'other', '_id': 'test3'}]
+        """
+        with self._lock.write():
+            if ordered:
+                index = SortedIndex(field, self._positions, unique=unique)
+            else:
+                index = HashIndex(field, unique=unique)
+            for record in self:
+                index.check(record)
+                index.add(record)
+            self._indexes[field] = index
+            self._log("create_index", field, unique, ordered)
+
+    def drop_index(self, field):
+        """Remove the index on field. A KeyError is raised if there
+        is no index on field.
+
+        >>> store = Store()
+        >>> store.create_index('this')
+        >>> store.drop_index('this')
+        """
+        with self._lock.write():
+            del self._indexes[field]
+            self._log("drop_index", field)
+
+    def _iter_misses(self, desc):
+        """Returns an iterator over the records (not copies) in this
+        Store which don't match desc, in Store order."""
+        candidates = self._candidates(desc)
+        if candidates is self:
+            return ifilterfalse(compile_desc(desc), self)
+        matches = set(imap(id, self._iter_matches(desc, candidates)))
+        return (record for record in self if id(record) not in matches)
+
+    def _iter_matches(self, desc, candidates=None):
+        """Returns an iterator over the records (not copies) in this
+        Store which match desc. If candidates is given only those
+        records are tested."""
+        if candidates is None:
+            candidates = self._candidates(desc)
+        return ifilter(compile_desc(desc), candidates)
 
     def add_record(self, record):
         """This method adds a record to this Store. record should be
@@ -54,7 +518,8 @@ class Store(list):
 
         Every record in data.store must have a unique value for
         the field '_id', if you don't provide one then one will
-        be generated.
+        be generated. A ValueError is raised if a record with the
+        same '_id' is already in this Store.
 
         This method returns the record you passed in, but
         with the '_id' field added if it wasn't present.
@@ -69,12 +534,138 @@ class Store(list):
         """
         if "_id" not in record:
             record["_id"] = uuid.uuid4().hex
-        self.append(record)
+        with self._lock.write():
+            if record["_id"] in self._ids:
+                raise ValueError(
+                    "A record with _id {} already exists!".format(
+                        record["_id"]))
+            for index in self._indexes.values():
+                index.check(record)
+            self._ids[record["_id"]] = record
+            self._positions[record["_id"]] = self._take_position()
+            self.append(record)
+            for index in self._indexes.values():
+                index.add(record)
+            self._changed()
+            self._log("add", [record])
         return record
 
-    def sort(self, by="_id"):
+    def add_records(self, records):
+        """Adds every record from records (any iterable of dicts,
+        including generators) to this Store in one go and returns them
+        as a list.
+
+        Missing '_id's are generated in a single batch. If any '_id'
+        is duplicated (within records or with a record already in this
+        Store), or a unique index would be violated, a ValueError is
+        raised and no record is added.
+
+        >>> store = Store()
+        >>> store.add_records({'n': n, '_id': str(n)} for n in range(3))
+        [{'_id': '0', 'n': 0}, {'_id': '1', 'n': 1}, {'_id': '2', 'n': 2}]
+        >>> len(store)
+        3
+        """
+        records = list(records)
+        missing = [record for record in records if "_id" not in record]
+        for record, _id in izip(missing, new_ids(len(missing))):
+            record["_id"] = _id
+        ids = [record["_id"] for record in records]
+        with self._lock.write():
+            unique = set(ids)
+            if len(unique) != len(ids) or not unique.isdisjoint(self._ids):
+                seen = set(self._ids)
+                for _id in ids:
+                    if _id in seen:
+                        raise ValueError(
+                            "A record with _id {} already exists!".format(
+                                _id))
+                    seen.add(_id)
+            for index in self._indexes.values():
+                index.check_many(records)
+            self._positions.update(
+                izip(ids, count(self._take_position(len(records)))))
+            self._ids.update(izip(ids, records))
+            self.extend(records)
+            for index in self._indexes.values():
+                index.add_many(records)
+            if records:
+                self._changed()
+            self._log("add", records)
+        return records
+
+    @classmethod
+    def _from_results(cls, records):
+        """Returns a Store of records, the transformed copies a query
+        returns. Unlike add_records their '_id's aren't checked:
+        sanitizing '_id' gives every result the same one, and only the
+        last of the records sharing an '_id' can be found by it.
+
+        >>> Store._from_results([{'_id': '********'}, {'_id': '********'}])
+        [{'_id': '********'}, {'_id': '********'}]
+        """
+        store = cls()
+        records = list(records)
+        missing = [record for record in records if "_id" not in record]
+        for record, _id in izip(missing, new_ids(len(missing))):
+            record["_id"] = _id
+        ids = [record["_id"] for record in records]
+        store._positions.update(izip(ids, count(store._take_position(
+            len(records)))))
+        store._ids.update(izip(ids, records))
+        store.extend(records)
+        return store
+
+    def update_record(self, desc, updates):
+        """Updates the record matching desc in place with the keys and
+        values in updates. Like del_record, desc must match exactly one
+        record otherwise a ValueError is raised. A copy of the updated
+        record is returned.
+
+        >>> store = Store([{'this': 'that', '_id': 'test'}])
+        >>> store.update_record({'_id': 'test'}, {'this': 'other'})
+        {'this': 'other', '_id': 'test'}
+        >>> store
+        [{'this': 'other', '_id': 'test'}]
+        """
+        with self._lock.write():
+            matches = list(islice(self._iter_matches(desc), 2))
+            if len(matches) != 1:
+                raise ValueError(
+                    "{} does not match exactly one record! Aborting...".format(
+                        str(desc)))
+            record = matches[0]
+            old_id = record["_id"]
+            _id = updates.get("_id", old_id)
+            if _id != old_id and _id in self._ids:
+                raise ValueError(
+                    "A record with _id {} already exists!".format(_id))
+            if _id != old_id:
+                indexes = self._indexes.values()
+            else:
+                indexes = [
+                    index for field, index in self._indexes.items()
+                    if field in updates]
+            updated = record.copy()
+            updated.update(updates)
+            for index in indexes:
+                index.check(updated, ignore=old_id)
+            for index in indexes:
+                index.discard(record)
+            if _id != old_id:
+                self._ids[_id] = self._ids.pop(old_id)
+                self._positions[_id] = self._positions.pop(old_id)
+            record.update(updates)
+            for index in indexes:
+                index.add(record)
+            self._changed(updates.keys(), old_id)
+            self._log("update", old_id, updates)
+            return record.copy()
+
+    def sort(self, by="_id", limit=None, skip=0, reverse=False):
         """Return a sorted Store. The records in the returned Store
-        will be sorted by the field named in by.
+        will be sorted by the field named in by. limit, skip and
+        reverse work as they do for find.
 
         >>> store = Store([
         ...     {"this": "b"},
@@ -82,8 +673,11 @@ class Store(list):
         >>> srtd = store.sort(by="this")
         >>> print srtd[0]["this"]
         a
+        >>> print store.sort(by="this", limit=1, reverse=True)[0]["this"]
+        b
         """
-        return self.find({}, order_by=by)
+        return self.find(
+            {}, order_by=by, limit=limit, skip=skip, reverse=reverse)
 
     def filter(self, desc, sanitize_list=None, encrypt_list=None,
                password="_", order_by=None):
@@ -99,22 +693,46 @@ class Store(list):
         >>> print filtered[0]["this"]
         b
         """
-        matches = self.find(desc)
-        ret = self.find(
-            desc={},
-            sanitize_list=sanitize_list,
-            encrypt_list=encrypt_list,
-            password=password,
-            order_by=order_by)
-        for match in list(matches):
-            ret.del_record({"_id": match["_id"]})
-        return ret
-
-    def group_by(self, by):
+        with self._lock.read():
+            return self._results(
+                self._iter_misses(desc), order_by, False, None, 0, False,
+                sanitize_list, encrypt_list, password, None)
+
+    def retain(self, desc):
+        """The in-place version of find, every record which does not
+        match desc is removed from this Store. The records which were
+        removed are returned.
+
+        >>> store = Store([
+        ...     {"this": "b", "_id": "test1"},
+        ...     {"this": "a", "_id": "test2"}])
+        >>> store.retain({"this": "a"})
+        [{'this': 'b', '_id': 'test1'}]
+        >>> store
+        [{'this': 'a', '_id': 'test2'}]
+        """
+        with self._lock.write():
+            records = ResultList(self._iter_misses(desc))
+            self._remove_many(records)
+            if records:
+                self._log("delete", [record["_id"] for record in records])
+        return records
+
+    def group_by(self, by, aggregates=None, desc=None):
         """Returns a dict containing the values of by for the keys and
         Stores for the values where the field referenced in by matches
         the key.
 
+        by may also be a list of fields, in which case the keys are
+        tuples of their values. Records missing a field are grouped
+        under None for it. If desc is given only the records matching
+        it are grouped.
+
+        If aggregates is given the groups are not collected, instead
+        each key maps to a dict of the aggregates computed for its
+        group in a single pass (see data.store.aggregate), e.g.
+        {"n": "count", "total": ("sum", "amount")}.
+
         >>> store = Store([
         ...     {"this": "a"},
         ...     {"this": "a"},
@@ -127,15 +745,73 @@ class Store(list):
         3
         >>> print len(groups["a"])
         2
+        >>> store.group_by("this", aggregates={"n": "count"})["c"]
+        {'n': 2}
         """
+        with self._lock.read():
+            index = None
+            if desc is None and not isinstance(by, (list, tuple)):
+                index = self._indexes.get(by)
+                if index is not None and index.unhashable:
+                    index = None
+            if aggregates is None:
+                if index is not None:
+                    return self._group_by_index(index)
+                records = self if desc is None else self._iter_matches(desc)
+                key = group_key(by)
+                groups = {}
+                for record in records:
+                    value = key(record)
+                    if value in groups:
+                        groups[value].append(record)
+                    else:
+                        groups[value] = [record]
+                for k, v in dict(groups).items():
+                    groups[k] = Store(v)
+                return groups
+            aggregation = Aggregation(aggregates)
+            specs = aggregation.specs
+            if index is not None and all(
+                    field is None for name, operation, field in specs):
+                # Only counting records, the index knows how many there are
+                return dict(
+                    (value, dict(
+                        (name, len(ids)) for name, operation, field in specs))
+                    for value, ids in index.values.iteritems())
+            records = self if desc is None else self._iter_matches(desc)
+            states = aggregation.states(records, by)
+            return dict(
+                (value, aggregation.result(state))
+                for value, state in states.iteritems())
+
+    def aggregate(self, pipeline):
+        """Returns an iterator over the results of running pipeline, a
+        list of stages, over this Store. The stages are '$match',
+        '$project', '$group', '$sort', '$skip' and '$limit', see
+        data.store.pipeline. Records stream through the stages one at
+        a time, so unlike chaining find, group_by and sort no
+        intermediate Stores are built.
+
+        >>> store = Store([
+        ...     {"this": "a", "n": 1},
+        ...     {"this": "a", "n": 2},
+        ...     {"this": "b", "n": 5}])
+        >>> results = store.aggregate([
+        ...     {"$match": {"n": {"$lt": 5}}},
+        ...     {"$group": {"by": "this",
+        ...                 "aggregates": {"total": ("sum", "n")}}}])
+        >>> [(result["this"], result["total"]) for result in results]
+        [('a', 3)]
+        """
+        return run_pipeline(self, pipeline)
+
+    def _group_by_index(self, index):
         groups = {}
-        for record in self:
-            if record[by] in groups:
-                groups[record[by]].append(record)
-            else:
-                groups[record[by]] = [record]
-        for k, v in dict(groups).items():
-            groups[k] = Store(v)
+        for value, ids in index.values.items():
+            records = [
+                self._ids[_id]
+                for _id in sorted(ids, key=self._positions.__getitem__)]
+            groups[value] = Store(records)
         return groups
 
     def del_record(self, desc):
@@ -151,14 +827,16 @@ class Store(list):
         >>> store
         []
         """
-        record = self.find_one(desc)
-        records = self.find(desc)
-        if [record] != records:
-            raise ValueError(
-                "{} matches more than one record! Aborting...".format(
-                    str(desc)))
-        if record:
-            self.remove(record)
+        with self._lock.write():
+            records = list(islice(self._iter_matches(desc), 2))
+            if len(records) != 1:
+                raise ValueError(
+                    "{} does not match exactly one record! Aborting...".format(
+                        str(desc)))
+            record = records[0]
+            self._remove(record)
+            self._changed()
+            self._log("delete", [record["_id"]])
         return record
 
     def del_records(self, desc):
@@ -173,13 +851,89 @@ class Store(list):
         >>> store.del_records({'this': 'that'})
         [{'this': 'that', '_id': 'test1'}, {'this': 'that', '_id': 'test2'}, {'this': 'that', '_id': 'test3'}]
         """
-        records = self.find(desc)
-        for record in records:
-            self.remove(record)
+        with self._lock.write():
+            records = ResultList(self._iter_matches(desc))
+            self._remove_many(records)
+            if records:
+                self._log("delete", [record["_id"] for record in records])
         return records
 
+    def bulk_write(self, operations):
+        """Applies every operation in operations (an iterable) while
+        holding the write lock once, and returns a list with the
+        status of each operation in order. An operation is one of:
+
+        * {"op": "insert", "record": record}
+        * {"op": "update", "desc": desc, "updates": updates}
+        * {"op": "delete", "desc": desc}
+
+        An insert or update reports {"ok": True, "_id": _id}, a delete
+        (which, like del_records, removes every match) reports
+        {"ok": True, "deleted": n}. An operation which fails reports
+        {"ok": False, "error": message} and doesn't stop the others.
+        Runs of inserts are added with a single add_records when none
+        of them fails.
+
+        >>> store = Store([{'_id': 'a', 'n': 1}])
+        >>> statuses = store.bulk_write([
+        ...     {'op': 'insert', 'record': {'_id': 'b', 'n': 2}},
+        ...     {'op': 'insert', 'record': {'_id': 'a'}},
+        ...     {'op': 'delete', 'desc': {'n': 1}}])
+        >>> [status['ok'] for status in statuses]
+        [True, False, True]
+        >>> store
+        [{'_id': 'b', 'n': 2}]
+        """
+        statuses = []
+        inserts = []
+
+        def insert_all():
+            try:
+                self.add_records(inserts)
+            except (ValueError, TypeError):
+                # Find out which ones can't be added
+                for record in inserts:
+                    statuses.append(self._bulk_apply(
+                        {"op": "insert", "record": record}))
+            else:
+                statuses.extend(
+                    {"ok": True, "_id": record["_id"]} for record in inserts)
+            del inserts[:]
+        with self._lock.write():
+            for operation in operations:
+                if isinstance(operation, dict) and \
+                        operation.get("op") == "insert" and \
+                        isinstance(operation.get("record"), dict):
+                    inserts.append(operation["record"])
+                    continue
+                if inserts:
+                    insert_all()
+                statuses.append(self._bulk_apply(operation))
+            if inserts:
+                insert_all()
+        return statuses
+
+    def _bulk_apply(self, operation):
+        """Applies a single operation for bulk_write and returns its
+        status."""
+        try:
+            op = operation["op"]
+            if op == "insert":
+                record = self.add_record(operation["record"])
+                return {"ok": True, "_id": record["_id"]}
+            elif op == "update":
+                record = self.update_record(
+                    operation["desc"], operation["updates"])
+                return {"ok": True, "_id": record["_id"]}
+            elif op == "delete":
+                return {"ok": True,
+                        "deleted": len(self.del_records(operation["desc"]))}
+            raise ValueError("Unknown operation {}".format(op))
+        except (ValueError, TypeError, KeyError, AttributeError) as error:
+            return {"ok": False, "error": str(error)}
+
     def find_one(self, desc, sanitize_list=None, encrypt_list=None,
-                 password="_"):
+                 password="_", fields=None):
         """Returns one record matching desc, if more than one record
         matches desc returns the first one.
 
@@ -195,11 +949,21 @@ class Store(list):
         3. A callable which accepts one argument (the value of key in
         the current record) and returns True or False depending on
         whether the record should be included in the result set.
+        Records without key never match a regex or a callable.
+        4. A dict of operators, in the style of MongoDB, which the
+        value of key must all satisfy. The supported operators are
+        '$gt', '$gte', '$lt', '$lte' and '$in' (whose operand is a
+        list of values). Records without key never match.
 
         If sanitize_list is specified then it must be an iterable
         which contains values which when found as a key in a record
         will sanitize the value of that field in the result set.
 
+        If fields is specified only those fields are copied into the
+        result. It may be a list of the names of the fields to
+        include, or a dict of field names to 1 (include) or 0
+        (exclude). '_id' is always included.
+
         >>> store = Store([
         ...     {'this': 'that', '_id': 'test1'},
         ...     {'this': 'that', '_id': 'test2'},
@@ -207,33 +971,131 @@ class Store(list):
         >>> store.find_one({'this': 'that'})
         {'this': 'that', '_id': 'test1'}
         """
-        for item in self:
-            for key, value in desc.items():
-                if hasattr(value, "match"):
-                    if not value.match(item.get(key, None)):
-                        break
-                elif callable(value):
-                    if not value(item[key]):
-                        break
-                else:
-                    if not value == item[key]:
-                        break
-            else:
+        with self._lock.read():
+            key = self._cache_key(
+                "find_one", desc, sanitize_list, encrypt_list,
+                (password, fields))
+            if key is not None:
+                hit, record = self._cache.get(key)
+                if hit:
+                    return None if record is None else record.copy()
+            record = None
+            for item in self._iter_matches(desc):
                 # Needed to account for changing the actual store,
                 # Rather than just sanitizing the ResultList
-                _item = item.copy()
-                if sanitize_list:
-                    for key in sanitize_list:
-                        if item.get(key, None):
-                            _item[key] = "*" * 8
-                if encrypt_list:
-                    for field in encrypt_list:
-                        if item.get(field, None):
-                            _item[field] = encrypt(_item[field], key=password)
-                return _item
+                record = compile_transform(
+                    sanitize_list, encrypt_list, password, fields)(item)
+                break
+            if key is not None:
+                self._cache.put(
+                    key, None if record is None else record.copy(), desc,
+                    desc.keys())
+            return record
+
+    def iter_find(self, desc, limit=None, skip=0, sanitize_list=None,
+                  encrypt_list=None, password="_", copy=False, fields=None):
+        """Returns an iterator over the records matching desc. Unlike
+        find, records are only matched as the iterator is consumed so
+        paging through a large Store takes constant memory and the scan
+        stops as soon as limit records (after skipping the first skip
+        matches) have been found.
+
+        By default read-only RecordViews of the records are yielded
+        instead of copies. Pass copy=True to get dicts you can modify.
+        sanitize_list, encrypt_list, password and fields work just like
+        they do for find (and always produce copies).
+
+        The Store may be modified while iterating, the lock is only
+        held while the next batch of records is read. Records added
+        since iter_find was called are not yielded, records removed
+        since are skipped if they weren't reached yet, records updated
+        since are tested (and yielded) as they are when they are
+        reached. A desc answered from an index collects the records
+        from the index when iter_find is called.
+
+        >>> store = Store([
+        ...     {'this': 'that', '_id': 'test1'},
+        ...     {'this': 'that', '_id': 'test2'},
+        ...     {'this': 'that', '_id': 'test3'}])
+        >>> list(store.iter_find({'this': 'that'}, limit=1, skip=1))
+        [{'this': 'that', '_id': 'test2'}]
+        """
+        with self._lock.read():
+            candidates = self._candidates(desc)
+        if candidates is self:
+            # Scan lazily so memory stays constant and the scan stops
+            # as soon as enough matches were found
+            candidates = self._scan()
+        matches = self._iter_matches(desc, candidates=candidates)
+        if skip or limit is not None:
+            stop = None if limit is None else skip + limit
+            matches = islice(matches, skip, stop)
+        if sanitize_list or encrypt_list or fields is not None:
+            return imap(compile_transform(
+                sanitize_list, encrypt_list, password, fields), matches)
+        if copy:
+            return imap(dict.copy, matches)
+        return imap(RecordView, matches)
+
+    def _top(self, matches, order_by, count, reverse):
+        """Returns the first count records of matches when ordered by
+        order_by, using a bounded heap rather than a full sort."""
+        if not reverse:
+            return heapq.nsmallest(count, matches, key=itemgetter(order_by))
+        # Ties must come out in reverse order, just as if the ascending
+        # order had been reversed
+        top = heapq.nlargest(
+            count, enumerate(matches),
+            key=lambda (index, record): (record[order_by], index))
+        return [record for index, record in top]
+
+    def page(self, desc, order_by="_id", limit=50, token=None,
+             reverse=False, sanitize_list=None, encrypt_list=None,
+             password="_", fields=None):
+        """Returns a tuple of a Store holding one page of the records
+        matching desc ordered by order_by, and a token to pass back in
+        to get the next page (None on the last page).
+
+        Records are ordered by the value of order_by with ties broken
+        by '_id'. Each page only keeps the limit records following the
+        token on a bounded heap, so no page has to sort every match.
+        The value of order_by must be JSON serializable for the token
+        to be built.
+
+        >>> store = Store([{'n': n, '_id': str(n)} for n in range(5)])
+        >>> first, token = store.page({}, order_by='n', limit=3)
+        >>> [record['n'] for record in first]
+        [0, 1, 2]
+        >>> second, token = store.page({}, order_by='n', limit=3, token=token)
+        >>> [record['n'] for record in second], token
+        ([3, 4], None)
+        """
+        with self._lock.read():
+            key = lambda record: (record[order_by], record["_id"])
+            matches = self._iter_matches(desc)
+            if token is not None:
+                last = tuple(json.loads(base64.urlsafe_b64decode(str(token))))
+                if reverse:
+                    matches = (
+                        record for record in matches if key(record) < last)
+                else:
+                    matches = (
+                        record for record in matches if key(record) > last)
+            if reverse:
+                records = heapq.nlargest(limit + 1, matches, key=key)
+            else:
+                records = heapq.nsmallest(limit + 1, matches, key=key)
+            token = None
+            if len(records) > limit:
+                records = records[:limit]
+                token = base64.urlsafe_b64encode(json.dumps(key(records[-1])))
+            transform = compile_transform(
+                sanitize_list, encrypt_list, password, fields)
+            return Store._from_results(imap(transform, records)), token
 
     def find(self, desc, sanitize_list=None, encrypt_list=None,
-             password="_", order_by=None):
+             password="_", order_by=None, limit=None, skip=0,
+             reverse=False, fields=None):
         """Returns a ResultList containing records matching
         desc. If sanitize_list is specified it should be an iterable
         yielding keys of fields you would like sanitized. Those fields
@@ -242,6 +1104,15 @@ class Store(list):
         desc should follow the same rules as defined above in the
         docstring for find_one.
 
+        If order_by is given the records will be sorted by that field,
+        in descending order if reverse is True. skip and limit select
+        a slice of the (sorted) results. When ordering with a limit
+        only the first skip + limit records are kept on a bounded heap
+        instead of sorting every match. See also page.
+
+        fields selects the fields copied into the results, as described
+        for find_one. Unselected fields are never copied.
+
         >>> store = Store([
         ...     {'this': 'that', '_id': 'test1'},
         ...     {'this': 'that', '_id': 'test2'},
@@ -249,40 +1120,64 @@ class Store(list):
         >>> store.find({'this': 'that'})
         [{'this': 'that', '_id': 'test1'}, {'this': 'that', '_id': 'test2'}, {'this': 'that', '_id': 'test3'}]
         """
-        ret = ResultList()
-        for item in self:
-            for key, value in desc.items():
-                if hasattr(value, "match"):
-                    if not value.match(item.get(key, None)):
-                        break
-                elif callable(value):
-                    if not value(item[key]):
-                        break
-                else:
-                    if not value == item.get(key, None):
-                        break
-            else:
-                # Needed to account for changing the actual store,
-                # Rather than just sanitizing the ResultList
-                ret.append(item.copy())
-        for index, record in enumerate(list(ret)):
-            if sanitize_list:
-                for field in sanitize_list:
-                    if record.get(field, None):
-                        ret[index][field] = "*" * 8
-            if encrypt_list:
-                for field in encrypt_list:
-                    if str(record.get(field, None)):
-                        ret[index][field] = encrypt(
-                            str(ret[index][field]), key=password)
-        if order_by is not None:
-            ret = sorted(ret, key=lambda k: k[order_by])
-        return Store(ret)
-
-    def persist(self, filename, password=None):
+        with self._lock.read():
+            key = self._cache_key(
+                "find", desc, sanitize_list, encrypt_list,
+                (password, order_by, limit, skip, reverse, fields))
+            if key is not None:
+                hit, records = self._cache.get(key)
+                if hit:
+                    return Store(map(dict.copy, records))
+            candidates = self._candidates(desc)
+            ordered = None
+            if order_by is not None:
+                ordered = self._ordered_candidates(desc, order_by, candidates)
+                if ordered is not None:
+                    candidates = reversed(ordered) if reverse else ordered
+            matches = self._iter_matches(desc, candidates=candidates)
+            results = self._results(
+                matches, order_by, ordered is not None, limit, skip, reverse,
+                sanitize_list, encrypt_list, password, fields)
+            if key is not None:
+                self._cache.put(
+                    key, map(dict.copy, results), desc,
+                    desc.keys() + [order_by])
+            return results
+
+    def _results(self, matches, order_by, ordered, limit, skip, reverse,
+                 sanitize_list, encrypt_list, password, fields):
+        """Returns a Store of transformed copies of the records in
+        matches, sorted by order_by (unless ordered is True, meaning
+        matches are already in order) and sliced by skip and limit."""
+        stop = None if limit is None else skip + limit
+        if order_by is None or ordered:
+            if skip or stop is not None:
+                matches = islice(matches, skip, stop)
+        elif stop is not None:
+            matches = self._top(matches, order_by, stop, reverse)[skip:]
+        else:
+            matches = sorted(matches, key=itemgetter(order_by))
+            if reverse:
+                matches.reverse()
+            matches = matches[skip:]
+        # Needed to account for changing the actual store,
+        # Rather than just sanitizing the ResultList. The records are
+        # transformed as they come out of the scan.
+        return Store._from_results(imap(compile_transform(
+            sanitize_list, encrypt_list, password, fields), matches))
+
+    def persist(self, filename, password=None, codec=None):
         """Persist current data_store to a file named filename.
         A RLock from the threading module is used (unique by
-        filename) to ensure thread safety.
+        filename) to ensure thread safety. The file is replaced
+        atomically, if persisting fails the previous one is kept.
+
+        If codec is given the records are written in that format, one
+        of 'pickle', 'marshal', 'jsonl' or 'msgpack' (if the msgpack
+        package is installed), see data.store.codec. Otherwise this
+        Store is pickled with the default protocol, which any version
+        of data.store can load but is the slowest and largest. load
+        finds out which format was used from the file.
 
         >>> store = Store([
         ...     {'this': 'that', '_id': 'test1'},
@@ -296,12 +1191,23 @@ class Store(list):
         global LOCKS
         if filename not in LOCKS:
             LOCKS[filename] = RLock()
-        with LOCKS[filename]:
-            with open(filename, "wb") as fout:
-                pickle.dump(self, fout)
-            if password:
-                with open(filename, "rb") as fin:
-                    contents = fin.read()
-                contents = encrypt(contents, key=password)
-                with open(filename, "wb") as fout:
-                    fout.write(contents)
+        with LOCKS[filename], self._lock.read():
+            # Written next to filename and renamed over it, so a record
+            # the codec can't encode leaves the previous file in place
+            tmp = filename + ".tmp"
+            try:
+                with open(tmp, "wb") as fout:
+                    if codec is not None:
+                        dump_records(
+                            fout, list(self), self._state(), codec, password)
+                    elif password:
+                        writer = EncryptingWriter(fout, password)
+                        pickle.dump(self, writer)
+                        writer.close()
+                    else:
+                        pickle.dump(self, fout)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            os.rename(tmp, filename)
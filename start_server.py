@@ -1,4 +1,23 @@
-from data.store.api import api
+import argparse
+from data.store import api
+from data.store.registry import Registry
 
-api.run(server="cherrypy", host="0.0.0.0")
+parser = argparse.ArgumentParser(description="Serve the data.store api")
+parser.add_argument("--directory", default="collections",
+                    help="where the collections are kept, one file each")
+parser.add_argument("--max-collections", type=int, default=None,
+                    help="the most collections to keep in memory")
+parser.add_argument("--max-records", type=int, default=None,
+                    help="the most records to keep in memory")
+parser.add_argument("--flush-interval", type=float, default=5.0,
+                    help="seconds between writing changed collections")
+parser.add_argument("--port", type=int, default=8080)
+args = parser.parse_args()
 
+api.collections = Registry(
+    args.directory, max_collections=args.max_collections,
+    max_records=args.max_records, flush_interval=args.flush_interval)
+try:
+    api.api.run(server="cherrypy", host="0.0.0.0", port=args.port)
+finally:
+    api.collections.close()
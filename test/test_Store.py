@@ -293,3 +293,592 @@ def test_each_record_gets_uuid():
     store.add_record({"this": "that"})
     rec = store.find_one({"this": "that"})
     assert "_id" in rec
+
+
+def test_add_record_raises_ValueError_on_duplicate__id():
+    """Tests that add_record refuses a record whose '_id' is already
+    present in the Store."""
+    store = Store([{"_id": "test"}])
+    with pytest.raises(ValueError):
+        store.add_record({"_id": "test"})
+    assert len(store) == 1
+
+
+def test_find_by__id_uses_the__id_index():
+    """Tests that a desc pinning '_id' is answered from the index
+    and never calls the other matchers on unrelated records."""
+    store = _create_store()
+    target = store[3]
+    seen = []
+
+    def spy(value):
+        seen.append(value)
+        return True
+
+    results = store.find({"_id": target["_id"], "this": spy})
+    assert len(results) == 1
+    assert results[0]["_id"] == target["_id"]
+    assert seen == [target["this"]]
+    assert len(store.find({"_id": "missing"})) == 0
+
+
+def test_del_record_keeps__id_index_in_sync():
+    """Tests that records can still be found and deleted by '_id'
+    after records ahead of them were deleted."""
+    store = _create_store()
+    ids = [record["_id"] for record in store]
+    store.del_record({"_id": ids[0]})
+    store.del_record({"_id": ids[2]})
+    for _id in (ids[1], ids[3], ids[4], ids[5]):
+        assert store.find_one({"_id": _id})["_id"] == _id
+    store.del_record({"_id": ids[5]})
+    store.del_record({"_id": ids[1]})
+    assert [record["_id"] for record in store] == [ids[3], ids[4]]
+    store.add_record({"_id": ids[0]})
+    assert store.find_one({"_id": ids[0]}) == {"_id": ids[0]}
+
+
+def test_update_record_updates_in_place():
+    """Tests that update_record modifies the one matching record
+    and can change its '_id'."""
+    store = _create_store()
+    _id = store[1]["_id"]
+    updated = store.update_record({"_id": _id}, {"that": "qux"})
+    assert updated["that"] == "qux"
+    assert store[1]["that"] == "qux"
+    store.update_record({"_id": _id}, {"_id": "new"})
+    assert store.find_one({"_id": "new"})["that"] == "qux"
+    assert store.find_one({"_id": _id}) is None
+    with pytest.raises(ValueError):
+        store.update_record({"this": "that"}, {"that": "qux"})
+
+
+def test_load_rebuilds__id_index():
+    """Tests that a loaded Store can look records up by '_id'."""
+    filename = os.path.join(tempfile.gettempdir(), "testdb")
+    store = _create_store()
+    store.persist(filename)
+    store2 = data.store.load(filename)
+    assert store2.find_one({"_id": store[2]["_id"]}) == store[2]
+
+
+def test_create_index_is_used_by_find():
+    """Tests that find only tests the records from the index entry
+    when desc tests an indexed field for equality."""
+    store = _create_store()
+    store.create_index("this")
+    seen = []
+
+    def spy(value):
+        seen.append(value)
+        return True
+
+    results = store.find({"this": "that", "that": spy})
+    assert [record["that"] for record in results] == ["foo", "bar", "baz"]
+    assert seen == ["foo", "bar", "baz"]
+    assert store.find_one({"this": "baz"})["that"] == "this"
+    assert len(store.find({"this": "missing"})) == 0
+
+
+def test_index_is_kept_in_sync_with_add_update_and_delete():
+    """Tests that indexed lookups see records added, updated and
+    deleted after the index was created."""
+    store = _create_store()
+    store.create_index("this")
+    store.add_record({"this": "new", "_id": "new"})
+    assert store.find_one({"this": "new"})["_id"] == "new"
+    store.update_record({"_id": "new"}, {"this": "newer"})
+    assert store.find_one({"this": "new"}) is None
+    assert store.find_one({"this": "newer"})["_id"] == "new"
+    store.del_records({"this": "that"})
+    assert len(store.find({"this": "that"})) == 0
+    filtered = store.filter({"this": "newer"})
+    assert len(filtered) == 3
+    store.del_record({"this": "newer"})
+    assert len(store.find({"this": "newer"})) == 0
+
+
+def test_create_index_unique_rejects_duplicates():
+    """Tests that a unique index refuses duplicate values."""
+    store = _create_store()
+    with pytest.raises(ValueError):
+        store.create_index("this", unique=True)
+    store.create_index("that", unique=False)
+    store.drop_index("that")
+    store = Store([{"email": "a@example.com"}, {"email": "b@example.com"}])
+    store.create_index("email", unique=True)
+    with pytest.raises(ValueError):
+        store.add_record({"email": "a@example.com"})
+    with pytest.raises(ValueError):
+        store.update_record({"email": "b@example.com"},
+                            {"email": "a@example.com"})
+    assert len(store) == 2
+    assert store.find_one({"email": "b@example.com"}) is not None
+
+
+def test_index_handles_unhashable_values():
+    """Tests that records holding unhashable values are still found."""
+    store = Store([{"this": ["a", "b"]}, {"this": "a"}])
+    store.create_index("this")
+    assert len(store.find({"this": ["a", "b"]})) == 1
+    assert len(store.find({"this": "a"})) == 1
+
+
+def test_group_by_uses_index():
+    """Tests that group_by gives the same groups with an index."""
+    store = _create_store()
+    expected = store.group_by("that")
+    store.create_index("that")
+    groups = store.group_by("that")
+    assert groups == expected
+    assert all(isinstance(group, Store) for group in groups.values())
+
+
+def test_indexes_survive_persist_and_load():
+    """Tests that index declarations are persisted."""
+    filename = os.path.join(tempfile.gettempdir(), "testdb")
+    store = _create_store()
+    store.create_index("this")
+    store.persist(filename)
+    store2 = data.store.load(filename)
+    assert "this" in store2._indexes
+    assert len(store2.find({"this": "that"})) == 3
+
+
+def _create_aged_store():
+    """Helper which creates a Store with an 'age' field."""
+    return Store([
+        {"name": "a", "age": 30},
+        {"name": "b", "age": 17},
+        {"name": "c", "age": 65},
+        {"name": "d", "age": 18},
+        {"name": "e", "age": 30},
+        {"name": "f"}])
+
+
+def test_find_accepts_operator_dicts():
+    """Tests that find and find_one accept dicts of operators and that
+    records missing the field never match."""
+    store = _create_aged_store()
+    results = store.find({"age": {"$gte": 18, "$lt": 65}})
+    assert [record["name"] for record in results] == ["a", "d", "e"]
+    assert len(store.find({"age": {"$gt": 30}})) == 1
+    assert len(store.find({"age": {"$lte": 18}})) == 2
+    assert len(store.find({"name": {"$in": ["a", "f", "z"]}})) == 2
+    assert store.find_one({"age": {"$lt": 18}})["name"] == "b"
+    with pytest.raises(ValueError):
+        store.find({"age": {"$foo": 1}})
+
+
+def test_unhashable_id_in_operands_match_like_any_other_field():
+    """Tests that $in on '_id' with unhashable or non iterable operands
+    matches nothing, just like on a field without an index."""
+    store = Store([{"_id": "a", "name": "a"}, {"_id": "b", "name": "b"}])
+    for operand in ([["a"]], 1):
+        assert store.find({"_id": {"$in": operand}}) == \
+            store.find({"name": {"$in": operand}}) == []
+    assert [record["_id"] for record in store.find(
+        {"_id": {"$in": [["a"], "b"]}})] == ["b"]
+
+def test_ordered_index_answers_range_queries_in_order():
+    """Tests that range queries and order_by give the same results with
+    and without an ordered index."""
+    store = _create_aged_store()
+    descs = [
+        {"age": {"$gte": 18, "$lt": 65}},
+        {"age": {"$gt": 18}},
+        {"age": {"$lte": 30}, "name": {"$in": ["a", "b", "c"]}},
+        {"age": {"$in": [30, 65]}},
+    ]
+    expected = [store.find(desc, order_by="age") for desc in descs]
+    store.create_index("age", ordered=True)
+    for desc, result in zip(descs, expected):
+        assert store.find(desc, order_by="age") == result
+    store.del_record({"name": "f"})
+    assert store.sort(by="age") == sorted(store, key=lambda k: k["age"])
+    assert [r["name"] for r in store.sort(by="age")] == [
+        "b", "d", "a", "e", "c"]
+    store.update_record({"name": "b"}, {"age": 99})
+    store.add_record({"name": "g", "age": 1})
+    assert [r["name"] for r in store.sort(by="age")] == [
+        "g", "d", "a", "e", "c", "b"]
+    assert len(store.find({"age": {"$gt": 30}})) == 2
+
+
+def test_find_and_find_one_agree_on_missing_fields():
+    """Tests that find and find_one treat missing fields the same
+    way: equal to None for plain values, never matching otherwise."""
+    import re
+    store = Store([{"this": "that"}, {"that": "this"}])
+    for desc in ({"this": None},
+                 {"this": re.compile("t")},
+                 {"this": lambda value: True},
+                 {"this": {"$in": ["that", None]}}):
+        results = store.find(desc)
+        assert len(results) == 1
+        assert store.find_one(desc) == results[0]
+
+
+def test_compiled_plans_are_cached_by_desc_shape():
+    """Tests that descs with the same shape share a plan."""
+    from data.store import query
+    query._PLANS.clear()
+    store = _create_store()
+    assert len(store.find({"this": "that", "that": "foo"})) == 1
+    assert len(store.find({"that": "bar", "this": "that"})) == 1
+    assert len(store.find({"this": "foo"})) == 1
+    assert len(query._PLANS) == 2
+
+
+def test_iter_find_is_lazy_and_honours_limit_and_skip():
+    """Tests that iter_find stops scanning once limit matches have
+    been yielded and skips the first skip matches."""
+    store = _create_store()
+    seen = []
+
+    def spy(value):
+        seen.append(value)
+        return True
+
+    results = store.iter_find({"that": spy, "this": "that"}, limit=1, skip=1)
+    assert seen == []
+    results = list(results)
+    assert [record["that"] for record in results] == ["bar"]
+    assert seen == ["foo", "bar"]
+    assert len(list(store.iter_find({}, skip=4))) == 2
+
+
+def test_iter_find_yields_read_only_views_unless_copy():
+    """Tests that iter_find yields read-only views of the records by
+    default, copies on request and transformed copies for
+    sanitize_list and encrypt_list."""
+    store = _create_store()
+    view = next(store.iter_find({"that": "foo"}))
+    assert view == store[0]
+    with pytest.raises(TypeError):
+        view["this"] = "other"
+    record = next(store.iter_find({"that": "foo"}, copy=True))
+    record["this"] = "other"
+    assert store[0]["this"] == "that"
+    record = next(store.iter_find({"that": "foo"}, sanitize_list=["this"],
+                                  encrypt_list=["that", "missing"],
+                                  password="password"))
+    assert record["this"] == "*" * 8
+    assert decrypt(record["that"], key="password") == "foo"
+    assert "missing" not in record
+    assert store[0] == {"this": "that", "that": "foo", "_id": store[0]["_id"]}
+
+
+def test_find_accepts_limit_skip_and_reverse():
+    """Tests that limit, skip and reverse select the same records as
+    slicing the fully sorted results would, with and without an
+    ordered index."""
+    store = _create_aged_store()
+    store.del_record({"name": "f"})
+    ascending = [r["name"] for r in store.find({}, order_by="age")]
+    descending = list(reversed(ascending))
+    for indexed in (False, True):
+        if indexed:
+            store.create_index("age", ordered=True)
+        for limit, skip in ((2, 0), (2, 1), (None, 3), (10, 0)):
+            stop = None if limit is None else skip + limit
+            results = store.find({}, order_by="age", limit=limit, skip=skip)
+            assert [r["name"] for r in results] == ascending[skip:stop]
+            results = store.sort(by="age", limit=limit, skip=skip,
+                                 reverse=True)
+            assert [r["name"] for r in results] == descending[skip:stop]
+    assert len(store.find({}, limit=2, skip=1)) == 2
+
+
+def test_page_walks_every_match_once():
+    """Tests that following the tokens returned by page visits every
+    matching record once, in order."""
+    store = Store([{"n": n % 4, "_id": str(n)} for n in range(10)])
+    for reverse in (False, True):
+        seen = []
+        token = None
+        while True:
+            page, token = store.page({"n": {"$gt": 0}}, order_by="n",
+                                     limit=3, token=token, reverse=reverse)
+            seen.extend((r["n"], r["_id"]) for r in page)
+            if token is None:
+                break
+        expected = sorted(((r["n"], r["_id"]) for r in store if r["n"] > 0),
+                          reverse=reverse)
+        assert seen == expected
+
+
+def test_find_find_one_and_iter_find_accept_fields():
+    """Tests that fields projects the results of find, find_one and
+    iter_find, always keeping '_id'."""
+    store = _create_store()
+    _id = store[0]["_id"]
+    assert store.find_one({"that": "foo"}, fields=["that"]) == {
+        "that": "foo", "_id": _id}
+    assert store.find_one({"that": "foo"}, fields={"this": 0}) == {
+        "that": "foo", "_id": _id}
+    results = store.find({"this": "that"}, fields=["this"],
+                         sanitize_list=["this"], order_by="that")
+    assert [sorted(r) for r in results] == [["_id", "this"]] * 3
+    assert all(r["this"] == "*" * 8 for r in results)
+    record = next(store.iter_find({"that": "foo"}, fields={"that": False}))
+    assert record == {"this": "that", "_id": _id}
+    with pytest.raises(ValueError):
+        store.find({}, fields={"this": 1, "that": 0})
+
+
+def test_add_records_adds_records_from_any_iterable():
+    """Tests that add_records accepts generators, generates missing
+    '_id's and keeps the indexes in sync."""
+    store = _create_aged_store()
+    store.create_index("age", ordered=True)
+    store.create_index("name", unique=True)
+    added = store.add_records(
+        {"name": name, "age": age} for name, age in (("x", 40), ("y", 1)))
+    assert len(added) == 2
+    assert all(len(record["_id"]) == 32 for record in added)
+    assert len(store) == 8
+    assert store.find_one({"name": "y"})["age"] == 1
+    assert [r["name"] for r in store.find(
+        {"age": {"$gte": 30}}, order_by="age")] == ["a", "e", "x", "c"]
+    assert store.find({"age": {"$lt": 18}}, order_by="age")[0]["name"] == "y"
+
+
+def test_add_records_is_all_or_nothing():
+    """Tests that add_records doesn't add anything when an '_id' or a
+    unique value is duplicated."""
+    store = Store([{"_id": "a", "email": "a"}])
+    store.create_index("email", unique=True)
+    for records in ([{"_id": "b"}, {"_id": "b"}],
+                    [{"_id": "b"}, {"_id": "a"}],
+                    [{"email": "b"}, {"email": "b"}],
+                    [{"email": "a"}]):
+        with pytest.raises(ValueError):
+            store.add_records(records)
+        assert len(store) == 1
+
+
+def _create_big_store():
+    """Helper which creates a Store large enough to remove records
+    in bulk."""
+    store = Store({"n": n, "group": n % 3} for n in range(100))
+    store.create_index("group")
+    store.create_index("n", ordered=True)
+    return store
+
+
+def test_del_records_removes_many_records_and_keeps_indexes_in_sync():
+    """Tests that deleting many records at once leaves the Store and
+    its indexes consistent."""
+    store = _create_big_store()
+    deleted = store.del_records({"group": 1})
+    assert len(deleted) == 33
+    assert len(store) == 67
+    assert [r["n"] for r in store] == [n for n in range(100) if n % 3 != 1]
+    assert len(store.find({"group": 1})) == 0
+    assert [r["n"] for r in store.find({"n": {"$lt": 6}})] == [0, 2, 3, 5]
+    store.del_record({"n": 99})
+    assert store.find_one({"_id": store[-1]["_id"]})["n"] == 98
+    assert store.sort(by="n", reverse=True, limit=1)[0]["n"] == 98
+
+
+def test_retain_keeps_only_matching_records():
+    """Tests that retain removes every record which doesn't match."""
+    store = _create_big_store()
+    removed = store.retain({"n": {"$gte": 50}})
+    assert len(removed) == 50
+    assert [r["n"] for r in store] == range(50, 100)
+    assert len(store.find({"group": 0})) == 17
+    removed = store.retain({"group": 2})
+    assert all(r["group"] != 2 for r in removed)
+    assert all(r["group"] == 2 for r in store)
+
+
+def test_filter_returns_non_matching_records_with_and_without_index():
+    """Tests that filter gives the same results whether or not the
+    desc can use an index."""
+    store = _create_big_store()
+    filtered = store.filter({"group": 0, "n": lambda n: n > 10},
+                            order_by="n")
+    assert [r["n"] for r in filtered] == [
+        n for n in range(100) if n % 3 != 0 or n <= 10]
+    store.drop_index("group")
+    assert store.filter({"group": 0, "n": lambda n: n > 10},
+                        order_by="n") == filtered
+    assert len(store) == 100
+
+
+def test_find_find_one_and_page_transform_records_alike():
+    """Tests that find, find_one and page sanitize and encrypt the same
+    way, leave missing fields out and encrypt a field which is both
+    sanitized and encrypted as the sanitized value."""
+    store = data.store.Store([
+        {"_id": "1", "name": "jane", "password": "s3cret", "age": 22},
+        {"_id": "2", "name": "joe", "password": "", "age": 30},
+        {"_id": "3", "name": "ann"}])
+    options = {"sanitize_list": ["password", "name"],
+               "encrypt_list": ["age", "name"],
+               "password": "key"}
+    found = store.find({}, **options)
+    page, token = store.page({}, **options)
+    assert list(found) == list(page)
+    assert store.find_one({"_id": "1"}, **options) == found[0]
+    assert found[0]["password"] == "*" * 8
+    assert decrypt(found[0]["age"], key="key") == "22"
+    assert decrypt(found[0]["name"], key="key") == "*" * 8
+    assert found[1]["password"] == ""
+    assert "password" not in found[2] and "age" not in found[2]
+
+
+def test_sanitizing_id_returns_every_match():
+    """Tests that find, filter and page return every match when '_id'
+    is sanitized, even though the results then share one '_id'."""
+    store = data.store.Store([
+        {"_id": str(n), "n": n, "even": n % 2 == 0} for n in range(4)])
+    found = store.find({"even": True}, sanitize_list=["_id"])
+    assert [(record["_id"], record["n"]) for record in found] == [
+        ("*" * 8, 0), ("*" * 8, 2)]
+    filtered = store.filter({"even": True}, sanitize_list=["_id"])
+    assert [record["n"] for record in filtered] == [1, 3]
+    page, token = store.page({}, order_by="n", sanitize_list=["_id"])
+    assert len(page) == 4
+    assert set(store._ids) == set(["0", "1", "2", "3"])
+
+def _create_sales_store():
+    """Helper which creates a Store of sales."""
+    return Store([
+        {"region": "north", "rep": "a", "amount": 10},
+        {"region": "north", "rep": "b", "amount": 20},
+        {"region": "north", "rep": "a", "amount": 5},
+        {"region": "south", "rep": "c", "amount": 7},
+        {"region": "south", "rep": "c"},
+        {"rep": "d", "amount": 1}])
+
+
+def test_group_by_computes_aggregates():
+    """Tests that group_by computes count, sum, min, max and avg for
+    each group, leaving records without the field out of aggregates
+    over it and grouping records without by under None."""
+    groups = _create_sales_store().group_by("region", aggregates={
+        "n": "count",
+        "sold": ("count", "amount"),
+        "total": ("sum", "amount"),
+        "low": ("min", "amount"),
+        "high": ("max", "amount"),
+        "mean": ("avg", "amount")})
+    assert groups["north"] == {
+        "n": 3, "sold": 3, "total": 35, "low": 5, "high": 20,
+        "mean": 35 / 3.0}
+    assert groups["south"] == {
+        "n": 2, "sold": 1, "total": 7, "low": 7, "high": 7, "mean": 7.0}
+    assert groups[None]["n"] == 1
+
+
+def test_group_by_accepts_multiple_fields_and_a_desc():
+    """Tests that group_by groups by tuples of values when given a
+    list of fields and only groups records matching desc."""
+    store = _create_sales_store()
+    groups = store.group_by(["region", "rep"], desc={"amount": {"$gte": 5}},
+                            aggregates={"total": ("sum", "amount")})
+    assert groups == {
+        ("north", "a"): {"total": 15},
+        ("north", "b"): {"total": 20},
+        ("south", "c"): {"total": 7}}
+    groups = store.group_by("region", desc={"rep": "a"})
+    assert groups.keys() == ["north"]
+    assert len(groups["north"]) == 2
+
+
+def test_group_by_does_not_raise_on_missing_fields():
+    """Tests that group_by groups records missing the field under
+    None, with or without an index."""
+    store = _create_sales_store()
+    expected = store.group_by("region")
+    assert len(expected[None]) == 1
+    counts = store.group_by("region", aggregates={"n": "count"})
+    store.create_index("region")
+    assert store.group_by("region") == expected
+    assert store.group_by("region", aggregates={"n": "count"}) == counts
+
+
+def test_group_by_rejects_unknown_aggregates():
+    """Tests that group_by raises a ValueError for an unknown
+    operation or an operation other than count without a field."""
+    store = _create_sales_store()
+    with pytest.raises(ValueError):
+        store.group_by("region", aggregates={"x": ("median", "amount")})
+    with pytest.raises(ValueError):
+        store.group_by("region", aggregates={"x": "sum"})
+
+
+def test_bulk_write_reports_each_failed_insert_and_keeps_the_rest():
+    """Tests that when a run of inserts can't be added in one go,
+    each insert is retried alone so only the offending ones fail."""
+    store = data.store.Store([{"_id": "a", "email": "a@example.com"}])
+    store.create_index("email", unique=True)
+    statuses = store.bulk_write([
+        {"op": "insert", "record": {"_id": "b", "email": "b@example.com"}},
+        {"op": "insert", "record": {"_id": "c", "email": "a@example.com"}},
+        {"op": "insert", "record": {"_id": "d", "email": "d@example.com"}},
+        {"op": "update", "desc": {"_id": "missing"}, "updates": {}},
+        "not an operation"])
+    assert [status["ok"] for status in statuses] == [
+        True, False, True, False, False]
+    assert "already exists" in statuses[1]["error"]
+    assert sorted(record["_id"] for record in store) == ["a", "b", "d"]
+
+
+def test_ordered_index_survives_interleaved_deletes_and_inserts():
+    """Tests that a record added after a delete gets a position of its
+    own, so deleting it from an ordered index removes its own entry."""
+    store = data.store.Store([{"_id": str(n), "v": n} for n in range(3)])
+    store.create_index("v", ordered=True)
+    store.del_record({"_id": "0"})
+    store.add_record({"_id": "new", "v": 1})
+    store.del_record({"_id": "new"})
+    assert [r["_id"] for r in store.find({}, order_by="v")] == ["1", "2"]
+    assert [r["_id"] for r in store.find({"v": {"$gte": 0}})] == ["1", "2"]
+    store.add_records([{"_id": "x", "v": 2}, {"_id": "y", "v": 0}])
+    store.del_records({"_id": {"$in": ["1", "y"]}})
+    assert [r["_id"] for r in store.find({}, order_by="v")] == ["2", "x"]
+
+
+def test_indexed_results_keep_store_order_after_deletes():
+    """Tests that an index lookup returns its matches in the same
+    order as a scan, even when records were added after deletes."""
+    store = data.store.Store(
+        {"_id": "old{}".format(n), "k": 1, "n": n} for n in range(30))
+    store.del_records({"n": {"$lt": 20}})
+    for n in range(10):
+        store.add_record({"_id": "new{}".format(n), "k": 1})
+    scanned = [record["_id"] for record in store.find({"k": 1})]
+    store.create_index("k")
+    indexed = [record["_id"] for record in store.find({"k": 1})]
+    assert indexed == scanned == [record["_id"] for record in store]
+
+
+def test_del_record_after_del_records_removes_the_right_record():
+    """Tests that records are still found in the list (by bisecting
+    their positions) once a bulk delete has shifted them."""
+    store = data.store.Store({"_id": str(n), "n": n} for n in range(100))
+    store.del_records({"n": {"$lt": 50}})
+    for n in (50, 99, 75):
+        assert store.del_record({"_id": str(n)})["n"] == n
+    assert [record["n"] for record in store] == [
+        n for n in range(51, 99) if n != 75]
+    assert len(store._positions) == len(store._ids) == len(store)
+
+
+def test_iter_find_scans_lazily_while_the_store_changes(monkeypatch):
+    """Tests that iter_find reads the Store a batch at a time, picking
+    up after the last record it yielded when the Store changed."""
+    monkeypatch.setattr(data.store.store, "SCAN_BATCH", 2)
+    store = data.store.Store({"_id": str(n), "n": n} for n in range(10))
+    matches = store.iter_find({}, copy=True)
+    assert [next(matches)["n"] for _ in range(2)] == [0, 1]
+    store.del_records({"n": {"$in": [0, 1, 2, 5]}})
+    store.add_record({"_id": "late", "n": 10})
+    store.update_record({"_id": "3"}, {"n": 30})
+    assert [record["n"] for record in matches] == [30, 4, 6, 7, 8, 9]
+    assert [record["n"] for record in store.iter_find(
+        {"n": {"$gte": 7}}, limit=2)] == [30, 7]
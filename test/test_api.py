@@ -1,3 +1,6 @@
+import json
+import time
+import pytest
 import data.store
 import bottle
 from io import BytesIO
@@ -7,7 +10,7 @@ def test_api_exists():
     assert hasattr(data.store, "api")
 
 def test_get_collections_returns_list_of_collections():
-    assert data.store.api.get_collections() == {}
+    assert json.loads("".join(data.store.api.get_collections())) == {}
 
 def test_del_collection_deletes_a_collection():
     api.post_collection("new1")
@@ -36,7 +39,7 @@ def test_get_to_get_records_returns_records():
     bottle.request.environ['wsgi.input'] = BytesIO()
     bottle.request.environ['wsgi.input'].write(bottle.tob(body))
     bottle.request.environ['wsgi.input'].seek(0)
-    results = api.get_records("new")
+    results = json.loads("".join(api.get_records("new")))
     assert len(results) == 1
 
 def test_delete_to_delete_record_deletes_a_record():
@@ -59,3 +62,169 @@ def test_update_record_updates_a_record():
 
     results = api.update_record("new", "test")
     assert api.collections["new"].find({"_id": "test"})[0]["email"] == "me@ilovetux.com"
+
+def test_get_records_accepts_json_encoded_operators():
+    desc = api._parse_desc({"age": '{"$gte": 18}', "name": "{cliff}"})
+    assert desc == {"age": {"$gte": 18}, "name": "{cliff}"}
+
+def test_parse_fields_reads_the_fields_query_parameter():
+    assert api._parse_fields({}) is None
+    assert api._parse_fields({"$fields": "name, email"}) == ["name", "email"]
+    assert api._parse_fields({"$fields": "-name"}) == {"name": 0}
+    assert api._parse_desc({"$fields": "name", "a": "b"}) == {"a": "b"}
+
+def test_post_to_aggregate_runs_a_pipeline():
+    api.collections["sales"] = data.store.Store([
+        {"region": "north", "amount": 10},
+        {"region": "north", "amount": 20},
+        {"region": "south", "amount": 7}])
+    body = ('[{"$group": {"by": "region", "aggregates": '
+            '{"total": ["sum", "amount"]}}}, '
+            '{"$sort": {"by": "total", "reverse": true}}, {"$limit": 1}]')
+    bottle.request.bind({})
+    bottle.request.environ['CONTENT_LENGTH'] = str(len(bottle.tob(body)))
+    bottle.request.environ['CONTENT_TYPE'] = "application/json"
+    bottle.request.environ['wsgi.input'] = BytesIO()
+    bottle.request.environ['wsgi.input'].write(bottle.tob(body))
+    bottle.request.environ['wsgi.input'].seek(0)
+    results = json.loads(api.aggregate("sales"))
+    assert results == [{"_id": "north", "region": "north", "total": 30}]
+    bottle.request.bind({})
+    bottle.request.environ['CONTENT_LENGTH'] = "8"
+    bottle.request.environ['CONTENT_TYPE'] = "application/json"
+    bottle.request.environ['wsgi.input'] = BytesIO(b'[{"$limi')
+    with pytest.raises(bottle.HTTPError) as error:
+        api.aggregate("sales")
+    assert error.value.status_code == 400
+    del api.collections["sales"]
+
+def test_get_records_streams_json_or_ndjson(monkeypatch):
+    monkeypatch.setattr(api, "CHUNK_RECORDS", 2)
+    api.collections["stream"] = data.store.Store(
+        {"_id": str(n), "n": n} for n in range(5))
+    bottle.request.bind({"QUERY_STRING": "$fields=n"})
+    chunks = list(api.get_records("stream"))
+    assert len(chunks) > 3
+    assert "".join(chunks) == json.dumps(
+        list(api.collections["stream"].find({}, fields=["n"])))
+    assert bottle.response.content_type == "application/json"
+    bottle.request.bind({"HTTP_ACCEPT": api.NDJSON})
+    lines = "".join(api.get_collection("stream")).splitlines()
+    assert [json.loads(line) for line in lines] == list(
+        api.collections["stream"])
+    assert bottle.response.content_type == api.NDJSON
+    api.collections["stream"] = data.store.Store()
+    bottle.request.bind({})
+    assert "".join(api.get_collection("stream")) == "[]"
+    del api.collections["stream"]
+
+def _bind_body(body, content_type):
+    bottle.request.bind({})
+    bottle.request.environ['CONTENT_LENGTH'] = str(len(bottle.tob(body)))
+    bottle.request.environ['CONTENT_TYPE'] = content_type
+    bottle.request.environ['wsgi.input'] = BytesIO(bottle.tob(body))
+
+def test_post_to_bulk_write_applies_operations_in_one_request():
+    api.collections["bulk"] = data.store.Store([{"_id": "a", "n": 1}])
+    operations = [
+        {"op": "insert", "record": {"_id": "b", "n": 2}},
+        {"op": "insert", "record": {"_id": "a"}},
+        {"op": "update", "desc": {"_id": "b"}, "updates": {"n": 3}},
+        {"op": "delete", "desc": {"n": 1}},
+        {"op": "upsert"}]
+    _bind_body(json.dumps(operations), "application/json")
+    statuses = json.loads(api.bulk_write("bulk"))
+    assert [status["ok"] for status in statuses] == [
+        True, False, True, True, False]
+    assert statuses[3]["deleted"] == 1
+    assert list(api.collections["bulk"]) == [{"_id": "b", "n": 3}]
+    body = "\n".join(json.dumps({"op": "insert", "record": {"n": n}})
+                     for n in range(3))
+    _bind_body(body, api.NDJSON)
+    statuses = json.loads(api.bulk_write("bulk"))
+    assert all(status["ok"] for status in statuses)
+    assert len(api.collections["bulk"]) == 4
+    _bind_body('{"op": "insert"', api.NDJSON)
+    with pytest.raises(bottle.HTTPError):
+        api.bulk_write("bulk")
+    assert len(api.collections["bulk"]) == 4
+    assert api.api.match({"PATH_INFO": "/collections/bulk/records:bulk",
+                          "REQUEST_METHOD": "POST"})[0].callback is \
+        api.bulk_write
+    del api.collections["bulk"]
+
+def test_get_records_answers_repeated_searches_from_the_cache(monkeypatch):
+    monkeypatch.setattr(api, "cache_size", 8)
+    bottle.request.bind({})
+    api.post_collection("cached")
+    api.collections["cached"].add_records(
+        {"_id": str(n), "n": n % 2} for n in range(4))
+    bottle.request.bind({"QUERY_STRING": "n=1"})
+    first = "".join(api.get_records("cached"))
+    bottle.request.bind({"QUERY_STRING": "n=1"})
+    assert "".join(api.get_records("cached")) == first
+    assert api.collections["cached"].cache_info()["hits"] == 1
+    del api.collections["cached"]
+
+def _conditional_get(handler, name, environ):
+    bottle.request.bind(environ)
+    bottle.response.bind()
+    return "".join(handler(name)), bottle.response
+
+def test_get_collection_and_records_answer_304_when_unchanged():
+    api.collections["polled"] = data.store.Store([{"_id": "a", "n": "1"}])
+    api.collections["polled"]._modified = time.time() - 100
+    body, response = _conditional_get(
+        api.get_records, "polled", {"QUERY_STRING": "n=1"})
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+    body, response = _conditional_get(
+        api.get_records, "polled",
+        {"QUERY_STRING": "n=1", "HTTP_IF_NONE_MATCH": etag})
+    assert (body, response.status_code) == ("", 304)
+    # A different search of the same collection has its own ETag
+    body, response = _conditional_get(
+        api.get_records, "polled",
+        {"QUERY_STRING": "n=2", "HTTP_IF_NONE_MATCH": etag})
+    assert (body, response.status_code) == ("[]", 200)
+    body, response = _conditional_get(api.get_collection, "polled", {})
+    etag = response.headers["ETag"]
+    body, response = _conditional_get(
+        api.get_collection, "polled", {"HTTP_IF_NONE_MATCH": etag})
+    assert response.status_code == 304
+    body, response = _conditional_get(
+        api.get_collection, "polled",
+        {"HTTP_IF_MODIFIED_SINCE": response.headers["Last-Modified"]})
+    assert response.status_code == 304
+    api.collections["polled"].add_record({"_id": "b", "n": "1"})
+    body, response = _conditional_get(
+        api.get_collection, "polled", {"HTTP_IF_NONE_MATCH": etag})
+    assert len(json.loads(body)) == 2
+    assert response.status_code == 200
+    del api.collections["polled"]
+
+def test_last_modified_is_only_sent_once_its_second_is_over():
+    store = api.collections["dated"] = data.store.Store([{"_id": "a"}])
+    store._modified = time.time() - 10
+    body, response = _conditional_get(api.get_collection, "dated", {})
+    since = response.headers["Last-Modified"]
+    # A write in the current second, the client's date doesn't cover it
+    store.add_record({"_id": "b"})
+    body, response = _conditional_get(
+        api.get_collection, "dated", {"HTTP_IF_MODIFIED_SINCE": since})
+    assert (len(json.loads(body)), response.status_code) == (2, 200)
+    assert "Last-Modified" not in response.headers
+    # Nor are dates of a second which isn't over trusted
+    body, response = _conditional_get(
+        api.get_collection, "dated",
+        {"HTTP_IF_MODIFIED_SINCE": bottle.http_date(time.time() + 60)})
+    assert response.status_code == 200
+    del api.collections["dated"]
+
+def test_get_collections_streams_every_collection(monkeypatch):
+    monkeypatch.setattr(api, "collections", {
+        "a": data.store.Store([{"_id": "1"}]), "b": data.store.Store()})
+    bottle.response.bind()
+    assert json.loads("".join(api.get_collections())) == {
+        "a": [{"_id": "1"}], "b": []}
+    assert bottle.response.content_type == "application/json"
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import re
+from data.store import Store
+from data.store.cache import ResultCache
+
+
+def _store():
+    store = Store([{"_id": str(n), "n": n, "even": n % 2 == 0}
+                   for n in range(10)])
+    store.enable_cache(maxsize=4)
+    return store
+
+
+def test_version_grows_with_every_change():
+    store = Store()
+    versions = [store.version]
+    store.add_record({"_id": "a", "n": 1})
+    versions.append(store.version)
+    store.add_records([{"_id": "b"}, {"_id": "c"}])
+    versions.append(store.version)
+    store.update_record({"_id": "a"}, {"n": 2})
+    versions.append(store.version)
+    store.del_record({"_id": "a"})
+    versions.append(store.version)
+    store.del_records({})
+    versions.append(store.version)
+    assert versions == sorted(set(versions))
+
+
+def test_repeated_queries_are_answered_from_the_cache():
+    store = _store()
+    first = store.find({"even": True}, order_by="n", limit=3)
+    second = store.find({"even": True}, order_by="n", limit=3)
+    assert first == second
+    assert store.cache_info()["hits"] == 1
+    # The results are copies, changing them doesn't change the cache
+    second[0]["n"] = "changed"
+    assert store.find({"even": True}, order_by="n", limit=3) == first
+    assert store.find({"even": True}, order_by="n", limit=2) == first[:2]
+    assert store.find_one({"n": 3}) == store.find_one({"n": 3})
+    assert store.find_one({"n": 99}) is None
+    assert store.find_one({"n": 99}) is None
+    assert store.cache_info()["hits"] == 4
+
+
+def test_regexes_and_callables_are_cached_by_identity():
+    store = _store()
+    regex = re.compile(r"[0-4]")
+    store.find({"_id": regex})
+    store.find({"_id": regex})
+    store.find({"n": lambda n: n < 5})
+    store.find({"n": lambda n: n < 5})
+    assert store.cache_info()["hits"] == 1
+    # Descs holding unhashable values are never cached (nor missed)
+    store.find({"n": {"$in": set([1, 2])}})
+    assert store.cache_info()["misses"] == 3
+
+
+def test_writes_invalidate_the_affected_results():
+    store = _store()
+    assert len(store.find({"even": True})) == 5
+    store.find({"n": {"$lt": 3}})
+    store.add_record({"_id": "10", "n": 10, "even": True})
+    assert len(store.find({"even": True})) == 6
+    assert store.cache_info()["hits"] == 0
+    store.find({"n": {"$lt": 3}})
+    # Updating a field the query doesn't depend on, in a record it
+    # didn't return, keeps its results
+    store.update_record({"_id": "9"}, {"name": "nine"})
+    store.find({"n": {"$lt": 3}})
+    assert store.cache_info()["hits"] == 1
+    # Updating a record it returned drops them
+    store.update_record({"_id": "1"}, {"name": "one"})
+    assert store.find({"n": {"$lt": 3}})[1]["name"] == "one"
+    # and so does updating a field it depends on
+    store.update_record({"_id": "9"}, {"n": -9})
+    assert len(store.find({"n": {"$lt": 3}})) == 4
+    store.del_record({"_id": "0"})
+    assert len(store.find({"n": {"$lt": 3}})) == 3
+    assert store.cache_info()["hits"] == 1
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = ResultCache(2)
+    for n in range(3):
+        cache.put(cache.key("find", {"n": n}, ()), [], {"n": n}, ["n"])
+        cache.get(cache.key("find", {"n": 0}, ()))
+    assert len(cache) == 2
+    assert cache.get(cache.key("find", {"n": 0}, ()))[0]
+    assert not cache.get(cache.key("find", {"n": 1}, ()))[0]
+
+
+def test_disable_cache_stops_caching():
+    store = _store()
+    store.find({})
+    store.disable_cache()
+    assert store.cache_info() is None
+    store.find({})
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import base64
+from cStringIO import StringIO
+from itertools import cycle, izip
+import data.store
+from data.store import cipher
+from data.store.cipher import (
+    encrypt, decrypt, xor, EncryptingWriter, DecryptingReader)
+
+
+def _legacy_encrypt(string, key="_"):
+    return base64.encodestring(
+        ''.join(
+            chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key)))).strip()
+
+
+def _legacy_decrypt(string, key="_"):
+    string = base64.decodestring(string)
+    return ''.join(
+        chr(ord(c) ^ ord(k)) for c, k in izip(string, cycle(key))).strip()
+
+
+def test_encrypt_and_decrypt_match_the_legacy_implementation():
+    """Tests that encrypt and decrypt produce exactly what the
+    character at a time implementation did, including leading zero
+    bytes and lengths which don't fill a whole base64 line."""
+    for size in (0, 1, 56, 57, 58, 1000):
+        data = os.urandom(size)
+        for key in ("_", "password", "a longer key than some of the data"):
+            encrypted = encrypt(data, key)
+            assert encrypted == _legacy_encrypt(data, key)
+            assert decrypt(encrypted, key) == _legacy_decrypt(encrypted, key)
+    assert xor("\x00\x00abc", "\x00") == "\x00\x00abc"
+
+
+def test_encrypt_accepts_unicode():
+    """Tests that unicode strings are encrypted as utf-8."""
+    assert decrypt(encrypt(u"caf\xe9", u"k\xe9y"), u"k\xe9y") == "caf\xc3\xa9"
+
+
+def _stream(data, key, piece):
+    out = StringIO()
+    writer = EncryptingWriter(out, key)
+    for start in xrange(0, len(data), piece):
+        writer.write(data[start:start + piece])
+    writer.close()
+    return out.getvalue()
+
+
+def test_streaming_matches_encrypt_across_chunks(monkeypatch):
+    """Tests that EncryptingWriter and DecryptingReader agree with
+    encrypt and decrypt when the data spans many chunks, whatever the
+    size of the writes and reads."""
+    monkeypatch.setattr(cipher, "CHUNK", cipher.LINE * 2)
+    for size in (cipher.LINE * 2, cipher.LINE * 6, 1000):
+        data = os.urandom(size)
+        for piece in (1, 7, 200, size):
+            assert _stream(data, "password", piece) == encrypt(
+                data, "password")
+        reader = DecryptingReader(
+            StringIO(encrypt(data, "password")), "password")
+        chunks = [reader.read(13)]
+        while chunks[-1]:
+            chunks.append(reader.read(13))
+        assert "".join(chunks) == data
+
+
+def test_readline_returns_whole_lines(monkeypatch):
+    """Tests that DecryptingReader.readline returns lines split across
+    chunks whole."""
+    monkeypatch.setattr(cipher, "CHUNK", cipher.LINE)
+    lines = ["line {}\n".format("x" * n) for n in range(0, 200, 13)]
+    reader = DecryptingReader(
+        StringIO(encrypt("".join(lines) + "end", "key")), "key")
+    assert [reader.readline() for line in lines] == lines
+    assert reader.readline() == "end"
+    assert reader.readline() == ""
+
+
+def test_encrypted_persist_can_be_read_by_the_legacy_decrypt(tmpdir):
+    """Tests that a Store persisted with a password is encrypted
+    exactly as it was before streaming, so files written by either
+    version can be loaded by the other."""
+    import pickle
+    filename = str(tmpdir.join("test.db"))
+    store = data.store.Store({"n": n} for n in range(100))
+    store.persist(filename, password="password")
+    with open(filename, "rb") as fin:
+        assert pickle.loads(_legacy_decrypt(fin.read(), "password")) == store
+    with open(filename, "wb") as fout:
+        fout.write(_legacy_encrypt(pickle.dumps(store), "password"))
+    assert data.store.load(filename, password="password") == store
+
+
+def test_key_stream_matches_xor_at_every_offset():
+    """Tests that KeyStream.xor, which XORs short values as integers,
+    agrees with xor for every offset into the key and on both sides
+    of the size at which it switches to xor."""
+    stream = cipher.key_stream("password")
+    assert cipher.key_stream("password") is stream
+    for size in (1, 5, cipher.SMALL, cipher.SMALL + 1):
+        data = os.urandom(size)
+        for offset in range(len("password") + 1):
+            assert stream.xor(data, offset) == xor(data, "password", offset)
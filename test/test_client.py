@@ -36,3 +36,129 @@ def test_client_sanity(start_server):
     c = client.Client("127.0.0.1", 8080)
     coll = c.get_collections()
     assert isinstance(coll, dict)
+
+
+@pytest.fixture
+def local_server():
+    """Serves the api on a free port from a background thread."""
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+    server = make_server("127.0.0.1", 0, api.api, handler_class=QuietHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    api.collections["client"] = Store()
+    yield server.server_port
+    del api.collections["client"]
+    server.shutdown()
+
+
+def test_client_reuses_pooled_connections(local_server):
+    with client.Client("127.0.0.1", local_server, pool_size=2) as c:
+        c.add_record("client", {"n": 1})
+        c.add_record("client", {"n": 2})
+        assert len(c.get_records("client", {})) == 2
+        pool = c.session.get_adapter("http://").poolmanager
+        assert len(pool.pools) == 1
+
+
+def test_client_buffers_writes_until_flushed(local_server):
+    c = client.Client("127.0.0.1", local_server, buffer_size=3)
+    records = [c.add_record("client", {"n": n}) for n in range(2)]
+    assert all("_id" in record for record in records)
+    assert len(api.collections["client"]) == 0
+    c.add_record("client", {"n": 2})
+    assert len(api.collections["client"]) == 3
+    c.add_record("client", {"n": 3})
+    c.close()
+    assert sorted(record["n"] for record in api.collections["client"]) == [
+        0, 1, 2, 3]
+
+
+def test_client_flushes_buffered_writes_periodically(local_server):
+    with client.Client("127.0.0.1", local_server, buffer_size=100,
+                       flush_interval=0.05) as c:
+        c.add_record("client", {"n": 1})
+        for _ in range(100):
+            if len(api.collections["client"]):
+                break
+            sleep(0.01)
+        assert len(api.collections["client"]) == 1
+
+
+def _wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return True
+        sleep(0.01)
+    return False
+
+
+def test_client_keeps_flushing_after_errors_and_keeps_failures(local_server):
+    with client.Client("127.0.0.1", local_server, buffer_size=100,
+                       flush_interval=0.02) as c:
+        c.add_record("later", {"_id": "a"})
+        assert _wait_for(lambda: c.flush_error is not None)
+        assert isinstance(c.flush_error, requests.HTTPError)
+        api.collections["later"] = Store()
+        assert _wait_for(lambda: len(api.collections["later"]) == 1)
+        assert _wait_for(lambda: c.flush_error is None)
+        c.add_record("later", {"_id": "a", "n": 2})
+        assert _wait_for(lambda: c._failed)
+        [(collection, record, status)] = c.failures()
+        assert (collection, record["n"], status["ok"]) == ("later", 2, False)
+        assert c.failures() == []
+        c.add_record("later", {"_id": "a", "n": 3})
+    # The inserts refused by the flush on close are kept too
+    [(collection, record, status)] = c.failures()
+    assert (record["n"], status["ok"]) == (3, False)
+    del api.collections["later"]
+
+def test_async_client_fans_out_requests(local_server):
+    with client.AsyncClient("127.0.0.1", local_server, concurrency=4,
+                            max_pending=8) as c:
+        added = []
+        results = [c.add_record("client", {"n": n}, callback=added.append)
+                   for n in range(50)]
+        assert sorted(result.get(10)["n"] for result in results) == range(50)
+        assert len(added) == 50
+        found = c.get_records("client", {"n": {"$lt": 10}}).get(10)
+        assert len(found) == 10
+        records = c.iter_records("client", {}, buffer=5)
+        assert sorted(record["n"] for record in records) == range(50)
+        with pytest.raises(requests.HTTPError):
+            list(c.iter_records("missing", {}))
+        abandoned = c.iter_records("client", {}, buffer=1)
+        next(abandoned)
+        abandoned.close()
+
+
+def test_client_reuses_responses_the_server_says_are_unchanged(local_server):
+    statuses = []
+    with client.Client("127.0.0.1", local_server) as c:
+        c.session.hooks["response"].append(
+            lambda response, *args, **kwargs: statuses.append(
+                response.status_code))
+        c.add_record("client", {"_id": "a", "n": "1"})
+        assert c.get_collection("client") == [{"_id": "a", "n": "1"}]
+        assert c.get_collection("client") == [{"_id": "a", "n": "1"}]
+        assert len(c.get_records("client", {"n": "1"})) == 1
+        assert len(c.get_records("client", {"n": "1"})) == 1
+        c.add_record("client", {"_id": "b", "n": "1"})
+        assert len(c.get_records("client", {"n": "1"})) == 2
+    assert statuses == [200, 200, 304, 200, 304, 200, 200]
+
+
+def test_async_client_closes_with_an_unstarted_iterator(local_server):
+    api.collections["client"].add_records({"n": n} for n in range(20))
+    c = client.AsyncClient("127.0.0.1", local_server, concurrency=2)
+    unstarted = c.iter_records("client", {}, buffer=1)
+    del unstarted
+    closing = Thread(target=c.close)
+    closing.daemon = True
+    closing.start()
+    closing.join(5)
+    assert not closing.is_alive()
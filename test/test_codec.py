@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+import data.store
+from data.store import Store, codec
+
+
+def _store():
+    store = Store({"_id": str(n), "n": n, "name": u"user{}".format(n),
+                   "tags": ["a", "b"], "score": n / 3.0, "active": n % 2 == 0,
+                   "missing": None}
+                  for n in range(50))
+    store.create_index("n", unique=True)
+    store.create_index("score", ordered=True)
+    store.enable_cache(16)
+    return store
+
+
+@pytest.mark.parametrize("name", codec.available())
+def test_every_codec_round_trips_records_and_indexes(tmpdir, name):
+    filename = str(tmpdir.join("test.db"))
+    store = _store()
+    store.persist(filename, codec=name)
+    loaded = data.store.load(filename)
+    assert loaded == store
+    assert sorted(loaded._indexes) == ["n", "score"]
+    assert loaded.find({"score": {"$gt": 16.0}}) == store.find(
+        {"score": {"$gt": 16.0}})
+    assert loaded.cache_info()["maxsize"] == 16
+    assert data.store.load(filename, codec=name) == store
+
+
+@pytest.mark.parametrize("name", codec.available())
+def test_every_codec_can_be_encrypted(tmpdir, name):
+    filename = str(tmpdir.join("test.db"))
+    store = _store()
+    store.persist(filename, password="password", codec=name)
+    assert data.store.load(filename, password="password") == store
+    with pytest.raises(ValueError):
+        data.store.load(filename)
+
+
+def test_load_refuses_files_written_with_another_codec(tmpdir):
+    filename = str(tmpdir.join("test.db"))
+    store = _store()
+    store.persist(filename, codec="pickle")
+    with pytest.raises(ValueError):
+        data.store.load(filename, codec="jsonl")
+    # Files written without a codec are pickles too
+    store.persist(filename)
+    with pytest.raises(ValueError):
+        data.store.load(filename, codec="jsonl")
+    assert data.store.load(filename, codec="pickle") == store
+
+
+def test_unknown_codecs_are_refused(tmpdir):
+    with pytest.raises(ValueError):
+        _store().persist(str(tmpdir.join("test.db")), codec="yaml")
+
+
+def test_a_failed_persist_leaves_the_previous_file(tmpdir):
+    filename = str(tmpdir.join("test.db"))
+    store = _store()
+    store.persist(filename, codec="jsonl")
+    store.add_record({"_id": "late", "when": datetime.datetime.now()})
+    with pytest.raises(TypeError):
+        store.persist(filename, codec="jsonl")
+    assert len(data.store.load(filename)) == 50
+    assert tmpdir.listdir() == [tmpdir.join("test.db")]
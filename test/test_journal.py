@@ -0,0 +1,132 @@
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.getcwd())
+import pytest
+import data.store
+from data.store import Store
+from data.store import journal
+
+
+def _filename():
+    return os.path.join(tempfile.mkdtemp(), "journaled.db")
+
+
+def _create_store():
+    return Store([{"n": n, "group": n % 3} for n in range(30)])
+
+
+def _mutate(store):
+    """Makes one of every kind of logged change to store."""
+    store.create_index("group")
+    store.add_record({"n": 100, "group": 1, "_id": "hundred"})
+    store.add_records([{"n": 101 + n, "group": 2} for n in range(3)])
+    store.update_record({"_id": "hundred"}, {"n": 99})
+    store.del_record({"n": 0})
+    store.del_records({"group": 0})
+    store.retain({"n": {"$lt": 102}})
+    store.drop_index("group")
+
+
+@pytest.mark.parametrize("sync", ["always", "group", "never"])
+def test_load_replays_the_journal(sync):
+    """Tests that every change made to a journaled Store is rebuilt by
+    load, without the Store having been persisted again."""
+    filename = _filename()
+    store = _create_store()
+    store.journal(filename, sync=sync, interval=0.01)
+    _mutate(store)
+    store.close_journal()
+    loaded = data.store.load(filename)
+    assert loaded == store
+    assert loaded._indexes.keys() == []
+    assert loaded.find_one({"_id": "hundred"})["n"] == 99
+
+
+def test_load_ignores_a_torn_frame_at_the_end_of_the_log():
+    """Tests that a partially written change is ignored."""
+    filename = _filename()
+    store = _create_store()
+    store.journal(filename)
+    store.add_record({"_id": "complete"})
+    expected = list(store)
+    store.add_record({"_id": "torn"})
+    store.close_journal()
+    wal = journal.wal_filename(filename)
+    with open(wal, "rb+") as fout:
+        fout.truncate(os.path.getsize(wal) - 3)
+    assert data.store.load(filename) == expected
+
+
+def test_journal_compacts_the_log_in_the_background():
+    """Tests that the log is truncated into a fresh snapshot once it
+    grows past compact_size."""
+    filename = _filename()
+    store = _create_store()
+    store.journal(filename, compact_size=1024)
+    for n in range(200):
+        store.add_record({"n": n})
+    deadline = time.time() + 5
+    while (os.path.getsize(journal.wal_filename(filename)) > 2048 and
+           time.time() < deadline):
+        time.sleep(0.01)
+    assert os.path.getsize(journal.wal_filename(filename)) <= 2048
+    store.add_record({"n": "last"})
+    store.close_journal()
+    assert data.store.load(filename) == store
+
+
+def test_changes_already_in_the_snapshot_are_not_replayed():
+    """Tests that log entries older than the snapshot are skipped, as
+    happens after a crash between writing a snapshot and truncating
+    the log."""
+    filename = _filename()
+    store = _create_store()
+    store.journal(filename)
+    store.add_record({"_id": "logged"})
+    store.close_journal()
+    with open(journal.wal_filename(filename), "rb") as fin:
+        wal = fin.read()
+    store.journal(filename)
+    store.close_journal()
+    with open(journal.wal_filename(filename), "wb") as fout:
+        fout.write(wal)
+    assert data.store.load(filename) == store
+
+
+class _FailingFile(object):
+    """Wraps a file, writing half of the data and then failing on the
+    first failures calls to write."""
+    def __init__(self, fout, failures):
+        self._fout = fout
+        self.failures = failures
+
+    def write(self, data):
+        if self.failures:
+            self.failures -= 1
+            self._fout.write(data[:len(data) // 2])
+            raise IOError("No space left on device")
+        self._fout.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fout, name)
+
+
+def test_group_journal_retries_failed_writes_in_the_background():
+    """Tests that the background flush keeps going after a write fails
+    and that the changes it couldn't write are logged whole later."""
+    filename = _filename()
+    store = _create_store()
+    store.journal(filename, sync="group", interval=0.01)
+    store._journal._file = _FailingFile(store._journal._file, 3)
+    store.add_record({"_id": "delayed"})
+    deadline = time.time() + 5
+    while store._journal.error is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert isinstance(store._journal.error, IOError)
+    while store._journal._file.failures and time.time() < deadline:
+        time.sleep(0.01)
+    store.add_record({"_id": "after"})
+    store.close_journal()
+    assert data.store.load(filename) == store
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import pytest
+from threading import Thread, Event
+from data.store import Store
+from data.store.lock import RWLock
+
+
+def _hold(lock, side, entered, release):
+    def run():
+        with getattr(lock, side)():
+            entered.set()
+            release.wait(5)
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_readers_share_the_lock_and_writers_wait():
+    """Tests that a second reader gets in while a reader holds the
+    lock, but a writer has to wait for both to leave."""
+    lock = RWLock()
+    first, second, written, release = Event(), Event(), Event(), Event()
+    readers = [_hold(lock, "read", first, release),
+               _hold(lock, "read", second, release)]
+    assert first.wait(5) and second.wait(5)
+    writer = _hold(lock, "write", written, Event())
+    assert not written.wait(0.1)
+    release.set()
+    for reader in readers:
+        reader.join(5)
+    assert written.wait(5)
+
+
+def test_waiting_writers_go_before_new_readers():
+    """Tests that once a writer is waiting, new readers queue behind
+    it."""
+    lock = RWLock()
+    reading, release = Event(), Event()
+    reader = _hold(lock, "read", reading, release)
+    assert reading.wait(5)
+    written, late_read = Event(), Event()
+    writer = _hold(lock, "write", written, Event())
+    while not lock._waiting:
+        pass
+    late = _hold(lock, "read", late_read, Event())
+    assert not late_read.wait(0.1)
+    release.set()
+    assert written.wait(5)
+
+
+def test_lock_is_reentrant_but_refuses_upgrades():
+    """Tests that both sides are reentrant, that the writer may read
+    and that a reader can't take the write side."""
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        with lock.read():
+            with pytest.raises(RuntimeError):
+                lock.acquire_write()
+    with lock.write():
+        pass
+
+
+def test_iter_find_survives_deletes_while_iterating():
+    """Tests that records can be deleted from a Store while an
+    iter_find over it is being consumed."""
+    store = Store({"n": n} for n in range(10))
+    seen = []
+    for record in store.iter_find({}):
+        seen.append(record["n"])
+        if record["n"] == 2:
+            store.del_records({"n": {"$gt": 2}})
+    assert seen == range(10)
+    assert len(store) == 3
+
+
+def test_concurrent_reads_and_writes_keep_the_store_consistent():
+    """Tests that finds running alongside adds and deletes always see
+    whole records and leave the indexes in sync."""
+    store = Store({"n": n, "group": n % 5} for n in range(500))
+    store.create_index("group")
+    errors = []
+
+    def read():
+        try:
+            for _ in range(50):
+                for record in store.find({"group": 3}):
+                    assert record["group"] == 3
+        except Exception as error:
+            errors.append(error)
+
+    def write():
+        try:
+            for n in range(500, 600):
+                store.add_record({"n": n, "group": n % 5})
+                store.del_records({"n": n - 500})
+        except Exception as error:
+            errors.append(error)
+    threads = [Thread(target=read) for _ in range(4)] + [Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(store) == 500
+    assert len(store.find({"group": 3})) == 100
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.getcwd())
+import pytest
+import data.store
+from data.store import Store, MappedStore, dump_mapped
+
+
+def _create_mapped(fields=None):
+    store = Store([{"n": n, "group": n % 3, "tags": [n]} for n in range(30)])
+    store.create_index("group")
+    filename = os.path.join(tempfile.mkdtemp(), "mapped.db")
+    dump_mapped(store, filename, fields=fields)
+    return store, filename
+
+
+def test_mapped_store_reads_records_lazily():
+    """Tests that a MappedStore gives the same records as the Store it
+    was written from, decoding them one at a time."""
+    store, filename = _create_mapped()
+    with MappedStore(filename) as mapped:
+        assert len(mapped) == 30
+        assert mapped[0] == store[0]
+        assert mapped[-1] == store[-1]
+        assert list(mapped) == list(store)
+        with pytest.raises(IndexError):
+            mapped[30]
+
+
+def test_mapped_store_answers_queries_from_stored_indexes():
+    """Tests that indexed queries only decode the matching records."""
+    store, filename = _create_mapped()
+    with MappedStore(filename) as mapped:
+        assert sorted(mapped.indexed_fields()) == ["_id", "group"]
+        decoded = []
+        getitem = mapped.__getitem__
+        mapped.__getitem__ = lambda position: (
+            decoded.append(position) or getitem(position))
+        result = mapped.find({"group": 1, "n": {"$gt": 10}})
+        assert result == store.find({"group": 1, "n": {"$gt": 10}})
+        assert decoded == range(1, 30, 3)
+        del decoded[:]
+        _id = store[7]["_id"]
+        assert mapped.find_one({"_id": _id}, fields=["n"]) == {
+            "_id": _id, "n": 7}
+        assert decoded == [7]
+        del decoded[:]
+        assert len(mapped.find({"group": {"$in": [0, 2]}})) == 20
+        assert len(decoded) == 20
+
+
+def test_mapped_store_supports_find_options():
+    """Tests that find, iter_find and find_one accept Store's options."""
+    store, filename = _create_mapped(fields=[])
+    with MappedStore(filename) as mapped:
+        assert mapped.find({"tags": [3]}) == store.find({"tags": [3]})
+        assert mapped.find({}, order_by="n", reverse=True, limit=2) == \
+            store.find({}, order_by="n", reverse=True, limit=2)
+        results = list(mapped.iter_find({"group": 0}, skip=1, limit=2,
+                                        sanitize_list=["n"]))
+        assert [r["n"] for r in results] == ["*" * 8] * 2
+        assert mapped.find_one({"n": 100}) is None
+
+
+def test_load_reads_mapped_files():
+    """Tests that load returns a complete Store for mapped files."""
+    store, filename = _create_mapped()
+    loaded = data.store.load(filename)
+    assert loaded == store
+    assert "group" in loaded._indexes
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import pytest
+from data.store import Store
+
+
+def _create_store():
+    """Helper which creates a Store of people."""
+    return Store([
+        {"_id": "1", "name": "a", "age": 30, "city": "x"},
+        {"_id": "2", "name": "b", "age": 17, "city": "y"},
+        {"_id": "3", "name": "c", "age": 65, "city": "x"},
+        {"_id": "4", "name": "d", "age": 18, "city": "y"},
+        {"_id": "5", "name": "e", "age": 30, "city": "x"}])
+
+
+def test_aggregate_matches_find_for_match_sort_skip_and_limit():
+    """Tests that $match, $sort, $skip and $limit give the same
+    records as find, with and without a sorted index."""
+    store = _create_store()
+    pipeline = [{"$match": {"age": {"$gte": 18}}},
+                {"$sort": {"by": "age", "reverse": True}},
+                {"$skip": 1}, {"$limit": 2}]
+    expected = list(store.find({"age": {"$gte": 18}}, order_by="age",
+                               reverse=True, skip=1, limit=2))
+    assert list(store.aggregate(pipeline)) == expected
+    store.create_index("age", ordered=True)
+    assert list(store.aggregate(pipeline)) == expected
+
+
+def test_aggregate_sorts_and_slices_after_later_stages():
+    """Tests that $sort, $skip and $limit work on the output of
+    $group, and that $limit before $skip takes the limit first."""
+    store = _create_store()
+    results = list(store.aggregate([
+        {"$group": {"by": "city", "aggregates": {"n": "count"}}},
+        {"$sort": "n"}]))
+    assert [(result["city"], result["n"]) for result in results] == [
+        ("y", 2), ("x", 3)]
+    results = list(store.aggregate([
+        {"$sort": "age"}, {"$limit": 3}, {"$skip": 1}]))
+    assert [result["_id"] for result in results] == ["4", "1"]
+
+
+def test_aggregate_groups_by_multiple_fields_and_projects():
+    """Tests that $group on a list of fields keys groups by tuples
+    and passes on the fields, and that $project copies records."""
+    store = _create_store()
+    results = list(store.aggregate([
+        {"$group": {"by": ["city", "age"], "aggregates": {"n": "count"}}},
+        {"$match": {"n": 2}}]))
+    assert results == [{"_id": ("x", 30), "city": "x", "age": 30, "n": 2}]
+    results = list(store.aggregate([
+        {"$match": {"city": "y"}}, {"$project": ["name"]}]))
+    assert results == [{"_id": "2", "name": "b"}, {"_id": "4", "name": "d"}]
+
+
+def test_aggregate_groups_by_a_list_of_one_field():
+    """Tests that $group on a one element list passes on the value of
+    the field, not the tuple the group is keyed by."""
+    store = _create_store()
+    results = list(store.aggregate([
+        {"$group": {"by": ["city"], "aggregates": {"n": "count"}}},
+        {"$sort": "n"}]))
+    assert results == [{"_id": ("y",), "city": "y", "n": 2},
+                       {"_id": ("x",), "city": "x", "n": 3}]
+
+def test_aggregate_is_lazy_and_returns_copies():
+    """Tests that records are only matched as results are consumed
+    and that the Store can't be modified through them."""
+    store = _create_store()
+    seen = []
+
+    def check(value):
+        seen.append(value)
+        return True
+    results = store.aggregate([{"$match": {"name": check}}, {"$limit": 1}])
+    assert seen == []
+    record = next(results)
+    assert seen == ["a"]
+    record["name"] = "changed"
+    assert store[0]["name"] == "a"
+
+
+def test_aggregate_rejects_unknown_stages():
+    """Tests that aggregate raises a ValueError for malformed or
+    unknown stages."""
+    store = _create_store()
+    with pytest.raises(ValueError):
+        store.aggregate([{"$unwind": "x"}])
+    with pytest.raises(ValueError):
+        store.aggregate([{"$match": {}, "$limit": 1}])
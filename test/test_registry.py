@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import gc
+from threading import Thread, Event
+import pytest
+import data.store
+from data.store import Store
+from data.store.registry import Registry
+
+
+def _fill(directory, count):
+    with Registry(directory, flush_interval=None) as registry:
+        for n in range(count):
+            registry["c{}".format(n)] = Store(
+                {"_id": str(x), "n": x} for x in range(10))
+
+
+def test_collections_survive_a_restart(tmpdir):
+    directory = str(tmpdir)
+    with Registry(directory, flush_interval=None) as registry:
+        registry["users"] = Store([{"_id": "a", "name": "cliff"}])
+        registry["odd/name"] = Store()
+        registry["users"].add_record({"_id": "b", "name": "lowks"})
+    with Registry(directory, flush_interval=None) as registry:
+        assert list(registry) == ["odd/name", "users"]
+        assert "users" in registry and "missing" not in registry
+        assert registry.loaded() == []
+        assert len(registry["users"]) == 2
+        assert registry.loaded() == ["users"]
+        del registry["users"]
+        with pytest.raises(KeyError):
+            registry["users"]
+    assert os.listdir(directory) == ["odd%2Fname.db"]
+
+
+def test_least_recently_used_collections_are_evicted(tmpdir):
+    directory = str(tmpdir)
+    _fill(directory, 4)
+    with Registry(directory, max_collections=2,
+                  flush_interval=None) as registry:
+        registry["c0"]
+        registry["c1"]
+        registry["c0"]
+        registry["c2"].add_record({"_id": "new"})
+        assert registry.loaded() == ["c0", "c2"]
+        # The changed collection is written when it is evicted
+        registry["c3"]
+        registry["c1"]
+        assert registry.loaded() == ["c3", "c1"]
+        assert len(registry["c2"]) == 11
+    with Registry(directory, max_records=25,
+                  flush_interval=None) as registry:
+        for name in ["c0", "c1", "c2"]:
+            registry[name]
+        assert registry.loaded() == ["c1", "c2"]
+
+
+def test_collections_in_use_are_kept_until_released(tmpdir):
+    directory = str(tmpdir)
+    _fill(directory, 2)
+    with Registry(directory, max_collections=1,
+                  flush_interval=None) as registry:
+        store = registry["c0"]
+        registry["c1"]
+        assert registry.loaded() == ["c1", "c0"]
+        store.add_record({"_id": "late"})
+        assert registry["c0"] is store
+        registry["c1"]
+        store.add_record({"_id": "later"})
+        del store
+        gc.collect()
+        registry.flush()
+        assert registry.loaded() == ["c1"]
+        assert set(["late", "later"]) <= set(registry["c0"]._ids)
+
+
+def test_changes_are_flushed_in_the_background(tmpdir):
+    directory = str(tmpdir)
+    with Registry(directory, flush_interval=0.05) as registry:
+        registry["users"] = Store()
+        registry["users"].add_record({"_id": "a"})
+        for _ in range(100):
+            if os.path.exists(os.path.join(directory, "users.db")):
+                break
+            registry._closed.wait(0.01)
+        with Registry(directory, flush_interval=None) as other:
+            assert len(other["users"]) == 1
+
+
+def test_reading_a_collection_does_not_block_the_others(tmpdir, monkeypatch):
+    directory = str(tmpdir)
+    _fill(directory, 2)
+    reading, release = Event(), Event()
+    load = data.store.load
+
+    def slow_load(filename, *args, **kwargs):
+        if "c1" in filename:
+            reading.set()
+            release.wait(5)
+        return load(filename, *args, **kwargs)
+    monkeypatch.setattr(data.store, "load", slow_load)
+    with Registry(directory, flush_interval=None) as registry:
+        registry["c0"]
+        readers = [Thread(target=registry.__getitem__, args=("c1",))
+                   for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        assert reading.wait(5)
+        # The registry's lock isn't held while c1 is read
+        registry["c0"].add_record({"_id": "new"})
+        registry.flush()
+        assert registry.loaded() == ["c0"]
+        release.set()
+        for reader in readers:
+            reader.join()
+        assert registry.loaded() == ["c0", "c1"]
+
+
+def test_background_flushes_survive_errors(tmpdir):
+    directory = str(tmpdir)
+    with Registry(directory, flush_interval=0.02, codec="jsonl") as registry:
+        registry["good"] = Store([{"_id": "a"}])
+        registry["bad"] = Store([{"_id": "a", "value": object()}])
+        for _ in range(200):
+            if registry.error is not None:
+                break
+            registry._closed.wait(0.01)
+        assert isinstance(registry.error, TypeError)
+        assert os.path.exists(os.path.join(directory, "good.db"))
+        registry["bad"].update_record({"_id": "a"}, {"value": 1})
+        for _ in range(200):
+            if registry.error is None:
+                break
+            registry._closed.wait(0.01)
+        assert registry.error is None
+    with Registry(directory, flush_interval=None) as registry:
+        assert registry["bad"].find_one({})["value"] == 1
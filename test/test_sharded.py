@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import re
+import cPickle
+import pytest
+from data.store import Store
+from data.store.sharded import ShardedStore
+
+
+def _is_even(value):
+    return value % 2 == 0
+
+
+def _records():
+    return [{"_id": str(n), "n": n, "group": n % 3, "name": "r{}".format(n)}
+            for n in range(30)]
+
+
+@pytest.fixture
+def sharded():
+    store = ShardedStore(_records(), shards=3)
+    yield store
+    store.close()
+
+
+def test_sharded_store_splits_records_across_shards(sharded):
+    """Tests that every record lands on exactly one shard and that
+    the shards each get some."""
+    sizes = sharded._broadcast("__len__")
+    assert sum(sizes) == len(sharded) == 30
+    assert all(sizes)
+
+
+def test_sharded_find_matches_store_find(sharded):
+    """Tests that find, sort and find_one on a ShardedStore give the
+    same records as on a Store, including ordered, limited and
+    reversed results and picklable callables and regexes."""
+    store = Store(_records())
+    queries = [
+        ({"n": {"$gte": 10}}, {"order_by": "n", "limit": 5, "skip": 2}),
+        ({"group": 1}, {"order_by": "n", "reverse": True}),
+        ({"n": _is_even}, {"order_by": "name", "limit": 4}),
+        ({"name": re.compile("r1")}, {"order_by": "n", "fields": ["n"]})]
+    for desc, options in queries:
+        assert list(sharded.find(desc, **options)) == list(
+            store.find(desc, **options))
+    assert len(sharded.find({"group": 2})) == 10
+    assert list(sharded.sort("n", limit=3, reverse=True)) == list(
+        store.sort("n", limit=3, reverse=True))
+    assert sharded.find_one({"_id": "7"}) == store.find_one({"_id": "7"})
+    assert sharded.find_one({"_id": "missing"}) is None
+
+
+def test_sharded_group_by_merges_shards(sharded):
+    """Tests that group_by merges the groups and aggregates computed
+    by each shard."""
+    store = Store(_records())
+    aggregates = {"n": "count", "total": ("sum", "n"), "low": ("min", "n"),
+                  "high": ("max", "n"), "mean": ("avg", "n")}
+    assert sharded.group_by("group", aggregates=aggregates) == \
+        store.group_by("group", aggregates=aggregates)
+    groups = sharded.group_by("group", desc={"n": {"$lt": 9}})
+    assert sorted(record["n"] for record in groups[0]) == [0, 3, 6]
+
+
+def test_sharded_writes_and_errors(sharded):
+    """Tests add_record, del_records, that a shard's exception is
+    raised in the caller and that an unpicklable desc doesn't leave
+    the shards out of step."""
+    record = sharded.add_record({"n": 100})
+    assert sharded.find_one({"_id": record["_id"]})["n"] == 100
+    with pytest.raises(ValueError):
+        sharded.add_record({"_id": "3"})
+    deleted = sharded.del_records({"n": {"$gte": 20}})
+    assert len(deleted) == 11
+    assert len(sharded) == 20
+    with pytest.raises(cPickle.PicklingError):
+        sharded.find({"n": lambda n: True})
+    assert len(sharded.find({})) == 20
+
+
+def test_sharded_store_accepts_unicode_ids(sharded):
+    """Tests that records with non-ASCII unicode '_id's are added and
+    found, and that ASCII ids hash alike as str and unicode."""
+    sharded.add_record({"_id": u"caf\xe9", "n": 100})
+    sharded.add_records([{"_id": u"\u65e5\u672c", "n": 101}])
+    assert sharded.find_one({"_id": u"caf\xe9"})["n"] == 100
+    assert sharded.find_one({"_id": u"\u65e5\u672c"})["n"] == 101
+    assert sharded._shard(u"abc") == sharded._shard("abc")